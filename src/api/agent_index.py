@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import copy
+import logging
+from typing import Optional, Sequence, Set
+
+from azure.ai.projects.aio import AIProjectClient
+from azure.ai.projects.models import AgentVersionObject, AzureAISearchAgentTool, Tool
+
+logger = logging.getLogger("azureaiapp")
+
+
+def get_search_index_name(agent_obj: AgentVersionObject) -> Optional[str]:
+    """
+    Get the name of the index, the agent searches.
+
+    :param agent_obj: The agent.
+    :return: The index name or None if the agent does not use Azure AI Search.
+    """
+    for tool in getattr(agent_obj.definition, 'tools', None) or []:
+        if isinstance(tool, AzureAISearchAgentTool):
+            return tool.azure_ai_search.indexes[0].index_name
+    return None
+
+
+async def copy_agent(
+        project_client: AIProjectClient,
+        agent_obj: AgentVersionObject,
+        index_name: Optional[str] = None,
+        tools: Sequence[Tool] = (),
+        instructions: Optional[str] = None) -> AgentVersionObject:
+    """
+    Create the new version of the agent, which copies the definition of the given one.
+
+    The instructions, model and tools of the agent, including the customized ones, are
+    kept; only the index of its search tool is replaced and the tools are appended.
+
+    :param project_client: The project client.
+    :param agent_obj: The version of the agent to copy.
+    :param index_name: The name of the index to search or None to keep the index.
+    :param tools: The tools to add.
+    :param instructions: The text to append to the instructions of the agent.
+    :return: The new version of the agent.
+    """
+    definition = copy.deepcopy(agent_obj.definition)
+    if index_name is not None:
+        for tool in definition.tools:
+            if isinstance(tool, AzureAISearchAgentTool):
+                tool.azure_ai_search.indexes[0].index_name = index_name
+    if tools:
+        definition.tools = [*(definition.tools or []), *tools]
+    if instructions:
+        definition.instructions = f"{definition.instructions or ''} {instructions}".lstrip()
+    new_agent = await project_client.agents.create_version(agent_name=agent_obj.name, definition=definition)
+    logger.info(f"Created agent {new_agent.id} from {agent_obj.id}.")
+    return new_agent
+
+
+async def repin_agent(
+        project_client: AIProjectClient, agent_name: str, index_name: str) -> Optional[AgentVersionObject]:
+    """
+    Create the new version of the agent, which searches the given index.
+
+    The new version copies the definition of the latest one and differs only by the
+    index of its search tool. Nothing is created if the latest version already searches
+    the index or does not use Azure AI Search.
+
+    :param project_client: The project client.
+    :param agent_name: The name of the agent.
+    :param index_name: The name of the index to search.
+    :return: The new version of the agent or None if it was not needed.
+    """
+    agent_obj = (await project_client.agents.get(agent_name)).versions.latest
+    if get_search_index_name(agent_obj) in (None, index_name):
+        return None
+    new_agent = await copy_agent(project_client, agent_obj, index_name)
+    logger.info(f"Agent {new_agent.id} searches {index_name}.")
+    return new_agent
+
+
+async def get_pinned_index_names(project_client: AIProjectClient, agent_name: str) -> Set[str]:
+    """
+    Get the names of the indexes, searched by any version of the agent.
+
+    The running application keeps using the version of the agent, it has started with,
+    so the index of every version, which was not deleted, may still be queried.
+
+    :param project_client: The project client.
+    :param agent_name: The name of the agent.
+    :return: The names of the indexes.
+    """
+    pinned = set()
+    async for agent_obj in project_client.agents.list_versions(agent_name):
+        index_name = get_search_index_name(agent_obj)
+        if index_name:
+            pinned.add(index_name)
+    return pinned
@@ -0,0 +1,291 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from .index_files import get_version_directory, write_directory
+from .local_search_index import normalize, read_embeddings, recall_at_k, sample_queries
+
+logger = logging.getLogger("azureaiapp")
+
+
+@dataclass
+class IvfAlgorithmConfiguration:
+    """
+    The parameters of the inverted file index, the local counterpart of HnswAlgorithmConfiguration.
+
+    The vectors are clustered with k-means and each query scans only the clusters
+    with the closest centroids.
+
+    :param nlist: The number of clusters. If not set, the square root of the number of vectors.
+    :param nprobe: The number of clusters scanned by each query; the larger
+                   value gives the better recall at the cost of latency.
+    :param train_iterations: The number of k-means iterations.
+    :param train_sample: The maximal number of vectors per cluster used for training.
+    :param seed: The seed of the random generator, used for training.
+    """
+    nlist: Optional[int] = None
+    nprobe: int = 8
+    train_iterations: int = 20
+    train_sample: int = 256
+    seed: int = 0
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """Get the closest centroid of each vector."""
+    labels = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], chunk_size):
+        labels[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return labels
+
+
+def _train_centroids(vectors: np.ndarray, config: IvfAlgorithmConfiguration, nlist: int) -> np.ndarray:
+    """
+    Cluster the normalized vectors with spherical k-means.
+
+    :param vectors: The normalized vectors.
+    :param config: The index configuration.
+    :param nlist: The number of clusters.
+    :return: The normalized centroids.
+    """
+    rng = np.random.default_rng(config.seed)
+    sample_size = min(vectors.shape[0], nlist * config.train_sample)
+    sample = vectors[np.sort(rng.choice(vectors.shape[0], sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(config.train_iterations):
+        labels = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        # Restart the empty clusters from the random points.
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IvfIndex:
+    """
+    The approximate nearest neighbour index over the normalized vectors.
+
+    The vectors are stored grouped by cluster, so that every cluster is a contiguous
+    block of rows. The index is built once, saved to a directory of .npy files and
+    memory-mapped by every worker, so that the operating system shares its pages.
+    The index of every version of the embeddings file is saved to its own subdirectory.
+
+    :param centroids: The normalized centroids of the clusters.
+    :param vectors: The vectors, ordered by cluster.
+    :param ids: The row numbers of the vectors in the embeddings file.
+    :param offsets: The first row of each cluster; the last element is the number of vectors.
+    :param config: The index configuration.
+    """
+
+    _FILES = ('centroids', 'vectors', 'ids', 'offsets')
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            vectors: np.ndarray,
+            ids: np.ndarray,
+            offsets: np.ndarray,
+            config: IvfAlgorithmConfiguration
+        ) -> None:
+        """Constructor."""
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.config = config
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+    @staticmethod
+    def build(vectors: np.ndarray, config: Optional[IvfAlgorithmConfiguration] = None) -> "IvfIndex":
+        """
+        Build the index.
+
+        :param vectors: The normalized vectors, one per row.
+        :param config: The index configuration.
+        :return: The new index.
+        """
+        config = config or IvfAlgorithmConfiguration()
+        nlist = min(config.nlist or max(1, int(round(np.sqrt(vectors.shape[0])))), vectors.shape[0])
+        centroids = _train_centroids(vectors, config, nlist)
+        labels = _assign(vectors, centroids)
+        ids = np.argsort(labels, kind='stable').astype(np.int32)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+        return IvfIndex(centroids, np.ascontiguousarray(vectors[ids]), ids, offsets,
+                        IvfAlgorithmConfiguration(**{**asdict(config), 'nlist': nlist}))
+
+    def save(self, directory: str, source_sha256: Optional[str] = None) -> None:
+        """
+        Save the index atomically.
+
+        :param directory: The directory to store the index in; if it exists, it is kept.
+        :param source_sha256: The hash of the embeddings file, the index was built from.
+        """
+        def write(tmp_directory: str) -> None:
+            for name in IvfIndex._FILES:
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), getattr(self, name))
+            with open(os.path.join(tmp_directory, 'config.json'), 'w') as fp:
+                json.dump({'config': asdict(self.config), 'source_sha256': source_sha256}, fp)
+
+        write_directory(directory, write)
+
+    @staticmethod
+    def load(directory: str, mmap: bool = True) -> Tuple["IvfIndex", Optional[str]]:
+        """
+        Load the index.
+
+        :param directory: The directory with the saved index.
+        :param mmap: Memory-map the arrays instead of reading them.
+        :return: The tuple of the index and the hash of the embeddings file it was built from.
+        """
+        with open(os.path.join(directory, 'config.json')) as fp:
+            saved = json.load(fp)
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+            for name in IvfIndex._FILES}
+        return IvfIndex(config=IvfAlgorithmConfiguration(**saved['config']), **arrays), saved.get('source_sha256')
+
+    @staticmethod
+    def load_or_build(
+            directory: str,
+            embeddings_file: str,
+            config: Optional[IvfAlgorithmConfiguration] = None
+            ) -> "IvfIndex":
+        """
+        Load the index, built from the embeddings file, or build and save it.
+
+        The index is rebuilt if the embeddings file has changed.
+
+        :param directory: The directory with the saved versions of the index.
+        :param embeddings_file: The embeddings file.
+        :param config: The configuration of the index to build.
+        :return: The index.
+        """
+        version_directory, source_sha256 = get_version_directory(directory, embeddings_file)
+        if not os.path.isdir(version_directory):
+            start = time.perf_counter()
+            vectors, _, _ = read_embeddings(embeddings_file)
+            index = IvfIndex.build(normalize(vectors), config)
+            index.save(version_directory, source_sha256)
+            logger.info(
+                f"Built the index of {len(index)} vectors with {index.config.nlist} clusters "
+                f"in {time.perf_counter() - start:.2f}s, saved to {version_directory}")
+        index = IvfIndex.load(version_directory)[0]
+        if config is not None:
+            index.config.nprobe = config.nprobe
+        return index
+
+    def search_vectors(
+            self,
+            queries: np.ndarray,
+            k: int,
+            nprobe: Optional[int] = None
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the approximate nearest documents for the batch of query vectors.
+
+        :param queries: The query vectors, one per row, or the single vector.
+        :param k: The number of documents per query.
+        :param nprobe: The number of clusters to scan, overrides the configured one.
+        :return: The tuple of the row numbers in the embeddings file and cosine similarities,
+                 both of shape (queries, k), sorted by descending similarity. If the scanned
+                 clusters contain less than k vectors, the row numbers are padded with -1.
+        """
+        queries = normalize(queries)
+        nlist = self.centroids.shape[0]
+        nprobe = min(nprobe or self.config.nprobe, nlist)
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        result_ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        result_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i, clusters in enumerate(probes):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters])
+            if rows.size == 0:
+                continue
+            scores = self.vectors[rows] @ queries[i]
+            kk = min(k, rows.size)
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            top = top[np.argsort(-scores[top])]
+            result_ids[i, :kk] = self.ids[rows[top]]
+            result_scores[i, :kk] = scores[top]
+        return result_ids, result_scores
+
+
+def benchmark(
+        embeddings_file: str,
+        config: Optional[IvfAlgorithmConfiguration] = None,
+        k: int = 5,
+        nprobes: Sequence[int] = (1, 2, 4, 8, 16),
+        num_queries: int = 200,
+        noise: float = 0.5,
+        seed: int = 0
+        ) -> List[Dict[str, float]]:
+    """
+    Measure the recall@k and latency of the index against the exact search.
+
+    The queries are the corpus vectors with the gaussian noise, see sample_queries.
+
+    :param embeddings_file: The embeddings file.
+    :param config: The configuration of the index to build.
+    :param k: The number of documents per query.
+    :param nprobes: The numbers of the scanned clusters to evaluate.
+    :param num_queries: The number of queries.
+    :param noise: The standard deviation of the noise relative to the vector component scale.
+    :param seed: The seed of the random generator.
+    :return: One row per nprobe value with recall@k and the latency in microseconds per query.
+    """
+    vectors = normalize(read_embeddings(embeddings_file)[0])
+    index = IvfIndex.build(vectors, config)
+    queries = sample_queries(vectors, num_queries, noise, seed)
+
+    start = time.perf_counter()
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+    exact_us = (time.perf_counter() - start) / len(queries) * 1e6
+    rows = [{'nprobe': 0, 'recall': 1.0, 'latency_us': exact_us}]
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        ids, _ = index.search_vectors(queries, k, nprobe=nprobe)
+        latency_us = (time.perf_counter() - start) / len(queries) * 1e6
+        rows.append({'nprobe': nprobe, 'recall': recall_at_k(ids, exact, k), 'latency_us': latency_us})
+    return rows
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to build and benchmark the index."""
+    parser = argparse.ArgumentParser(description="Build or benchmark the local IVF index over the embeddings file.")
+    parser.add_argument('command', choices=['build', 'benchmark'])
+    parser.add_argument('embeddings_file')
+    parser.add_argument('--output', help="The directory to save the index to (build only).")
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    config = IvfAlgorithmConfiguration(nlist=args.nlist, nprobe=args.nprobe)
+    if args.command == 'build':
+        output = args.output or os.path.splitext(args.embeddings_file)[0] + '.ivf'
+        index = IvfIndex.load_or_build(output, args.embeddings_file, config)
+        print(f"Index with {len(index)} vectors and {index.config.nlist} clusters is saved to {output}")
+    else:
+        print(f"{'nprobe':>8} {'recall@' + str(args.k):>10} {'us/query':>10}")
+        for row in benchmark(args.embeddings_file, config, k=args.k):
+            nprobe = 'exact' if row['nprobe'] == 0 else row['nprobe']
+            print(f"{nprobe:>8} {row['recall']:>10.3f} {row['latency_us']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import asyncio
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+
+from .search_results import get_shingles, join_titles
+
+DEFAULT_PATTERNS = ('**/*.md', '**/*.json')
+MIN_DIFF_CHARACTERS_IN_LINE = 5
+MIN_LINE_LENGTH = 5
+
+# The sentence tokenizer, loaded once per process.
+_sent_tokenize: Optional[Callable[[str], List[str]]] = None
+
+
+def _get_sent_tokenize() -> Callable[[str], List[str]]:
+    """
+    Get the nltk sentence tokenizer.
+
+    We do lazy loading of nltk, because it is only used during rag generation and is not
+    included into requirements. The punkt model is downloaded only if it is not found in
+    the nltk data directories, so it is cached locally after the first run.
+    """
+    global _sent_tokenize
+    if _sent_tokenize is None:
+        import nltk
+        from nltk.tokenize import sent_tokenize
+        try:
+            sent_tokenize("Load the model.")
+        except LookupError:
+            # The recent nltk versions need punkt_tab, the older ones punkt.
+            for resource in ('punkt_tab', 'punkt'):
+                nltk.download(resource, quiet=True)
+        _sent_tokenize = sent_tokenize
+    return _sent_tokenize
+
+
+def _iter_json_lines(value: Any, path: str = '') -> Iterator[str]:
+    """Flatten the JSON document to the lines of the form 'path: value'."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _iter_json_lines(item, f"{path}.{key}" if path else str(key))
+    elif isinstance(value, list):
+        for item in value:
+            yield from _iter_json_lines(item, path)
+    elif value is not None:
+        yield f"{path}: {value}" if path else str(value)
+
+
+def read_lines(file_path: str) -> List[str]:
+    """
+    Read the text lines of the markdown or JSON file.
+
+    :param file_path: The path to the file.
+    :return: The lines; the JSON documents are flattened to one line per value.
+    """
+    with open(file_path, encoding='utf-8') as fp:
+        if file_path.endswith('.json'):
+            return list(_iter_json_lines(json.load(fp)))
+        return fp.readlines()
+
+
+def chunk_file(file_path: str, sentences_per_embedding: int) -> List[Tuple[str, str]]:
+    """
+    Split the file to the chunks of several sentences.
+
+    :param file_path: The path to the file.
+    :param sentences_per_embedding: The number of sentences in the chunk.
+    :return: The list of the tuples of the chunk text and the name of the file.
+    """
+    sent_tokenize = _get_sent_tokenize()
+    reference = os.path.split(file_path)[-1]
+    chunks: List[Tuple[str, str]] = []
+    index = 0
+    for line in read_lines(file_path):
+        line = line.strip()
+        # Skip non informative lines.
+        if len(line) < MIN_LINE_LENGTH or len(set(line)) < MIN_DIFF_CHARACTERS_IN_LINE:
+            continue
+        for sentence in sent_tokenize(line):
+            if index % sentences_per_embedding == 0:
+                chunks.append((sentence, reference))
+            else:
+                chunks[-1] = (f"{chunks[-1][0]} {sentence}", reference)
+            index += 1
+    return chunks
+
+
+def find_files(input_directory: str, patterns: Sequence[str] = DEFAULT_PATTERNS) -> List[str]:
+    """
+    Find the files to chunk.
+
+    :param input_directory: The directory with the files.
+    :param patterns: The recursive glob patterns relative to the directory.
+    :return: The sorted paths of the files.
+    """
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(os.path.join(input_directory, pattern), recursive=True))
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+async def iter_chunks(
+        input_directory: str,
+        sentences_per_embedding: int,
+        patterns: Sequence[str] = DEFAULT_PATTERNS,
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None
+        ) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Chunk the files on the process pool and stream the chunks in the order of the files.
+
+    The files are sent to the pool as the chunks are consumed, so at most max_pending
+    files are chunked ahead of the embedding stage.
+
+    :param input_directory: The directory with the files.
+    :param sentences_per_embedding: The number of sentences in the chunk.
+    :param patterns: The recursive glob patterns relative to the directory.
+    :param max_workers: The number of processes, the number of CPUs by default.
+    :param max_pending: The maximal number of files chunked ahead, twice the number of processes by default.
+    :return: The asynchronous iterator over the tuples of the chunk text and the name of the file.
+    """
+    files = iter(find_files(input_directory, patterns))
+    # Download the tokenizer model once, before the workers load it.
+    _get_sent_tokenize()
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * max_workers
+    loop = asyncio.get_running_loop()
+    pending: Deque[asyncio.Future] = deque()
+    executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_get_sent_tokenize)
+    try:
+        while True:
+            for file_path in files:
+                pending.append(loop.run_in_executor(executor, chunk_file, file_path, sentences_per_embedding))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            for chunk in await pending.popleft():
+                yield chunk
+    finally:
+        for future in pending:
+            future.cancel()
+        # Waiting for the workers would block the event loop when the consumer stops early.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class MinHashDeduplicator:
+    """
+    The detector of the near-duplicate chunks with MinHash and locality-sensitive hashing.
+
+    The signature of every chunk is the minimum of num_perm random hash functions over
+    its word trigrams. The signatures are split into bands; the chunks sharing any band
+    are the candidates, and a candidate is the duplicate if the Jaccard similarity of its
+    trigrams to the earlier chunk is at least the threshold.
+
+    :param threshold: The minimal Jaccard similarity of the near-duplicate chunks.
+    :param num_perm: The number of hash functions.
+    :param bands: The number of bands; the more bands, the more candidates are checked.
+    :param seed: The seed of the random hash functions.
+    """
+
+    # The Mersenne prime, the modulus of the hash functions.
+    _PRIME = (1 << 31) - 1
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, seed: int = 0) -> None:
+        """Constructor."""
+        if num_perm % bands:
+            raise ValueError("The number of hash functions must be divisible by the number of bands.")
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MinHashDeduplicator._PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, MinHashDeduplicator._PRIME, num_perm, dtype=np.uint64)
+        self._threshold = threshold
+        self._bands = bands
+        self._rows = num_perm // bands
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._shingles: List[Set[str]] = []
+
+    def _signature(self, shingles: Set[str]) -> np.ndarray:
+        """Get the MinHash signature of the set of trigrams."""
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles))
+        values = (hashes[:, None] % MinHashDeduplicator._PRIME * self._a + self._b) % MinHashDeduplicator._PRIME
+        return values.min(axis=0)
+
+    def find(self, text: str) -> Optional[int]:
+        """
+        Find the earlier near-duplicate of the text or remember the text.
+
+        :param text: The chunk text.
+        :return: The number of the earlier chunk, the text duplicates, or None if the text is new.
+        """
+        shingles = get_shingles(text)
+        signature = self._signature(shingles)
+        keys = [(band, signature[band * self._rows:(band + 1) * self._rows].tobytes()) for band in range(self._bands)]
+        candidates = {number for key in keys for number in self._buckets.get(key, ())}
+        for number in sorted(candidates):
+            other = self._shingles[number]
+            if len(shingles & other) / len(shingles | other) >= self._threshold:
+                return number
+        number = len(self._shingles)
+        self._shingles.append(shingles)
+        for key in keys:
+            self._buckets.setdefault(key, []).append(number)
+        return None
+
+
+async def deduplicate_chunks(
+        chunks: AsyncIterator[Tuple[str, str]],
+        threshold: float = 0.8,
+        stats: Optional[Dict[str, int]] = None
+        ) -> AsyncIterator[Tuple[str, str]]:
+    """
+    Drop the near-duplicates of the earlier chunks.
+
+    The titles of the dropped chunks are joined to the title of the kept one, so the
+    answers, grounded on it, cite every file it was found in. A kept chunk may be
+    duplicated by any later one, so the unique chunks are yielded only after all the
+    chunks were read; the texts, titles and word trigram sets of the unique chunks
+    are held in memory until then.
+
+    :param chunks: The tuples of the chunk text and the name of its file.
+    :param threshold: The minimal Jaccard similarity of the word trigrams of the near-duplicates.
+    :param stats: The dictionary to store the numbers of the 'chunks' read and 'unique' chunks yielded,
+                  updated as the chunks are read.
+    :return: The asynchronous iterator over the unique chunks in the order of their occurrence,
+             titled with the files of their duplicates too.
+    """
+    deduplicator = MinHashDeduplicator(threshold)
+    stats = stats if stats is not None else {}
+    stats.update(chunks=0, unique=0)
+    unique: List[Tuple[str, List[str]]] = []
+    async for token, title in chunks:
+        stats['chunks'] += 1
+        number = deduplicator.find(token)
+        if number is None:
+            stats['unique'] += 1
+            unique.append((token, [title]))
+        else:
+            unique[number][1].append(title)
+    for token, titles in unique:
+        yield token, join_titles(titles)
@@ -0,0 +1,252 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncio
+import glob
+import json
+import logging
+import os
+
+from util import file_sha256
+
+if TYPE_CHECKING:
+    from azure.ai.projects.models import AgentVersionObject, FunctionTool
+
+logger = logging.getLogger("azureaiapp")
+
+FUNCTION_NAME = 'lookup_customer'
+DEFAULT_PATTERN = 'customer_info_*.json'
+DEFAULT_INPUT_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'files')
+DEFAULT_STORE_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'customer_store.json')
+
+# The long product descriptions are found by the search, the store keeps only the order facts.
+_DROPPED_ORDER_FIELDS = ('description',)
+
+FUNCTION_PARAMETERS = {
+    'type': 'object',
+    'properties': {
+        'customer_id': {'type': 'string', 'description': "The customer id, for example '7'."},
+        'email': {'type': 'string', 'description': "The customer e-mail address."},
+        'order_id': {'type': 'string', 'description': "The order number, for example '29'."},
+    },
+    'additionalProperties': False,
+}
+
+
+def _normalize_key(kind: str, value: Any) -> str:
+    """Get the lookup key of the value; the e-mails are case insensitive and the numbers ignore the leading zeros."""
+    value = str(value).strip().lower()
+    if kind != 'email' and value.isdigit():
+        value = str(int(value))
+    return f"{kind}:{value}"
+
+
+class CustomerStore:
+    """
+    The records of the customer_info JSON files with the exact lookup by their keys.
+
+    Every record is indexed by the customer id, the e-mail and the ids of its orders,
+    so that the structured questions are answered without the search. The store is
+    saved to a JSON file together with the hashes of the source files and is rebuilt
+    when any of them changes.
+
+    :param records: The customer records.
+    :param keys: The record numbers by the lookup key.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]], keys: Dict[str, List[int]]) -> None:
+        """Constructor."""
+        self.records = records
+        self.keys = keys
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @staticmethod
+    def build(file_paths: Sequence[str]) -> "CustomerStore":
+        """
+        Build the store.
+
+        :param file_paths: The customer_info JSON files, one customer per file.
+        :return: The new store.
+        """
+        records: List[Dict[str, Any]] = []
+        keys: Dict[str, List[int]] = {}
+        for file_path in file_paths:
+            with open(file_path, encoding='utf-8') as fp:
+                record = json.load(fp)
+            record['orders'] = [
+                {name: value for name, value in order.items() if name not in _DROPPED_ORDER_FIELDS}
+                for order in record.get('orders', [])]
+            number = len(records)
+            records.append(record)
+            record_keys = [_normalize_key('customer', record['id'])]
+            if record.get('email'):
+                record_keys.append(_normalize_key('email', record['email']))
+            record_keys.extend(_normalize_key('order', order['id']) for order in record['orders'])
+            for key in record_keys:
+                keys.setdefault(key, []).append(number)
+        return CustomerStore(records, keys)
+
+    @staticmethod
+    def _get_sources(input_directory: str, pattern: str) -> Dict[str, str]:
+        """Get the hashes of the source files by their names."""
+        return {
+            os.path.basename(path): file_sha256(path)
+            for path in sorted(glob.glob(os.path.join(input_directory, pattern)))}
+
+    def save(self, store_file: str, sources: Optional[Dict[str, str]] = None) -> None:
+        """
+        Save the store atomically.
+
+        :param store_file: The JSON file.
+        :param sources: The hashes of the source files by their names.
+        """
+        tmp_file = f"{store_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as fp:
+            json.dump({'sources': sources, 'records': self.records, 'keys': self.keys}, fp, separators=(',', ':'))
+        os.replace(tmp_file, store_file)
+
+    @staticmethod
+    def load_or_build(
+            store_file: str = DEFAULT_STORE_FILE,
+            input_directory: str = DEFAULT_INPUT_DIRECTORY,
+            pattern: str = DEFAULT_PATTERN
+            ) -> "CustomerStore":
+        """
+        Load the store, built from the current customer files, or build and save it.
+
+        :param store_file: The JSON file of the store.
+        :param input_directory: The directory with the customer files.
+        :param pattern: The glob pattern of the customer files.
+        :return: The store.
+        """
+        sources = CustomerStore._get_sources(input_directory, pattern)
+        if os.path.exists(store_file):
+            with open(store_file, encoding='utf-8') as fp:
+                saved = json.load(fp)
+            if saved.get('sources') == sources:
+                return CustomerStore(saved['records'], saved['keys'])
+            logger.info(f"The customer files have changed, rebuilding {store_file}")
+        store = CustomerStore.build([os.path.join(input_directory, name) for name in sources])
+        os.makedirs(os.path.dirname(os.path.abspath(store_file)), exist_ok=True)
+        store.save(store_file, sources)
+        logger.info(f"Indexed {len(store)} customers with {len(store.keys)} keys in {store_file}")
+        return store
+
+    def lookup(
+            self,
+            customer_id: Optional[str] = None,
+            email: Optional[str] = None,
+            order_id: Optional[str] = None
+            ) -> List[Dict[str, Any]]:
+        """
+        Find the customers matching all the given keys.
+
+        :param customer_id: The customer id.
+        :param email: The customer e-mail.
+        :param order_id: The order id; the found customer is returned with this order only.
+        :return: The matching records.
+        """
+        given = [(kind, value) for kind, value in (
+            ('customer', customer_id), ('email', email), ('order', order_id)) if value not in (None, '')]
+        if not given:
+            return []
+        numbers = None
+        for kind, value in given:
+            found = set(self.keys.get(_normalize_key(kind, value), ()))
+            numbers = found if numbers is None else numbers & found
+        records = [self.records[number] for number in sorted(numbers)]
+        if order_id not in (None, ''):
+            order_key = _normalize_key('order', order_id)
+            records = [
+                {**record, 'orders': [o for o in record['orders'] if _normalize_key('order', o['id']) == order_key]}
+                for record in records]
+        return records
+
+
+def get_function_tool() -> "FunctionTool":
+    """Get the definition of the lookup function for the agent."""
+    from azure.ai.projects.models import FunctionTool
+    return FunctionTool(
+        name=FUNCTION_NAME,
+        description=(
+            "Look up the customer record with the contact details, membership and orders "
+            "by the exact customer id, e-mail or order id."),
+        parameters=FUNCTION_PARAMETERS,
+        strict=False)
+
+
+def has_function_tool(agent_obj: "AgentVersionObject") -> bool:
+    """
+    Check that the agent has the lookup function.
+
+    :param agent_obj: The agent.
+    :return: True if the agent was created with the tool of get_function_tool.
+    """
+    from azure.ai.projects.models import FunctionTool
+    return any(
+        isinstance(tool, FunctionTool) and tool.name == FUNCTION_NAME
+        for tool in getattr(agent_obj.definition, 'tools', None) or [])
+
+
+_store: Optional[CustomerStore] = None
+_store_stats: Optional[Dict[str, Tuple[int, int]]] = None
+
+
+def _get_file_stats(input_directory: str, pattern: str) -> Dict[str, Tuple[int, int]]:
+    """Get the modification times and the sizes of the customer files by their paths."""
+    stats = {}
+    for path in sorted(glob.glob(os.path.join(input_directory, pattern))):
+        stat = os.stat(path)
+        stats[path] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+def get_store(
+        store_file: str = DEFAULT_STORE_FILE,
+        input_directory: str = DEFAULT_INPUT_DIRECTORY,
+        pattern: str = DEFAULT_PATTERN
+        ) -> CustomerStore:
+    """
+    Get the store of the process.
+
+    The store is loaded once and reloaded when a customer file is added, removed or
+    modified. It reads the files, so call it with asyncio.to_thread from the event loop.
+
+    :param store_file: The JSON file of the store.
+    :param input_directory: The directory with the customer files.
+    :param pattern: The glob pattern of the customer files.
+    :return: The store.
+    """
+    global _store, _store_stats
+    stats = _get_file_stats(input_directory, pattern)
+    if _store is None or stats != _store_stats:
+        _store = CustomerStore.load_or_build(store_file, input_directory, pattern)
+        _store_stats = stats
+    return _store
+
+
+async def call_function(name: str, arguments: str) -> str:
+    """
+    Run the function, called by the agent.
+
+    The store is loaded in the thread, so the event loop is not blocked by the file reads.
+
+    :param name: The name of the function.
+    :param arguments: The JSON object of the arguments.
+    :return: The JSON output for the agent.
+    """
+    if name != FUNCTION_NAME:
+        return json.dumps({'error': f"Unknown function {name}."})
+    store = await asyncio.to_thread(get_store)
+    try:
+        kwargs = json.loads(arguments or '{}')
+        customers = store.lookup(**{key: kwargs.get(key) for key in FUNCTION_PARAMETERS['properties']})
+    except (ValueError, TypeError, AttributeError) as e:
+        return json.dumps({'error': f"Invalid arguments: {e}"})
+    if not customers:
+        return json.dumps({'customers': [], 'error': "No customer matches the given keys."})
+    return json.dumps({'customers': customers})
@@ -0,0 +1,234 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Dict, List, Optional, Sequence
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+from .embeddings_store import get_metadata_file
+from .local_search_index import normalize, read_embeddings, recall_at_k, sample_queries
+
+REDUCTION_METHODS = ('truncate', 'pca')
+PROJECTION_SUFFIX = '.projection.npz'
+
+
+def get_projection_file(vectors_file: str) -> str:
+    """Get the path to the projection matrix of the reduced embeddings."""
+    return os.path.splitext(vectors_file)[0] + PROJECTION_SUFFIX
+
+
+class Projection:
+    """
+    The linear projection of the embeddings to the smaller number of dimensions.
+
+    The truncation keeps the first dimensions; the models trained to support the
+    dimensions parameter, like text-embedding-3, return the same vectors, so the truncated
+    embeddings can be searched with the query embeddings of that many dimensions.
+    The PCA projection keeps the directions of the largest variance of the corpus; it
+    usually preserves more of the ranking, but the queries must be projected with the
+    same matrix, which is possible only for the local search.
+    The projected vectors are normalized.
+
+    :param method: The reduction method, truncate or pca.
+    :param components: The projection matrix of shape (dimensions, reduced dimensions).
+    :param mean: The mean of the normalized corpus vectors, subtracted before the projection.
+    """
+
+    def __init__(self, method: str, components: np.ndarray, mean: np.ndarray) -> None:
+        """Constructor."""
+        self.method = method
+        self.components = components
+        self.mean = mean
+
+    @property
+    def dimensions(self) -> int:
+        """The number of the reduced dimensions."""
+        return self.components.shape[1]
+
+    @staticmethod
+    def fit(
+            vectors: np.ndarray,
+            dimensions: int,
+            method: str = 'pca',
+            sample_size: int = 100000,
+            seed: int = 0
+            ) -> "Projection":
+        """
+        Fit the projection to the corpus.
+
+        :param vectors: The corpus vectors, one per row.
+        :param dimensions: The number of the reduced dimensions.
+        :param method: The reduction method, truncate or pca.
+        :param sample_size: The maximal number of vectors used to fit PCA.
+        :param seed: The seed of the random generator, used to sample the vectors.
+        :return: The projection.
+        :raises: ValueError if the method is unknown or there are more dimensions than the
+                 vectors have, or, for PCA, than the number of the fitted vectors.
+        """
+        if method not in REDUCTION_METHODS:
+            raise ValueError(f"Unknown reduction method {method}, expected one of {', '.join(REDUCTION_METHODS)}.")
+        if not 0 < dimensions <= vectors.shape[1]:
+            raise ValueError(f"The number of dimensions must be between 1 and {vectors.shape[1]}.")
+        if method == 'truncate':
+            return Projection(
+                method,
+                np.eye(vectors.shape[1], dimensions, dtype=np.float32),
+                np.zeros(vectors.shape[1], dtype=np.float32))
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(vectors.shape[0], min(sample_size, vectors.shape[0]), replace=False))
+        if dimensions > min(len(rows), vectors.shape[1]):
+            # There are no more principal components than the fitted vectors.
+            raise ValueError(
+                f"PCA of {len(rows)} vectors has at most {min(len(rows), vectors.shape[1])} dimensions, "
+                f"{dimensions} requested.")
+        sample = normalize(vectors[rows]).astype(np.float64)
+        mean = sample.mean(axis=0)
+        _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        return Projection(method, vt[:dimensions].T.astype(np.float32), mean.astype(np.float32))
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Project the vectors.
+
+        :param vectors: The vectors, one per row, or the single vector.
+        :return: The normalized projected vectors.
+        """
+        return normalize((normalize(vectors) - self.mean) @ self.components)
+
+    def save(self, projection_file: str) -> None:
+        """Save the projection matrix."""
+        np.savez(projection_file, method=self.method, components=self.components, mean=self.mean)
+
+    @staticmethod
+    def load(projection_file: str) -> "Projection":
+        """Load the projection matrix."""
+        with np.load(projection_file) as saved:
+            return Projection(str(saved['method']), saved['components'], saved['mean'])
+
+
+def reduce_embeddings(
+        embeddings_file: str,
+        vectors_file: str,
+        dimensions: int,
+        method: str = 'pca',
+        chunk_size: int = 65536
+        ) -> Projection:
+    """
+    Write the reduced embeddings in the binary format together with the projection matrix.
+
+    :param embeddings_file: The CSV or .npy embeddings file.
+    :param vectors_file: The output .npy file; the metadata table and the projection
+                         matrix are saved next to it.
+    :param dimensions: The number of the reduced dimensions.
+    :param method: The reduction method, truncate or pca.
+    :param chunk_size: The number of rows projected at once.
+    :return: The projection.
+    :raises: ValueError if the projection cannot have that many dimensions; nothing is written.
+    """
+    vectors, tokens, titles = read_embeddings(embeddings_file)
+    projection = Projection.fit(vectors, dimensions, method)
+    tmp_vectors = vectors_file + '.tmp.npy'
+    try:
+        reduced = np.lib.format.open_memmap(
+            tmp_vectors, mode='w+', dtype=np.float32, shape=(vectors.shape[0], projection.dimensions))
+        for start in range(0, vectors.shape[0], chunk_size):
+            reduced[start:start + chunk_size] = projection.apply(vectors[start:start + chunk_size])
+        reduced.flush()
+        del reduced
+        with open(get_metadata_file(vectors_file), 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'title'])
+            writer.writeheader()
+            writer.writerows({'token': token, 'title': title} for token, title in zip(tokens, titles))
+        projection.save(get_projection_file(vectors_file))
+        os.replace(tmp_vectors, vectors_file)
+    finally:
+        if os.path.exists(tmp_vectors):
+            os.remove(tmp_vectors)
+    return projection
+
+
+def evaluate(
+        embeddings_file: str,
+        dimensions: Sequence[int],
+        methods: Sequence[str] = REDUCTION_METHODS,
+        k: int = 5,
+        num_queries: int = 200,
+        noise: float = 0.5,
+        seed: int = 0
+        ) -> List[Dict[str, float]]:
+    """
+    Measure the recall@k and latency of the reduced embeddings against the full-dimension search.
+
+    The queries are the corpus vectors with the gaussian noise, see sample_queries.
+
+    :param embeddings_file: The embeddings file.
+    :param dimensions: The numbers of the reduced dimensions to evaluate.
+    :param methods: The reduction methods to evaluate.
+    :param k: The number of documents per query.
+    :param num_queries: The number of queries.
+    :param noise: The standard deviation of the noise relative to the vector component scale.
+    :param seed: The seed of the random generator.
+    :return: One row per method and number of dimensions (the first row is the full-dimension
+             search) with recall@k, the latency in microseconds per query and the size of the vectors.
+    """
+    vectors = normalize(read_embeddings(embeddings_file)[0])
+    queries = sample_queries(vectors, num_queries, noise, seed)
+
+    def search(corpus: np.ndarray, query_vectors: np.ndarray):
+        start = time.perf_counter()
+        found = np.array([np.argsort(-(corpus @ query))[:k] for query in query_vectors])
+        return found, (time.perf_counter() - start) / len(query_vectors) * 1e6
+
+    exact, exact_us = search(vectors, queries)
+    rows = [{'method': 'full', 'dimensions': vectors.shape[1], 'recall': 1.0,
+             'latency_us': exact_us, 'memory_bytes': vectors.nbytes}]
+    for method in methods:
+        for target in dimensions:
+            projection = Projection.fit(vectors, target, method, seed=seed)
+            reduced = projection.apply(vectors)
+            found, latency_us = search(reduced, projection.apply(queries))
+            rows.append({'method': method, 'dimensions': projection.dimensions, 'recall': recall_at_k(found, exact, k),
+                         'latency_us': latency_us, 'memory_bytes': reduced.nbytes})
+    return rows
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to evaluate and write the reduced embeddings."""
+    parser = argparse.ArgumentParser(description="Evaluate or write the embeddings with the reduced dimensions.")
+    parser.add_argument('command', choices=['evaluate', 'reduce'])
+    parser.add_argument('embeddings_file')
+    parser.add_argument('--dimensions', type=int, nargs='+', required=True)
+    parser.add_argument('--method', choices=REDUCTION_METHODS, default=None,
+                        help="The reduction method; evaluate compares all of them by default.")
+    parser.add_argument('--output', help="The .npy file to write (reduce only).")
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.command == 'reduce':
+        method = args.method or 'pca'
+        output = args.output or f"{os.path.splitext(args.embeddings_file)[0]}.{method}{args.dimensions[0]}.npy"
+        try:
+            projection = reduce_embeddings(args.embeddings_file, output, args.dimensions[0], method)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Embeddings reduced to {projection.dimensions} dimensions with {method} are saved to {output}, "
+              f"the projection matrix to {get_projection_file(output)}")
+    else:
+        methods = [args.method] if args.method else REDUCTION_METHODS
+        try:
+            rows = evaluate(args.embeddings_file, args.dimensions, methods, k=args.k)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"{'method':>8} {'dims':>6} {'recall@' + str(args.k):>10} {'us/query':>10} {'memory':>10}")
+        for row in rows:
+            print(f"{row['method']:>8} {row['dimensions']:>6} {row['recall']:>10.3f} "
+                  f"{row['latency_us']:>10.1f} {row['memory_bytes']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+# The binary embeddings are stored as the float32 .npy matrix, one row per document,
+# and the CSV table with the token and title of every row next to it.
+VECTORS_EXTENSION = '.npy'
+METADATA_SUFFIX = '.meta.csv'
+CACHE_SUFFIX = '.embedding_cache.csv'
+
+logger = logging.getLogger("azureaiapp")
+
+
+def is_binary_embeddings(embeddings_file: str) -> bool:
+    """Return True if the embeddings file is the binary matrix rather than the CSV file."""
+    return embeddings_file.endswith(VECTORS_EXTENSION)
+
+
+def get_metadata_file(vectors_file: str) -> str:
+    """Get the path to the metadata table of the binary embeddings."""
+    return os.path.splitext(vectors_file)[0] + METADATA_SUFFIX
+
+
+def convert_csv(embeddings_file: str, vectors_file: Optional[str] = None) -> str:
+    """
+    Convert the CSV embeddings file, generated by build_embeddings_file, to the binary format.
+
+    The rows are streamed: the vectors are written directly into the memory-mapped
+    output, so that the whole file is never held in memory.
+
+    :param embeddings_file: The CSV embeddings file.
+    :param vectors_file: The output .npy file. By default, the CSV file name with .npy extension.
+    :return: The path to the vectors file; the metadata table is stored next to it.
+    """
+    vectors_file = vectors_file or os.path.splitext(embeddings_file)[0] + VECTORS_EXTENSION
+    metadata_file = get_metadata_file(vectors_file)
+    # The first pass gets the shape of the matrix without parsing the vectors.
+    count = 0
+    dimensions = 0
+    with open(embeddings_file, newline='') as fp:
+        for row in csv.DictReader(fp):
+            if count == 0:
+                dimensions = len(json.loads(row['embedding']))
+            count += 1
+
+    tmp_vectors = vectors_file + '.tmp.npy'
+    tmp_metadata = metadata_file + '.tmp'
+    vectors = np.lib.format.open_memmap(tmp_vectors, mode='w+', dtype=np.float32, shape=(count, dimensions))
+    with open(embeddings_file, newline='') as fp, open(tmp_metadata, 'w', newline='') as meta_fp:
+        writer = csv.DictWriter(meta_fp, fieldnames=['token', 'title'])
+        writer.writeheader()
+        for index, row in enumerate(csv.DictReader(fp)):
+            vectors[index] = json.loads(row['embedding'])
+            writer.writerow({'token': row['token'], 'title': row['title']})
+    vectors.flush()
+    del vectors
+    os.replace(tmp_metadata, metadata_file)
+    os.replace(tmp_vectors, vectors_file)
+    return vectors_file
+
+
+def open_vectors(vectors_file: str) -> np.ndarray:
+    """
+    Memory-map the binary embeddings without copying them.
+
+    :param vectors_file: The .npy file.
+    :return: The read-only float32 matrix, one row per document.
+    """
+    return np.load(vectors_file, mmap_mode='r')
+
+
+def read_metadata(vectors_file: str) -> Tuple[List[str], List[str]]:
+    """
+    Read the metadata table of the binary embeddings.
+
+    :param vectors_file: The .npy file.
+    :return: The tuple of the lists of the document texts and their titles.
+    """
+    tokens = []
+    titles = []
+    with open(get_metadata_file(vectors_file), newline='') as fp:
+        for row in csv.DictReader(fp):
+            tokens.append(row['token'])
+            titles.append(row['title'])
+    return tokens, titles
+
+
+def iter_embeddings(embeddings_file: str) -> Iterator[Tuple[str, str, Union[np.ndarray, List[float]]]]:
+    """
+    Stream the documents from the embeddings file of either format.
+
+    :param embeddings_file: The CSV or .npy embeddings file.
+    :return: The iterator over the tuples of the document text, title and vector.
+    """
+    if is_binary_embeddings(embeddings_file):
+        vectors = open_vectors(embeddings_file)
+        with open(get_metadata_file(embeddings_file), newline='') as fp:
+            for index, row in enumerate(csv.DictReader(fp)):
+                yield row['token'], row['title'], vectors[index]
+    else:
+        with open(embeddings_file, newline='') as fp:
+            for row in csv.DictReader(fp):
+                yield row['token'], row['title'], json.loads(row['embedding'])
+
+
+def count_embeddings(embeddings_file: str) -> int:
+    """Get the number of documents in the embeddings file of either format."""
+    if is_binary_embeddings(embeddings_file):
+        return open_vectors(embeddings_file).shape[0]
+    with open(embeddings_file, newline='') as fp:
+        return sum(1 for _ in csv.DictReader(fp))
+
+
+class EmbeddingCache:
+    """
+    The embeddings of the text chunks from the previous builds of the embeddings file.
+
+    The embeddings are keyed by the hash of the chunk text, the model and the number of
+    dimensions, so a rebuild embeds only the new or changed chunks. The cache is a CSV
+    file next to the embeddings file; the vectors are kept as the serialized JSON and
+    written to the embeddings file as is. On save, the entries not used by the build are dropped.
+
+    :param cache_file: The path to the cache file. If not set, the cache is neither loaded nor saved.
+    :param model: The embedding model.
+    :param dimensions: The number of dimensions in the embedding, if the model accepts it.
+    """
+
+    def __init__(self, cache_file: Optional[str], model: str, dimensions: Optional[int] = None) -> None:
+        """Constructor."""
+        self._cache_file = cache_file
+        self._prefix = f"{model}\0{dimensions}\0"
+        self._entries: Dict[str, str] = {}
+        self._used: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_file is None:
+            return
+        try:
+            with open(cache_file, newline='') as fp:
+                for row in csv.DictReader(fp):
+                    self._entries[row['key']] = row['embedding']
+        except (OSError, csv.Error, KeyError):
+            self._entries = {}
+
+    @staticmethod
+    def get_cache_file(output_file: str) -> str:
+        """Get the path to the cache of the embeddings file."""
+        return os.path.splitext(output_file)[0] + CACHE_SUFFIX
+
+    def get_key(self, text: str) -> str:
+        """Get the key of the text chunk."""
+        return hashlib.sha256((self._prefix + text).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the cached embedding.
+
+        :param key: The key of the text chunk.
+        :return: The embedding serialized as JSON or None if it is not cached.
+        """
+        embedding = self._entries.get(key)
+        if embedding is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._used[key] = embedding
+        return embedding
+
+    def put(self, key: str, embedding: str) -> None:
+        """
+        Cache the embedding.
+
+        :param key: The key of the text chunk.
+        :param embedding: The embedding serialized as JSON.
+        """
+        self._entries[key] = embedding
+        self._used[key] = embedding
+
+    @property
+    def reuse_ratio(self) -> float:
+        """The share of the chunks, found in the cache."""
+        return self.hits / max(1, self.hits + self.misses)
+
+    def save(self) -> None:
+        """Atomically replace the cache with the embeddings used by the build."""
+        if self._cache_file is None:
+            return
+        tmp_file = self._cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=['key', 'embedding'])
+                writer.writeheader()
+                writer.writerows({'key': key, 'embedding': embedding} for key, embedding in self._used.items())
+            os.replace(tmp_file, self._cache_file)
+        except OSError as e:
+            logger.warning(f"Unable to save the embedding cache {self._cache_file}: {e}")
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to convert the CSV embeddings file."""
+    parser = argparse.ArgumentParser(description="Convert the CSV embeddings file to the binary format.")
+    parser.add_argument('embeddings_file')
+    parser.add_argument('--output', help="The .npy file to write.")
+    args = parser.parse_args(argv)
+    vectors_file = convert_csv(args.embeddings_file, args.output)
+    vectors = open_vectors(vectors_file)
+    print(f"{vectors.shape[0]} vectors with {vectors.shape[1]} dimensions are saved to {vectors_file} "
+          f"({os.path.getsize(vectors_file)} bytes, was {os.path.getsize(args.embeddings_file)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Callable, Tuple
+
+import os
+import shutil
+import tempfile
+
+from util import file_sha256
+
+
+def get_version_directory(directory: str, source_file: str) -> Tuple[str, str]:
+    """
+    Get the directory of the index, built from the current contents of the source file.
+
+    Every version of the source file has its own subdirectory, so the index of the new
+    version is saved next to the previous one instead of replacing it, while the other
+    workers may still be loading it.
+
+    :param directory: The directory of the index.
+    :param source_file: The file, the index is built from.
+    :return: The tuple of the directory of the version and the hash of the source file.
+    """
+    source_sha256 = file_sha256(source_file)
+    return os.path.join(directory, source_sha256[:16]), source_sha256
+
+
+def write_directory(directory: str, write: Callable[[str], None]) -> bool:
+    """
+    Create the directory with the files atomically.
+
+    The files are written to the temporary directory next to it, which is then renamed.
+    The existing directory is never replaced or deleted.
+
+    :param directory: The directory to create.
+    :param write: The function, writing the files to the given directory.
+    :return: True if the directory was created, False if the other worker has created it first.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(prefix=f".{os.path.basename(directory)}.", suffix='.tmp', dir=parent)
+    try:
+        write(tmp_directory)
+        try:
+            os.rename(tmp_directory, directory)
+            return True
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+            return False
+    finally:
+        # Only the own temporary directory is removed, if it was not renamed.
+        shutil.rmtree(tmp_directory, ignore_errors=True)
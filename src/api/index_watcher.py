@@ -0,0 +1,317 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Any, Dict, List, Optional, Sequence
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from azure.core.exceptions import AzureError
+from openai import APIError, AsyncOpenAI
+from util import file_sha256, get_env_file_path
+from .chunking import DEFAULT_PATTERNS, chunk_file, find_files
+from .search_index_manager import SearchIndexManager
+
+logger = logging.getLogger("azureaiapp")
+
+DEFAULT_INPUT_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'files')
+DEFAULT_MANIFEST_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'index_watcher_manifest.json')
+# The API version of the Azure OpenAI embeddings, used by the command line interface.
+EMBEDDINGS_API_VERSION = '2024-10-21'
+
+_DOCUMENT_KEY = re.compile(r'[0-9a-f]{12}-[0-9a-f]{20}')
+
+
+def get_document_key(file_name: str, token: str) -> str:
+    """
+    Get the key of the chunk document.
+
+    The key depends only on the file and the chunk text, so the chunks, which did not
+    change, keep their documents when the other parts of the file are edited.
+
+    :param file_name: The path of the file relative to the watched directory.
+    :param token: The chunk text.
+    :return: The key, made of the characters allowed by the search service.
+    """
+    file_hash = hashlib.sha256(file_name.encode('utf-8')).hexdigest()[:12]
+    return f"{file_hash}-{hashlib.sha256(token.encode('utf-8')).hexdigest()[:20]}"
+
+
+def is_document_key(key: str) -> bool:
+    """
+    Check that the document was uploaded by the watcher.
+
+    The documents, uploaded from the embeddings file, have the numeric keys.
+
+    :param key: The document key.
+    :return: True if the key has the format of get_document_key.
+    """
+    return _DOCUMENT_KEY.fullmatch(key) is not None
+
+
+class OpenAIEmbeddingClient:
+    """
+    The embedding client of SearchIndexManager, backed by the OpenAI embeddings API.
+
+    :param client: The OpenAI client of the Azure OpenAI resource with the embedding deployment.
+    """
+
+    def __init__(self, client: AsyncOpenAI) -> None:
+        """Constructor."""
+        self._client = client
+
+    async def embed(self, input: List[str], dimensions: Optional[int], model: str) -> Dict[str, Any]:
+        """
+        Embed the batch of texts.
+
+        :param input: The texts.
+        :param dimensions: The number of dimensions or None for the default of the model.
+        :param model: The name of the embedding deployment.
+        :return: The response with the 'data' list of the items with the 'embedding'.
+        """
+        kwargs = {'dimensions': dimensions} if dimensions else {}
+        response = await self._client.embeddings.create(input=input, model=model, **kwargs)
+        return {'data': [{'embedding': item.embedding} for item in response.data]}
+
+
+class IndexWatcher:
+    """
+    Keep the search index in sync with the source documents, one changed file at a time.
+
+    The manifest file records the modification time, the size, the content hash and the
+    document keys of every indexed file. On every sync, the files with the new modification
+    time or size are hashed; only the files with the new content are chunked, only their new
+    chunks are embedded and uploaded, and the documents of the removed chunks and files are
+    deleted. The manifest is saved after every file, so the interrupted sync is resumed.
+
+    Every chunk of every file is indexed, like build_embeddings_file does by default: the
+    near-duplicates across the files are not dropped, because the chunk, which was kept,
+    could be deleted with its file later.
+
+    The first sync, without the manifest, indexes every file and then deletes the documents
+    of the watcher, not belonging to any file, like the ones left by the lost manifest. The
+    watcher takes the files over from the embeddings file: its documents, titled with the
+    names of the indexed files, are deleted too, and the application does not upload them
+    again once the manifest exists.
+
+    :param search_mgr: The search index manager with the embedding client and the created index.
+    :param input_directory: The directory with the source documents.
+    :param manifest_file: The path to the JSON manifest.
+    :param sentences_per_embedding: The number of sentences in the chunk.
+    :param patterns: The recursive glob patterns of the files relative to the directory.
+    """
+
+    def __init__(
+            self,
+            search_mgr: SearchIndexManager,
+            input_directory: str = DEFAULT_INPUT_DIRECTORY,
+            manifest_file: Optional[str] = None,
+            sentences_per_embedding: int = 4,
+            patterns: Sequence[str] = DEFAULT_PATTERNS
+        ) -> None:
+        """Constructor."""
+        self._search_mgr = search_mgr
+        self._input_directory = input_directory
+        self._manifest_file = manifest_file or DEFAULT_MANIFEST_FILE
+        self._sentences_per_embedding = sentences_per_embedding
+        self._patterns = patterns
+
+    def _load_manifest(self) -> Optional[Dict[str, Any]]:
+        """Load the manifest or return None if it is absent or broken."""
+        try:
+            with open(self._manifest_file) as fp:
+                manifest = json.load(fp)
+            if isinstance(manifest.get("files"), dict):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _save_manifest(self, manifest: Dict[str, Any]) -> None:
+        """Atomically replace the manifest."""
+        os.makedirs(os.path.dirname(os.path.abspath(self._manifest_file)), exist_ok=True)
+        tmp_file = self._manifest_file + ".tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+        os.replace(tmp_file, self._manifest_file)
+
+    async def _index_file(self, name: str, file_path: str, old_keys: List[str]) -> Dict[str, Any]:
+        """
+        Upload the new chunks of the file and delete its removed chunks.
+
+        :param name: The path of the file relative to the watched directory.
+        :param file_path: The path of the file.
+        :param old_keys: The keys of the documents of the previous version of the file.
+        :return: The numbers of the 'uploaded' and 'deleted' documents and the new 'keys'.
+        """
+        chunks = await asyncio.to_thread(chunk_file, file_path, self._sentences_per_embedding)
+        new_chunks = {}
+        for token, title in chunks:
+            new_chunks.setdefault(get_document_key(name, token), (token, title))
+        old = set(old_keys)
+        to_upload = [(key, chunk) for key, chunk in new_chunks.items() if key not in old]
+        to_delete = [key for key in old_keys if key not in new_chunks]
+        documents = []
+        batch_size = SearchIndexManager.EMBED_BATCH_SIZE
+        for start in range(0, len(to_upload), batch_size):
+            batch = to_upload[start:start + batch_size]
+            embeddings = await self._search_mgr.embed_batch([token for _, (token, _) in batch])
+            documents.extend(
+                {'embedId': key, 'token': token, 'title': title, 'embedding': embedding}
+                for (key, (token, title)), embedding in zip(batch, embeddings))
+        uploaded = await self._search_mgr.upsert_documents(documents) if documents else 0
+        deleted = await self._search_mgr.delete_documents(to_delete) if to_delete else 0
+        return {'uploaded': uploaded, 'deleted': deleted, 'keys': list(new_chunks)}
+
+    async def sync(self) -> Dict[str, int]:
+        """
+        Re-index the added, changed and deleted files.
+
+        :return: The numbers of the 'added', 'changed', 'deleted' and 'unchanged' files
+                 and of the 'uploaded' and 'removed' documents.
+        """
+        start = time.perf_counter()
+        manifest = self._load_manifest() or {"files": {}, "pruned": False}
+        files = manifest["files"]
+        current = {
+            os.path.relpath(path, self._input_directory).replace(os.sep, '/'): path
+            for path in find_files(self._input_directory, self._patterns)}
+        stats = dict.fromkeys(('added', 'changed', 'deleted', 'unchanged', 'uploaded', 'removed'), 0)
+
+        for name in sorted(set(files) - set(current)):
+            stats['removed'] += await self._search_mgr.delete_documents(files[name]['keys'])
+            stats['deleted'] += 1
+            del files[name]
+            self._save_manifest(manifest)
+
+        for name, file_path in sorted(current.items()):
+            stat = os.stat(file_path)
+            entry = files.get(name)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                stats['unchanged'] += 1
+                continue
+            sha256 = await asyncio.to_thread(file_sha256, file_path)
+            if entry and entry['sha256'] == sha256:
+                # The file was touched, but not changed.
+                stats['unchanged'] += 1
+            else:
+                result = await self._index_file(name, file_path, entry['keys'] if entry else [])
+                stats['changed' if entry else 'added'] += 1
+                stats['uploaded'] += result['uploaded']
+                stats['removed'] += result['deleted']
+                entry = {'keys': result['keys']}
+            files[name] = {**entry, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': sha256}
+            self._save_manifest(manifest)
+
+        if not manifest.get('pruned'):
+            known = {key for entry in files.values() for key in entry['keys']}
+            # The chunks are titled with the file names, like chunk_file does.
+            titles = {os.path.basename(path) for path in current.values()}
+            stale = {
+                key for key, title in (await self._search_mgr.get_index_titles()).items()
+                if key not in known and (is_document_key(key) or title in titles)}
+            stats['removed'] += await self._search_mgr.delete_documents(sorted(stale))
+            manifest['pruned'] = True
+            self._save_manifest(manifest)
+        if stats['added'] or stats['changed'] or stats['deleted']:
+            logger.info(
+                f"Re-indexed {stats['added']} added, {stats['changed']} changed and {stats['deleted']} deleted files "
+                f"in {time.perf_counter() - start:.1f}s: {stats['uploaded']} documents uploaded, "
+                f"{stats['removed']} deleted")
+        return stats
+
+    async def watch(self, interval: float = 5.0, stop: Optional[asyncio.Event] = None) -> None:
+        """
+        Poll the files and re-index the changed ones until stopped.
+
+        The failed sync is logged and repeated after the interval; it can be run as
+        the background task.
+
+        :param interval: The number of seconds between the polls.
+        :param stop: The event, which stops the watcher.
+        """
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            try:
+                await self.sync()
+            except (OSError, ValueError, AzureError, APIError) as e:
+                logger.warning(f"Re-indexing failed, retrying in {interval}s: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def _run(args: argparse.Namespace) -> None:
+    """
+    Create the search index manager from the environment and run the watcher.
+
+    The documents are embedded with the Azure OpenAI connection of the project, like
+    the index is created and populated on startup.
+    """
+    from azure.ai.projects.aio import AIProjectClient
+    from azure.ai.projects.models import ApiKeyCredentials, ConnectionType
+    from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+    from openai import AsyncAzureOpenAI
+    async with (
+        DefaultAzureCredential() as credential,
+        AIProjectClient(endpoint=os.environ['AZURE_EXISTING_AIPROJECT_ENDPOINT'], credential=credential) as project_client,
+    ):
+        aoai_connection = await project_client.connections.get_default(
+            connection_type=ConnectionType.AZURE_OPEN_AI, include_credentials=True)
+        embed_api_key = None
+        if aoai_connection.credentials and isinstance(aoai_connection.credentials, ApiKeyCredentials):
+            embed_api_key = aoai_connection.credentials.api_key
+        embedding = os.environ['AZURE_AI_EMBED_DEPLOYMENT_NAME']
+        dimensions = int(os.environ['AZURE_AI_EMBED_DIMENSIONS'])
+        openai_client = AsyncAzureOpenAI(
+            azure_endpoint=aoai_connection.target,
+            api_version=EMBEDDINGS_API_VERSION,
+            api_key=embed_api_key,
+            azure_ad_token_provider=None if embed_api_key else get_bearer_token_provider(
+                credential, "https://cognitiveservices.azure.com/.default"))
+        async with openai_client, SearchIndexManager(
+                endpoint=os.environ['AZURE_AI_SEARCH_ENDPOINT'],
+                credential=credential,
+                index_name=os.environ['AZURE_AI_SEARCH_INDEX_NAME'],
+                dimensions=dimensions,
+                model=embedding,
+                deployment_name=embedding,
+                embedding_endpoint=aoai_connection.target,
+                embed_api_key=embed_api_key,
+                embedding_client=OpenAIEmbeddingClient(openai_client)) as search_mgr:
+            await search_mgr.use_active_index()
+            await search_mgr.create_index(vector_index_dimensions=dimensions)
+            watcher = IndexWatcher(
+                search_mgr, args.input_directory, args.manifest, args.sentences_per_embedding)
+            if args.once:
+                logger.info(f"Re-indexing finished: {await watcher.sync()}")
+            else:
+                await watcher.watch(args.interval)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to re-index the changed files once or continuously."""
+    parser = argparse.ArgumentParser(
+        description="Watch the source documents and re-index the added, changed and deleted files.")
+    parser.add_argument('input_directory', nargs='?', default=DEFAULT_INPUT_DIRECTORY)
+    parser.add_argument('--manifest', help="The JSON manifest of the indexed files.")
+    parser.add_argument('--interval', type=float, default=5.0, help="The number of seconds between the polls.")
+    parser.add_argument('--once', action='store_true', help="Re-index the changed files once and exit.")
+    parser.add_argument('--sentences-per-embedding', type=int, default=4)
+    args = parser.parse_args(argv)
+    from dotenv import load_dotenv
+    from logging_config import configure_logging
+    load_dotenv(get_env_file_path())
+    configure_logging(os.getenv("APP_LOG_FILE", ""))
+    asyncio.run(_run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from array import array
+from collections import Counter
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+from .embeddings_store import get_metadata_file, is_binary_embeddings
+from .index_files import get_version_directory, write_directory
+from .search_index_manager import QueryResult
+from .search_results import SearchHit, format_search_hits
+
+logger = logging.getLogger("azureaiapp")
+
+_TERM = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split the text to the lowercase terms; the item numbers like 'TM-X4' give the terms 'tm' and 'x4'."""
+    return _TERM.findall(text.lower())
+
+
+def get_keyword_index_directory(embeddings_file: str) -> str:
+    """Get the default directory of the keyword index of the embeddings file."""
+    return os.path.splitext(embeddings_file)[0] + '.bm25'
+
+
+def read_chunks(embeddings_file: str) -> Tuple[List[str], List[str]]:
+    """
+    Read the chunks of the embeddings file without parsing the vectors.
+
+    :param embeddings_file: The CSV or .npy embeddings file.
+    :return: The tuple of the lists of the chunk texts and their titles.
+    """
+    tokens = []
+    titles = []
+    source = get_metadata_file(embeddings_file) if is_binary_embeddings(embeddings_file) else embeddings_file
+    with open(source, newline='') as fp:
+        for row in csv.DictReader(fp):
+            tokens.append(row['token'])
+            titles.append(row['title'])
+    return tokens, titles
+
+
+class KeywordIndex:
+    """
+    The in-process inverted index with the BM25 ranking.
+
+    The postings of all the terms are kept in two flat arrays of document numbers and
+    term frequencies; the postings of the term t are the slice offsets[t]:offsets[t + 1].
+    The index is saved to a directory of .npy files and memory-mapped on load, while the
+    vocabulary and the chunks are kept in a JSON file. It has the same search interface
+    as SearchIndexManager and is the counterpart of its full-text query for the offline
+    use, tests and the keyword leg of the local hybrid search. The document numbers are
+    the rows of the embeddings file, so they are the same as in LocalSearchIndex.
+
+    :param terms: The vocabulary, the position of the term is its number.
+    :param offsets: The first posting of every term; the last element is the number of postings.
+    :param doc_ids: The document numbers of the postings, ascending for every term.
+    :param freqs: The frequencies of the terms in the documents of the postings.
+    :param doc_lengths: The number of terms in every document.
+    :param tokens: The texts of the documents.
+    :param titles: The titles of the documents.
+    :param k1: The saturation of the term frequency.
+    :param b: The normalization of the term frequency by the document length.
+    :param top_k: The number of results returned by search.
+    """
+
+    _FILES = ('offsets', 'doc_ids', 'freqs', 'doc_lengths')
+
+    def __init__(
+            self,
+            terms: Sequence[str],
+            offsets: np.ndarray,
+            doc_ids: np.ndarray,
+            freqs: np.ndarray,
+            doc_lengths: np.ndarray,
+            tokens: Sequence[str],
+            titles: Sequence[str],
+            k1: float = 1.2,
+            b: float = 0.75,
+            top_k: int = 5
+        ) -> None:
+        """Constructor."""
+        self.terms = list(terms)
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.freqs = freqs
+        self.doc_lengths = doc_lengths
+        self.tokens = list(tokens)
+        self.titles = list(titles)
+        self.k1 = k1
+        self.b = b
+        self._top_k = top_k
+        self._vocabulary = {term: number for number, term in enumerate(self.terms)}
+        # The length normalization of every document, the part of BM25 not depending on the query.
+        average_length = float(doc_lengths.mean()) if doc_lengths.size else 1.0
+        self._norms = (k1 * (1 - b + b * doc_lengths / max(average_length, 1e-6))).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    @staticmethod
+    def build(
+            chunks: Iterable[Tuple[str, str]],
+            k1: float = 1.2,
+            b: float = 0.75
+            ) -> "KeywordIndex":
+        """
+        Build the index.
+
+        :param chunks: The tuples of the chunk text and the name of its file.
+        :param k1: The saturation of the term frequency.
+        :param b: The normalization of the term frequency by the document length.
+        :return: The new index.
+        """
+        vocabulary: Dict[str, int] = {}
+        term_ids = array('i')
+        doc_ids = array('i')
+        freqs = array('i')
+        doc_lengths = array('i')
+        tokens = []
+        titles = []
+        for doc_id, (token, title) in enumerate(chunks):
+            terms = tokenize(f"{token} {title}")
+            for term, freq in Counter(terms).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                freqs.append(freq)
+            doc_lengths.append(len(terms))
+            tokens.append(token)
+            titles.append(title)
+        term_ids_array = np.frombuffer(term_ids, dtype=np.int32)
+        # The stable sort keeps the postings of every term ordered by document.
+        order = np.argsort(term_ids_array, kind='stable')
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids_array, minlength=len(vocabulary)), out=offsets[1:])
+        return KeywordIndex(
+            terms=sorted(vocabulary, key=vocabulary.get),
+            offsets=offsets,
+            doc_ids=np.frombuffer(doc_ids, dtype=np.int32)[order],
+            freqs=np.minimum(np.frombuffer(freqs, dtype=np.int32)[order], np.iinfo(np.uint16).max).astype(np.uint16),
+            doc_lengths=np.frombuffer(doc_lengths, dtype=np.int32).copy(),
+            tokens=tokens,
+            titles=titles,
+            k1=k1,
+            b=b)
+
+    @staticmethod
+    async def build_from_files(
+            input_directory: str,
+            sentences_per_embedding: int = 4,
+            patterns: Optional[Sequence[str]] = None,
+            max_workers: Optional[int] = None,
+            duplicate_threshold: Optional[float] = None
+            ) -> "KeywordIndex":
+        """
+        Build the index from the same chunks as SearchIndexManager.build_embeddings_file, without embedding them.
+
+        :param input_directory: The directory with the markdown and JSON files.
+        :param sentences_per_embedding: The number of sentences in the chunk.
+        :param patterns: The recursive glob patterns of the files relative to the directory.
+        :param max_workers: The number of processes, which chunk the files.
+        :param duplicate_threshold: The minimal similarity of the dropped near-duplicate chunks;
+                                    None, the default, keeps all the chunks.
+        :return: The new index.
+        """
+        from .chunking import DEFAULT_PATTERNS, deduplicate_chunks, iter_chunks
+        chunks: AsyncIterable[Tuple[str, str]] = iter_chunks(
+            input_directory, sentences_per_embedding, patterns or DEFAULT_PATTERNS, max_workers)
+        if duplicate_threshold is not None:
+            chunks = deduplicate_chunks(chunks, duplicate_threshold)
+        return KeywordIndex.build([chunk async for chunk in chunks])
+
+    def save(self, directory: str, source_sha256: Optional[str] = None) -> None:
+        """
+        Save the index atomically.
+
+        :param directory: The directory to store the index in; if it exists, it is kept.
+        :param source_sha256: The hash of the embeddings file, the index was built from.
+        """
+        def write(tmp_directory: str) -> None:
+            for name in KeywordIndex._FILES:
+                np.save(os.path.join(tmp_directory, f"{name}.npy"), getattr(self, name))
+            with open(os.path.join(tmp_directory, 'documents.json'), 'w', encoding='utf-8') as fp:
+                json.dump({
+                    'k1': self.k1,
+                    'b': self.b,
+                    'source_sha256': source_sha256,
+                    'terms': self.terms,
+                    'tokens': self.tokens,
+                    'titles': self.titles,
+                }, fp, ensure_ascii=False)
+
+        write_directory(directory, write)
+
+    @staticmethod
+    def load(directory: str, mmap: bool = True) -> Tuple["KeywordIndex", Optional[str]]:
+        """
+        Load the index.
+
+        :param directory: The directory with the saved index.
+        :param mmap: Memory-map the postings instead of reading them.
+        :return: The tuple of the index and the hash of the embeddings file it was built from.
+        """
+        with open(os.path.join(directory, 'documents.json'), encoding='utf-8') as fp:
+            saved = json.load(fp)
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None)
+            for name in KeywordIndex._FILES}
+        index = KeywordIndex(
+            terms=saved['terms'], tokens=saved['tokens'], titles=saved['titles'],
+            k1=saved['k1'], b=saved['b'], **arrays)
+        return index, saved.get('source_sha256')
+
+    @staticmethod
+    def load_or_build(directory: str, embeddings_file: str) -> "KeywordIndex":
+        """
+        Load the index of the chunks of the embeddings file, or build and save it.
+
+        The index is rebuilt if the embeddings file has changed.
+
+        :param directory: The directory with the saved versions of the index.
+        :param embeddings_file: The embeddings file.
+        :return: The index.
+        """
+        version_directory, source_sha256 = get_version_directory(directory, embeddings_file)
+        if not os.path.isdir(version_directory):
+            start = time.perf_counter()
+            tokens, titles = read_chunks(embeddings_file)
+            index = KeywordIndex.build(zip(tokens, titles))
+            index.save(version_directory, source_sha256)
+            logger.info(
+                f"Built the keyword index of {len(index)} documents and {len(index.terms)} terms "
+                f"in {time.perf_counter() - start:.2f}s, saved to {version_directory}")
+        return KeywordIndex.load(version_directory)[0]
+
+    def search_terms(self, message: str, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the documents with the best BM25 score.
+
+        :param message: The query.
+        :param k: The number of documents.
+        :return: The tuple of the document numbers and their scores, sorted by descending
+                 score; only the documents, containing any term of the query, are returned.
+        """
+        k = k or self._top_k
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(message)):
+            number = self._vocabulary.get(term)
+            if number is None:
+                continue
+            start, end = self.offsets[number], self.offsets[number + 1]
+            ids = self.doc_ids[start:end]
+            freqs = self.freqs[start:end].astype(np.float32)
+            idf = np.log(1 + (len(self) - (end - start) + 0.5) / (end - start + 0.5))
+            # Every document occurs once in the postings of the term.
+            scores[ids] += idf * freqs * (self.k1 + 1) / (freqs + self._norms[ids])
+        found = np.flatnonzero(scores)
+        if found.size > k:
+            found = found[np.argpartition(-scores[found], k - 1)[:k]]
+        found = found[np.argsort(-scores[found], kind='stable')]
+        return found, scores[found]
+
+    def _get_hits(self, indices: np.ndarray, scores: np.ndarray) -> List[SearchHit]:
+        """Get the hits of one query; the score is BM25."""
+        return [
+            SearchHit(token=self.tokens[i], title=self.titles[i], embed_id=str(i), score=float(score))
+            for i, score in zip(indices, scores)]
+
+    def get_hits(self, message: str, k: Optional[int] = None) -> List[SearchHit]:
+        """
+        Find the documents with the best BM25 score, for the use by the other search backends.
+
+        :param message: The query.
+        :param k: The number of documents.
+        :return: The hits, best first; the score is BM25.
+        """
+        return self._get_hits(*self.search_terms(message, k))
+
+    def get_documents(self, message: str, k: Optional[int] = None) -> List[Dict[str, str]]:
+        """
+        Find the documents in the format of the search service, for the fusion with the other rankings.
+
+        :param message: The query.
+        :param k: The number of documents.
+        :return: The documents with 'token', 'title', 'embedId' and '@search.score' fields, best first.
+        """
+        indices, scores = self.search_terms(message, k)
+        return [
+            {'token': self.tokens[i], 'title': self.titles[i], 'embedId': str(i), '@search.score': float(score)}
+            for i, score in zip(indices, scores)]
+
+    async def search_hits(self, message: str, mode: str = 'vector') -> AsyncIterator[SearchHit]:
+        """
+        Search the message and stream the found documents with their scores.
+
+        :param message: The customer question.
+        :param mode: Not used, all the modes are the keyword search.
+        :return: The asynchronous iterator over the hits, best first.
+        """
+        for hit in self.get_hits(message):
+            yield hit
+
+    async def search(self, message: str) -> str:
+        """
+        Search the message in the keyword index.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return format_search_hits(self.get_hits(message))
+
+    async def semantic_search(self, message: str) -> str:
+        """
+        Search the message in the keyword index.
+
+        There is no semantic ranker in the keyword index, so it is the same as search.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return await self.search(message)
+
+    async def hybrid_search(self, message: str) -> str:
+        """
+        Search the message in the keyword index.
+
+        There are no vectors in the keyword index, so it is the same as search.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return await self.search(message)
+
+    async def search_many(
+            self,
+            messages: Sequence[str],
+            concurrency: int = 8,
+            mode: str = 'vector'
+            ) -> List[QueryResult]:
+        """
+        Search the batch of messages.
+
+        :param messages: The customer questions.
+        :param concurrency: Not used, the queries are answered in-process one by one;
+                            present for parity with SearchIndexManager.
+        :param mode: Not used, all the modes are the keyword search.
+        :return: The results in the order of the messages.
+        """
+        results = []
+        for message in messages:
+            start = time.perf_counter()
+            context = format_search_hits(self.get_hits(message))
+            results.append(QueryResult(message, context, time.perf_counter() - start))
+        return results
+
+    async def close(self) -> None:
+        """The keyword index does not hold any resources; present for parity with SearchIndexManager."""
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to build and query the keyword index."""
+    parser = argparse.ArgumentParser(description="Build or query the local BM25 index over the chunks of the embeddings file.")
+    parser.add_argument('command', choices=['build', 'search'])
+    parser.add_argument('embeddings_file')
+    parser.add_argument('--output', help="The directory of the index.")
+    parser.add_argument('--query', help="The query (search only).")
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    output = args.output or get_keyword_index_directory(args.embeddings_file)
+    index = KeywordIndex.load_or_build(output, args.embeddings_file)
+    if args.command == 'build':
+        print(f"Keyword index with {len(index)} documents and {len(index.terms)} terms is saved to {output}")
+    else:
+        start = time.perf_counter()
+        indices, scores = index.search_terms(args.query or '', args.k)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        for i, score in zip(indices, scores):
+            print(f"{score:8.3f} {index.titles[i]}: {index.tokens[i][:100]}")
+        print(f"Found in {elapsed_us:.0f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import TYPE_CHECKING, Any, AsyncIterator, List, Optional, Sequence, Tuple
+
+import logging
+import time
+
+import numpy as np
+
+from .embeddings_store import is_binary_embeddings, iter_embeddings, open_vectors, read_metadata
+from .search_index_manager import QueryResult
+from .search_results import SearchHit, format_search_hits, fuse_rankings
+
+if TYPE_CHECKING:
+    # The index module imports this one, so it is imported lazily by the constructor.
+    from .ann_index import IvfAlgorithmConfiguration
+
+logger = logging.getLogger("azureaiapp")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale the rows to the unit length, so that the dot product is the cosine similarity."""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+
+def read_embeddings(embeddings_file: str) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    Read the embeddings file, generated by SearchIndexManager.build_embeddings_file.
+
+    The binary embeddings (.npy) are memory-mapped without copying.
+
+    :param embeddings_file: The CSV or .npy embeddings file.
+    :return: The tuple of the float32 matrix with one row per document,
+             the list of the document texts and the list of their titles.
+    """
+    if is_binary_embeddings(embeddings_file):
+        tokens, titles = read_metadata(embeddings_file)
+        return open_vectors(embeddings_file), tokens, titles
+    vectors = []
+    tokens = []
+    titles = []
+    for token, title, vector in iter_embeddings(embeddings_file):
+        tokens.append(token)
+        titles.append(title)
+        vectors.append(vector)
+    return np.asarray(vectors, dtype=np.float32), tokens, titles
+
+
+def sample_queries(vectors: np.ndarray, num_queries: int = 200, noise: float = 0.5, seed: int = 0) -> np.ndarray:
+    """
+    Get the queries for the benchmarks of the approximate search against the exact one.
+
+    The queries are the corpus vectors with the gaussian noise added, so that
+    they are close to, but not identical with the documents.
+
+    :param vectors: The normalized corpus vectors.
+    :param num_queries: The number of queries.
+    :param noise: The standard deviation of the noise relative to the vector component scale.
+    :param seed: The seed of the random generator.
+    :return: The normalized queries, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(vectors.shape[0], min(num_queries, vectors.shape[0]), replace=False)]
+    return normalize(sample + rng.normal(scale=noise / np.sqrt(vectors.shape[1]), size=sample.shape))
+
+
+def recall_at_k(found: np.ndarray, exact: np.ndarray, k: int) -> float:
+    """
+    Get the share of the exact top k documents, found by the approximate search.
+
+    :param found: The documents, found for every query, one row per query.
+    :param exact: The exact top k documents of every query.
+    :param k: The number of documents per query.
+    :return: The recall@k, averaged over the queries.
+    """
+    return float(np.mean([len(set(a) & set(e)) / k for a, e in zip(found, exact)]))
+
+
+class LocalSearchIndex:
+    """
+    The in-process vector search over the embeddings file.
+
+    The embeddings are kept in one contiguous float32 matrix (memory-mapped for the
+    binary embeddings file) with the precomputed inverse row norms, so that the cosine
+    similarity of the whole corpus to a batch of queries is a single matrix multiplication. It has the same search interface as
+    SearchIndexManager and is intended for offline use, tests and small corpora.
+
+    :param embeddings_file: The embeddings file, generated by SearchIndexManager.build_embeddings_file,
+                            or its binary version, created by embeddings_store.convert_csv.
+    :param model: The embedding model, must be the same as one used to build the embeddings file.
+    :param dimensions: The number of dimensions in the embedding. Set this parameter only if
+                       embedding model accepts dimensions parameter.
+    :param embedding_client: The embedding client, used to embed the queries.
+    :param top_k: The number of results returned by search.
+    :param ann_directory: The directory of the approximate nearest neighbour index. If set,
+                          the index is loaded from it (or built and saved there once) and
+                          used instead of the exact search; recommended for large corpora.
+    :param ann_config: The configuration of the approximate nearest neighbour index.
+    :param quantization: The quantization of the vectors, int8 or binary. If set, the first
+                         pass of the search scans the compressed codes and the top candidates are
+                         rescored at full precision; use with the memory-mapped binary embeddings
+                         file, so that only the codes are resident in the memory of every worker.
+    :param rescore_factor: The number of candidates rescored per result with the quantization.
+    :param projection_file: The projection matrix of the embeddings file, reduced by
+                            dimension_reduction.reduce_embeddings; the query embeddings are
+                            projected with it.
+    :param keyword_index_directory: The directory of the BM25 index of the same chunks. If set,
+                                    the index is loaded from it (or built and saved there once);
+                                    semantic_search uses it instead of the vectors and hybrid_search
+                                    fuses both rankings.
+    """
+
+    def __init__(
+            self,
+            embeddings_file: str,
+            model: str,
+            dimensions: Optional[int] = None,
+            embedding_client: Optional[Any] = None,
+            top_k: int = 5,
+            ann_directory: Optional[str] = None,
+            ann_config: Optional["IvfAlgorithmConfiguration"] = None,
+            quantization: Optional[str] = None,
+            rescore_factor: int = 8,
+            projection_file: Optional[str] = None,
+            keyword_index_directory: Optional[str] = None
+        ) -> None:
+        """Constructor."""
+        self._embedding_model = model
+        self._dimensions = dimensions
+        self._embedding_client = embedding_client
+        self._top_k = top_k
+        self._projection = None
+        if projection_file:
+            from .dimension_reduction import Projection
+            self._projection = Projection.load(projection_file)
+        start = time.perf_counter()
+        self._matrix, self._tokens, self._titles = read_embeddings(embeddings_file)
+        logger.info(
+            f"Loaded {self._matrix.shape[0]} embeddings with {self._matrix.shape[1]} dimensions "
+            f"from {embeddings_file} in {time.perf_counter() - start:.2f}s")
+        self._inv_norms = LocalSearchIndex._inverse_norms(self._matrix)
+        self._ann = None
+        self._quantized = None
+        if ann_directory and quantization:
+            raise ValueError("The approximate nearest neighbour index and the quantization cannot be used together.")
+        if quantization:
+            from .quantization import QuantizedVectors
+            self._quantized = QuantizedVectors.build(self._matrix, quantization, self._inv_norms, rescore_factor)
+            logger.info(
+                f"Quantized the embeddings to {quantization}: {self._quantized.nbytes} bytes "
+                f"instead of {self._matrix.nbytes}")
+        if ann_directory:
+            from .ann_index import IvfIndex
+            self._ann = IvfIndex.load_or_build(ann_directory, embeddings_file, ann_config)
+            # The vectors are memory-mapped by the index.
+            self._matrix = None
+            self._inv_norms = None
+        self._keyword_index = None
+        if keyword_index_directory:
+            from .keyword_index import KeywordIndex
+            self._keyword_index = KeywordIndex.load_or_build(keyword_index_directory, embeddings_file)
+
+    @staticmethod
+    def _inverse_norms(matrix: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        """Calculate the inverse norms of the rows without copying the whole matrix."""
+        norms = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], chunk_size):
+            norms[start:start + chunk_size] = np.linalg.norm(matrix[start:start + chunk_size], axis=1)
+        norms[norms == 0] = 1
+        return 1 / norms
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def search_vectors(self, queries: np.ndarray, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest documents for the batch of query vectors.
+
+        :param queries: The query vectors, one per row, or the single vector.
+        :param k: The number of documents per query.
+        :return: The tuple of the document indices and cosine similarities,
+                 both of shape (queries, k), sorted by descending similarity. The approximate
+                 search pads the indices with -1 if it has found less than k documents.
+        """
+        queries = normalize(queries)
+        k = min(k or self._top_k, len(self))
+        if self._ann is not None:
+            return self._ann.search_vectors(queries, k)
+        if self._quantized is not None:
+            return self._quantized.search_vectors(queries, k)
+        scores = (queries @ self._matrix.T) * self._inv_norms
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    async def _embed(self, messages: Sequence[str]) -> np.ndarray:
+        """
+        Embed the queries with the embedding client.
+
+        :param messages: The queries.
+        :return: The matrix of the query embeddings.
+        """
+        if self._embedding_client is None:
+            raise ValueError("The embedding client is needed to search the local index.")
+        embedding = (await self._embedding_client.embed(
+            input=list(messages),
+            dimensions=self._dimensions,
+            model=self._embedding_model
+        ))["data"]
+        vectors = np.asarray([item['embedding'] for item in embedding], dtype=np.float32)
+        return vectors if self._projection is None else self._projection.apply(vectors)
+
+    def _get_hits(self, indices: np.ndarray, scores: np.ndarray) -> List[SearchHit]:
+        """Get the hits of one query; the score is the cosine similarity."""
+        return [
+            SearchHit(token=self._tokens[i], title=self._titles[i], embed_id=str(i), score=float(score))
+            for i, score in zip(indices, scores) if i >= 0]
+
+    async def _hybrid_hits(self, message: str, candidates: int = 10, rank_constant: int = 60) -> List[SearchHit]:
+        """Get the hits of the vector and the keyword rankings, merged with the reciprocal rank fusion."""
+        indices, scores = self.search_vectors(await self._embed([message]), candidates)
+        vector = [
+            {'token': hit.token, 'title': hit.title, 'embedId': hit.embed_id}
+            for hit in self._get_hits(indices[0], scores[0])]
+        documents = fuse_rankings(
+            {'vector': vector, 'keyword': self._keyword_index.get_documents(message, candidates)},
+            {'vector': 1.0, 'keyword': 1.0},
+            self._top_k, rank_constant)
+        return [SearchHit.from_document(document) for document in documents]
+
+    async def _get_mode_hits(self, message: str, mode: str) -> List[SearchHit]:
+        """Get the hits of one query in the search mode."""
+        if self._keyword_index is not None and mode == 'semantic':
+            return self._keyword_index.get_hits(message, self._top_k)
+        if self._keyword_index is not None and mode == 'hybrid':
+            return await self._hybrid_hits(message)
+        indices, scores = self.search_vectors(await self._embed([message]))
+        return self._get_hits(indices[0], scores[0])
+
+    async def search_hits(self, message: str, mode: str = 'vector') -> AsyncIterator[SearchHit]:
+        """
+        Search the message and stream the found documents with their scores.
+
+        :param message: The customer question.
+        :param mode: 'vector', 'semantic' for the keyword search or 'hybrid' for both fused;
+                     without the keyword index all the modes are the vector search.
+        :return: The asynchronous iterator over the hits, best first.
+        """
+        for hit in await self._get_mode_hits(message, mode):
+            yield hit
+
+    async def search(self, message: str) -> str:
+        """
+        Search the message in the local index.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        indices, scores = self.search_vectors(await self._embed([message]))
+        return format_search_hits(self._get_hits(indices[0], scores[0]))
+
+    async def search_many(
+            self,
+            messages: Sequence[str],
+            concurrency: int = 8,
+            mode: str = 'vector'
+            ) -> List[QueryResult]:
+        """
+        Search the batch of messages with one embedding request and one matrix query.
+
+        :param messages: The customer questions.
+        :param concurrency: Not used, all the messages are searched at once;
+                            present for parity with SearchIndexManager.
+        :param mode: 'vector', 'semantic' or 'hybrid'; only the vector search is batched,
+                     the other modes with the keyword index answer the messages one by one.
+        :return: The results in the order of the messages; the latency of every query
+                 is its share of the time of the whole batch.
+        """
+        if not messages:
+            return []
+        if self._keyword_index is not None and mode != 'vector':
+            results = []
+            for message in messages:
+                start = time.perf_counter()
+                context = format_search_hits(await self._get_mode_hits(message, mode))
+                results.append(QueryResult(message, context, time.perf_counter() - start))
+            return results
+        start = time.perf_counter()
+        indices, scores = self.search_vectors(await self._embed(messages))
+        latency = (time.perf_counter() - start) / len(messages)
+        return [
+            QueryResult(message, format_search_hits(self._get_hits(*row)), latency)
+            for message, row in zip(messages, zip(indices, scores))]
+
+    async def semantic_search(self, message: str) -> str:
+        """
+        Search the message in the local index.
+
+        There is no semantic ranker in the local index, so it is the keyword search if
+        the keyword index is set, and the same as search otherwise.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return format_search_hits(await self._get_mode_hits(message, 'semantic'))
+
+    async def hybrid_search(self, message: str) -> str:
+        """
+        Search the message with both the vectors and the keyword index.
+
+        The rankings are merged with the reciprocal rank fusion. Without the keyword
+        index it is the same as search.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return format_search_hits(await self._get_mode_hits(message, 'hybrid'))
+
+    async def close(self) -> None:
+        """The local index does not hold any resources; present for parity with SearchIndexManager."""
@@ -17,6 +17,8 @@ from util import get_env_file_path
 
 from logging_config import configure_logging
 
+from .stream_drain import StreamDrainMiddleware, stream_drain
+
 enable_trace = False
 logger = None
 
@@ -72,8 +74,12 @@ async def lifespan(app: fastapi.FastAPI):
 
             app.state.ai_project = project_client
             app.state.agent_version_obj = agent_version_obj
+            stream_drain.install_signal_handler()
             yield
 
+            # Let the in-flight streams finish and flush their metadata before the client is closed.
+            await stream_drain.wait()
+
     except Exception as e:
         logger.error(f"Error during startup: {e}", exc_info=True)
         raise RuntimeError(f"Error during startup: {e}")
@@ -118,6 +124,7 @@ def create_app():
     directory = os.path.join(os.path.dirname(__file__), "static")
     app = fastapi.FastAPI(lifespan=lifespan)
     app.mount("/static", StaticFiles(directory=directory), name="static")
+    app.add_middleware(StreamDrainMiddleware, drain=stream_drain)
     
     # Mount React static files
     # Uncomment the following lines if you have a React frontend
@@ -0,0 +1,222 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import argparse
+import time
+
+import numpy as np
+
+from .local_search_index import normalize, read_embeddings, recall_at_k, sample_queries
+
+QUANTIZATION_MODES = ('int8', 'binary')
+
+# The number of set bits in every byte value, used to compute the Hamming distance.
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+# numpy>=2.0 counts the bits natively, the lookup table is the fallback.
+_popcount = getattr(np, 'bitwise_count', _POPCOUNT.__getitem__)
+
+
+class QuantizedVectors:
+    """
+    The compressed codes of the embeddings for the first pass of the search.
+
+    The int8 mode stores one byte per dimension, scaled per dimension to the range
+    of the corpus; the candidates are scored by the dot product of the codes with the
+    full-precision query. The binary mode stores one bit per dimension, the sign of the
+    component relative to the corpus mean; the candidates are the documents with the
+    smallest Hamming distance to the query code. In both modes the top candidates are
+    rescored with the full-precision vectors, which may stay memory-mapped on disk, so
+    only the codes have to be resident in memory.
+
+    :param mode: The quantization mode, int8 or binary.
+    :param codes: The codes, one row per document.
+    :param offset: The scale (int8) or the mean (binary) of every dimension.
+    :param vectors: The full-precision vectors, used for rescoring.
+    :param inv_norms: The inverse norms of the full-precision vectors.
+    :param rescore_factor: The number of candidates rescored per requested result.
+    """
+
+    def __init__(
+            self,
+            mode: str,
+            codes: np.ndarray,
+            offset: np.ndarray,
+            vectors: np.ndarray,
+            inv_norms: np.ndarray,
+            rescore_factor: int = 8
+        ) -> None:
+        """Constructor."""
+        self.mode = mode
+        self.codes = codes
+        self.offset = offset
+        self.vectors = vectors
+        self.inv_norms = inv_norms
+        self.rescore_factor = rescore_factor
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """The memory taken by the codes."""
+        return self.codes.nbytes + self.offset.nbytes + self.inv_norms.nbytes
+
+    @staticmethod
+    def build(
+            vectors: np.ndarray,
+            mode: str,
+            inv_norms: Optional[np.ndarray] = None,
+            rescore_factor: int = 8,
+            chunk_size: int = 65536
+            ) -> "QuantizedVectors":
+        """
+        Quantize the vectors.
+
+        :param vectors: The full-precision vectors, one per row; they are read in chunks
+                        and kept by reference for rescoring.
+        :param mode: The quantization mode, int8 or binary.
+        :param inv_norms: The inverse norms of the vectors, calculated if not given.
+        :param rescore_factor: The number of candidates rescored per requested result.
+        :param chunk_size: The number of rows quantized at once.
+        :return: The quantized vectors.
+        :raises: ValueError if the mode is unknown.
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode {mode}, expected one of {', '.join(QUANTIZATION_MODES)}.")
+        if inv_norms is None:
+            inv_norms = np.empty(vectors.shape[0], dtype=np.float32)
+            for start in range(0, vectors.shape[0], chunk_size):
+                inv_norms[start:start + chunk_size] = np.linalg.norm(vectors[start:start + chunk_size], axis=1)
+            inv_norms[inv_norms == 0] = 1
+            inv_norms = 1 / inv_norms
+
+        def chunks():
+            for start in range(0, vectors.shape[0], chunk_size):
+                stop = start + chunk_size
+                yield start, stop, vectors[start:stop] * inv_norms[start:stop, None]
+
+        if mode == 'int8':
+            offset = np.zeros(vectors.shape[1], dtype=np.float32)
+            for _, _, chunk in chunks():
+                np.maximum(offset, np.abs(chunk).max(axis=0), out=offset)
+            offset[offset == 0] = 1
+            offset /= 127
+            codes = np.empty(vectors.shape, dtype=np.int8)
+            for start, stop, chunk in chunks():
+                codes[start:stop] = np.clip(np.rint(chunk / offset), -127, 127)
+        else:
+            offset = np.zeros(vectors.shape[1], dtype=np.float64)
+            for _, _, chunk in chunks():
+                offset += chunk.sum(axis=0)
+            offset = (offset / max(1, vectors.shape[0])).astype(np.float32)
+            codes = np.empty((vectors.shape[0], (vectors.shape[1] + 7) // 8), dtype=np.uint8)
+            for start, stop, chunk in chunks():
+                codes[start:stop] = np.packbits(chunk > offset, axis=1)
+        return QuantizedVectors(mode, codes, offset, vectors, inv_norms, rescore_factor)
+
+    def _candidate_scores(self, query: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        """
+        Score all the documents against the normalized query with the codes.
+
+        :return: The scores, the larger the closer.
+        """
+        scores = np.empty(len(self), dtype=np.float32)
+        if self.mode == 'int8':
+            scaled = query * self.offset
+            for start in range(0, len(self), chunk_size):
+                scores[start:start + chunk_size] = self.codes[start:start + chunk_size].astype(np.float32) @ scaled
+        else:
+            code = np.packbits(query > self.offset)
+            for start in range(0, len(self), chunk_size):
+                distances = _popcount(self.codes[start:start + chunk_size] ^ code).sum(axis=1, dtype=np.int32)
+                scores[start:start + chunk_size] = -distances
+        return scores
+
+    def search_vectors(
+            self,
+            queries: np.ndarray,
+            k: int,
+            rescore_factor: Optional[int] = None
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest documents for the batch of query vectors.
+
+        :param queries: The query vectors, one per row, or the single vector.
+        :param k: The number of documents per query.
+        :param rescore_factor: The number of candidates rescored per result, overrides the configured one.
+        :return: The tuple of the document indices and full-precision cosine similarities,
+                 both of shape (queries, k), sorted by descending similarity.
+        """
+        queries = normalize(queries)
+        k = min(k, len(self))
+        candidates = min(k * (rescore_factor or self.rescore_factor), len(self))
+        result_ids = np.empty((queries.shape[0], k), dtype=np.int64)
+        result_scores = np.empty((queries.shape[0], k), dtype=np.float32)
+        for i, query in enumerate(queries):
+            scores = self._candidate_scores(query)
+            rows = np.sort(np.argpartition(-scores, candidates - 1)[:candidates])
+            exact = (self.vectors[rows] @ query) * self.inv_norms[rows]
+            top = np.argsort(-exact)[:k]
+            result_ids[i] = rows[top]
+            result_scores[i] = exact[top]
+        return result_ids, result_scores
+
+
+def benchmark(
+        embeddings_file: str,
+        k: int = 5,
+        rescore_factor: int = 8,
+        num_queries: int = 200,
+        noise: float = 0.5,
+        seed: int = 0
+        ) -> List[Dict[str, float]]:
+    """
+    Measure the memory, latency and recall@k of the quantized search against the exact search.
+
+    The queries are the corpus vectors with the gaussian noise, see sample_queries.
+
+    :param embeddings_file: The embeddings file.
+    :param k: The number of documents per query.
+    :param rescore_factor: The number of candidates rescored per result.
+    :param num_queries: The number of queries.
+    :param noise: The standard deviation of the noise relative to the vector component scale.
+    :param seed: The seed of the random generator.
+    :return: One row per mode (float32 is the exact search) with the memory in bytes,
+             the latency in microseconds per query and recall@k.
+    """
+    vectors = normalize(read_embeddings(embeddings_file)[0])
+    queries = sample_queries(vectors, num_queries, noise, seed)
+
+    # The queries are searched one at a time in every mode, as the chat requests are.
+    start = time.perf_counter()
+    exact = np.array([np.argsort(-(vectors @ query))[:k] for query in queries])
+    exact_us = (time.perf_counter() - start) / len(queries) * 1e6
+    rows = [{'mode': 'float32', 'memory_bytes': vectors.nbytes, 'latency_us': exact_us, 'recall': 1.0}]
+    inv_norms = np.ones(vectors.shape[0], dtype=np.float32)
+    for mode in QUANTIZATION_MODES:
+        quantized = QuantizedVectors.build(vectors, mode, inv_norms, rescore_factor)
+        start = time.perf_counter()
+        ids, _ = quantized.search_vectors(queries, k)
+        latency_us = (time.perf_counter() - start) / len(queries) * 1e6
+        rows.append({'mode': mode, 'memory_bytes': quantized.nbytes, 'latency_us': latency_us,
+                     'recall': recall_at_k(ids, exact, k)})
+    return rows
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """The command line interface to benchmark the quantized search."""
+    parser = argparse.ArgumentParser(description="Benchmark the quantized search over the embeddings file.")
+    parser.add_argument('embeddings_file')
+    parser.add_argument('--rescore-factor', type=int, default=8)
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print(f"{'mode':>8} {'memory':>10} {'us/query':>10} {'recall@' + str(args.k):>10}")
+    for row in benchmark(args.embeddings_file, k=args.k, rescore_factor=args.rescore_factor):
+        print(f"{row['mode']:>8} {row['memory_bytes']:>10} {row['latency_us']:>10.1f} {row['recall']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import asyncio
+import time
+
+
+def normalize_query(message: str) -> str:
+    """Normalize the query, so that the questions differing only by case and spaces are the same."""
+    return ' '.join(message.split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    The bounded least recently used cache of the query embeddings.
+
+    The concurrent requests for the same query, which is not cached yet, share one
+    embedding request.
+
+    :param embed: The coroutine function, returning the embedding of the query.
+    :param max_size: The maximal number of the cached embeddings.
+    """
+
+    def __init__(self, embed: Callable[[str], Awaitable[List[float]]], max_size: int = 1024) -> None:
+        """Constructor."""
+        self._embed = embed
+        self._max_size = max_size
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self._embed_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, message: str) -> List[float]:
+        """
+        Get the embedding of the query.
+
+        :param message: The query.
+        :return: The embedding.
+        """
+        key = normalize_query(message)
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+        if key in self._in_flight:
+            self.hits += 1
+            return await asyncio.shield(self._in_flight[key])
+        self.misses += 1
+        future = asyncio.ensure_future(self._embed(message))
+        self._in_flight[key] = future
+        start = time.perf_counter()
+        try:
+            embedding = await asyncio.shield(future)
+        finally:
+            del self._in_flight[key]
+        self._embed_seconds += time.perf_counter() - start
+        self._entries[key] = embedding
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+        return embedding
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the cache metrics.
+
+        :return: The dictionary with the numbers of hits and misses, the hit rate, the mean
+                 latency of the embedding request and the estimated time saved by the hits, in seconds.
+        """
+        embed_latency = self._embed_seconds / self.misses if self.misses else 0.0
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(1, self.hits + self.misses),
+            'embed_latency': embed_latency,
+            'time_saved': self.hits * embed_latency,
+        }
+
+
+class SearchResultCache:
+    """
+    The bounded cache of the search results with the time to live.
+
+    The results are keyed by the normalized query, the search mode and the version of
+    the index, so that the results of the previous version are never returned.
+
+    :param ttl: The number of seconds the results are kept; zero disables the cache.
+    :param max_size: The maximal number of the cached results.
+    """
+
+    def __init__(self, ttl: float = 60, max_size: int = 1024) -> None:
+        """Constructor."""
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, str, int], Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(message: str, mode: str, version: int) -> Tuple[str, str, int]:
+        """Get the key of the query."""
+        return normalize_query(message), mode, version
+
+    def get(self, key: Tuple[str, str, int]) -> Optional[str]:
+        """
+        Get the cached results.
+
+        :param key: The key of the query.
+        :return: The formatted results or None if they are not cached or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple[str, str, int], results: str) -> None:
+        """
+        Cache the results.
+
+        :param key: The key of the query.
+        :param results: The formatted results.
+        """
+        if self._ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self._ttl, results)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def queries(self) -> List[Tuple[str, str]]:
+        """
+        Get the queries with the unexpired results.
+
+        :return: The tuples of the normalized query and the search mode, most recently used last.
+        """
+        now = time.monotonic()
+        return [(key[0], key[1]) for key, (expires, _) in self._entries.items() if expires > now]
+
+    def clear(self) -> None:
+        """Drop all the cached results."""
+        self._entries.clear()
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the cache metrics.
+
+        :return: The dictionary with the numbers of hits, misses and invalidations and the hit rate.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(1, self.hits + self.misses),
+            'invalidations': self.invalidations,
+        }
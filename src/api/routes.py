@@ -25,6 +25,9 @@ from azure.ai.projects.aio import AIProjectClient
 
 from util import encode_project_resource_id
 
+from .customer_lookup import call_function
+from .stream_drain import stream_drain
+
 from urllib.parse import quote
 
 
@@ -47,6 +50,9 @@ templates = Jinja2Templates(directory=directory)
 # Create a new FastAPI router
 router = fastapi.APIRouter()
 
+# The maximal number of the responses, continued with the output of the local function calls.
+MAX_FUNCTION_CALL_ROUNDS = 5
+
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from typing import Optional
@@ -206,32 +212,74 @@ async def get_result(
     carrier: Dict[str, str]
 ) -> AsyncGenerator[str, None]:
     ctx = TraceContextTextMapPropagator().extract(carrier=carrier)
-    with tracer.start_as_current_span('get_result', context=ctx):
+    with tracer.start_as_current_span('get_result', context=ctx), stream_drain.track() as stream:
         async with project_client.get_openai_client() as openai_client:
             logger.info(f"get_result invoked for conversation={conversation.id}")
             input_created_at = datetime.now(timezone.utc).timestamp()
             try:
-                response = await openai_client.responses.create(
-                    conversation=conversation.id,
-                    input=user_message,
-                    extra_body={"agent": AgentReference(name=agent.name, version=agent.version).as_dict()},
-                    stream=True
-                )
-                logger.info("Successfully created stream; starting to process events")
-                async for event in response:
-                    if event.type == "response.created":
-                        logger.info(f"Stream response created with ID: {event.response.id}")
-                    elif event.type == "response.output_text.delta":
-                        logger.info(f"Delta: {event.delta}")
-                        stream_data = {'content': event.delta, 'type': "message"}
-                        yield serialize_sse_event(stream_data)
-                    elif event.type == "response.output_item.done" and event.item.type == "message":
-                        stream_data = await get_message_and_annotations(event.item)
-                        stream_data['type'] = "completed_message"
-                        yield serialize_sse_event(stream_data)
-                    elif event.type == "response.completed":
-                        logger.info(f"Response completed with full message: {event.response.output_text}")
-                                                        
+                response_input = user_message
+                for _ in range(MAX_FUNCTION_CALL_ROUNDS):
+                    response = await openai_client.responses.create(
+                        conversation=conversation.id,
+                        input=response_input,
+                        extra_body={"agent": AgentReference(name=agent.name, version=agent.version).as_dict()},
+                        stream=True
+                    )
+                    logger.info("Successfully created stream; starting to process events")
+                    function_calls = []
+                    async for event in response:
+                        if stream_drain.expired():
+                            # The worker is shutting down and the grace period is over.
+                            logger.warning(f"Aborting stream for conversation={conversation.id}, the worker is draining")
+                            stream.aborted = True
+                            await response.close()
+                            stream_data = {
+                                'content': "The server is restarting, please send your message again.",
+                                'annotations': [],
+                                'type': "completed_message"
+                            }
+                            yield serialize_sse_event(stream_data)
+                            break
+                        if event.type == "response.created":
+                            logger.info(f"Stream response created with ID: {event.response.id}")
+                        elif event.type == "response.output_text.delta":
+                            logger.info(f"Delta: {event.delta}")
+                            stream_data = {'content': event.delta, 'type': "message"}
+                            yield serialize_sse_event(stream_data)
+                        elif event.type == "response.output_item.done" and event.item.type == "message":
+                            stream_data = await get_message_and_annotations(event.item)
+                            stream_data['type'] = "completed_message"
+                            yield serialize_sse_event(stream_data)
+                        elif event.type == "response.output_item.done" and event.item.type == "function_call":
+                            function_calls.append(event.item)
+                        elif event.type == "response.completed":
+                            logger.info(f"Response completed with full message: {event.response.output_text}")
+                    if stream.aborted or not function_calls:
+                        break
+                    # The lookups are answered locally and the agent continues with their output.
+                    response_input = []
+                    for item in function_calls:
+                        # The arguments hold the customer's personal data, so they are not logged.
+                        logger.info(f"Function call {item.name}")
+                        response_input.append({
+                            "type": "function_call_output",
+                            "call_id": item.call_id,
+                            "output": await call_function(item.name, item.arguments),
+                        })
+                else:
+                    # The agent still calls the functions after the last round. Their output is
+                    # added to the conversation, so it can continue, and the user is told.
+                    logger.warning(
+                        f"Function calls still pending after {MAX_FUNCTION_CALL_ROUNDS} rounds "
+                        f"for conversation={conversation.id}")
+                    await openai_client.conversations.items.create(conversation.id, items=response_input)
+                    stream_data = {
+                        'content': "The answer needed too many lookups, please rephrase your question.",
+                        'annotations': [],
+                        'type': "completed_message"
+                    }
+                    yield serialize_sse_event(stream_data)
+
             except Exception as e:
                 logger.exception(f"Exception in get_result: {e}")
                 error_data = {
@@ -242,7 +290,7 @@ async def get_result(
                 yield serialize_sse_event(error_data)
             finally:
                 stream_data = {'type': "stream_end"}
-                await save_user_message_created_at(openai_client, conversation, input_created_at)
+                await stream_drain.flush(save_user_message_created_at(openai_client, conversation, input_created_at))
                 yield serialize_sse_event(stream_data)           
 
 
@@ -1,15 +1,22 @@
-from typing import Any, Dict, Optional
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
+import asyncio
 import csv
-import glob
 import json
+import logging
 import os
+import random
 import time
 
+import aiohttp
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.search.documents.aio import AsyncSearchItemPaged, SearchClient 
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.search.documents.aio import SearchClient 
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
@@ -25,8 +32,38 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     VectorSearchProfile,
 )
-from azure.search.documents.models import VectorizableTextQuery
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
+from util import file_sha256
+from .embeddings_store import EmbeddingCache, count_embeddings, is_binary_embeddings, iter_embeddings
+from .query_cache import QueryEmbeddingCache, SearchResultCache
+from .search_results import SearchHit, format_search_hits, fuse_rankings, pack_search_hits
 
+logger = logging.getLogger("azureaiapp")
+
+
+def format_search_results(results: Iterable[Union[Dict, SearchHit]]) -> str:
+    """
+    Format the search results as the context for the agent.
+
+    :param results: The found documents with 'token' and 'title' fields or the hits.
+    :return: The formatted response string.
+    """
+    return format_search_hits(
+        result if isinstance(result, SearchHit) else SearchHit.from_document(result) for result in results)
+
+
+@dataclass
+class QueryResult:
+    """
+    The result of one query of the batch search.
+
+    :param message: The query.
+    :param context: The formatted results.
+    :param latency: The time to answer the query in seconds.
+    """
+    message: str
+    context: str
+    latency: float
 
 
 class SearchIndexManager:
@@ -44,11 +81,45 @@ class SearchIndexManager:
     :param embeddings_endpoint: The the endpoint used for embedding.
     :param embed_api_key: The api key used by the embedding resource.
     :param embedding_client: The embedding client, used t build the embedding. Needed only
-                             to create embedding file. Not used in inference time.
+                             to create embedding file, or to vectorize the queries.
+    :param vectorize_queries: Embed the queries with the embedding client and send the vectors
+                              to the search service instead of the text, which would be embedded by the
+                              index vectorizer on every query. The embeddings of the recent queries are cached.
+    :param query_cache_size: The maximal number of the cached query embeddings.
+    :param result_cache_ttl: The number of seconds the search results are cached;
+                             zero disables the cache. The cache is dropped when the documents
+                             are uploaded or the index is deleted.
+    :param result_cache_size: The maximal number of the cached search results.
+    :param context_budget: The maximal size of the context, returned by the search methods.
+                           If set, the best hits, which fit the budget, are returned and
+                           the near-duplicate hits are dropped.
+    :param context_budget_unit: The unit of context_budget, characters or tokens (estimated).
+    :param max_connections: The maximal number of the connections to the search service.
+    :param keepalive_timeout: The number of seconds the idle connection is kept open.
+    :param connection_timeout: The timeout of establishing the connection in seconds.
+    :param read_timeout: The timeout of reading the response in seconds.
     """
     
-    MIN_DIFF_CHARACTERS_IN_LINE = 5
-    MIN_LINE_LENGTH = 5
+    # The service accepts up to 1000 documents and 16 MB per indexing request.
+    UPLOAD_BATCH_SIZE = 1000
+    UPLOAD_BATCH_BYTES = 8 * 1024 * 1024
+    UPLOAD_CONCURRENCY = 4
+    UPLOAD_MAX_RETRIES = 5
+    # The statuses of the throttled requests or documents, which must be retried.
+    _RETRIABLE_STATUSES = frozenset((409, 422, 429, 503))
+    # The maximal time to wait for the uploaded documents to become searchable.
+    READY_TIMEOUT = 30
+    # The embedding requests, sent by build_embeddings_file.
+    EMBED_BATCH_SIZE = 2000
+    EMBED_CONCURRENCY = 4
+    EMBED_MAX_RETRIES = 5
+    # The statuses of the throttled or temporarily failed embedding requests.
+    _EMBED_RETRIABLE_STATUSES = frozenset((429, 500, 503))
+    # The versions of the index, built by rebuild_index, are named {index_name}-v{timestamp}
+    # and the active version is recorded in the pointer index {index_name}-alias.
+    VERSION_INFIX = '-v'
+    ALIAS_SUFFIX = '-alias'
+    KEEP_VERSIONS = 2
     
     _SEMANTIC_CONFIG = "semantic_search"
     _EMBEDDING_CONFIG = "embedding_config"
@@ -65,11 +136,22 @@ class SearchIndexManager:
             deployment_name: str,
             embedding_endpoint: str, 
             embed_api_key: Optional[str],
-            embedding_client: Optional[Any] = None
+            embedding_client: Optional[Any] = None,
+            vectorize_queries: bool = False,
+            query_cache_size: int = 1024,
+            result_cache_ttl: float = 60,
+            result_cache_size: int = 1024,
+            context_budget: Optional[int] = None,
+            context_budget_unit: str = 'characters',
+            max_connections: int = 32,
+            keepalive_timeout: float = 60,
+            connection_timeout: float = 10,
+            read_timeout: float = 60
         ) -> None:
         """Constructor."""
         self._dimensions = dimensions
         self._index_name = index_name
+        self._base_index_name = index_name
         self._embeddings_endpoint = embedding_endpoint
         self._endpoint = endpoint
         self._credential = credential
@@ -79,36 +161,463 @@ class SearchIndexManager:
         self._embed_api_key = embed_api_key
         self._client = None
         self._embedding_client = embedding_client
+        # The uploaded documents become searchable with a delay; until the probe, started
+        # by upload_documents, has finished, the empty results of the queries wait for it.
+        self._ready = True
+        self._ready_task: Optional[asyncio.Task] = None
+        self._query_cache: Optional[QueryEmbeddingCache] = None
+        if vectorize_queries:
+            if embedding_client is None:
+                raise ValueError("The embedding client is needed to vectorize the queries.")
+            self._query_cache = QueryEmbeddingCache(self._embed_query, query_cache_size)
+        self._result_cache = SearchResultCache(result_cache_ttl, result_cache_size)
+        # Incremented on every change of the documents, so that the cached results are not reused.
+        self._index_version = 0
+        self._context_budget = context_budget
+        self._context_budget_unit = context_budget_unit
+        self._max_connections = max_connections
+        self._keepalive_timeout = keepalive_timeout
+        self._connection_timeout = connection_timeout
+        self._read_timeout = read_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._transport: Optional[AioHttpTransport] = None
+        self._index_client: Optional[SearchIndexClient] = None
+        self._alias_client: Optional[SearchClient] = None
+        self._connection_stats = {'created': 0, 'reused': 0}
+
+    def _get_transport(self) -> AioHttpTransport:
+        """
+        Get the HTTP transport, shared by the search and the index clients.
+
+        The aiohttp session keeps up to max_connections connections alive, so the
+        consecutive requests reuse them instead of opening the new ones.
+        """
+        if self._transport is None:
+            trace_config = aiohttp.TraceConfig()
+
+            async def on_connection_create_end(session, context, params) -> None:
+                self._connection_stats['created'] += 1
+
+            async def on_connection_reuseconn(session, context, params) -> None:
+                self._connection_stats['reused'] += 1
+
+            trace_config.on_connection_create_end.append(on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._max_connections,
+                    keepalive_timeout=self._keepalive_timeout,
+                    ttl_dns_cache=300),
+                trace_configs=[trace_config],
+                trust_env=True,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                # The responses are decompressed by the azure-core pipeline.
+                auto_decompress=False)
+            self._transport = AioHttpTransport(
+                session=self._session,
+                session_owner=False,
+                connection_timeout=self._connection_timeout,
+                read_timeout=self._read_timeout)
+        return self._transport
 
     def _get_client(self):
         """Get search client if it is absent."""
         if self._client is None:
             self._client = SearchClient(
-                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential)
+                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential,
+                transport=self._get_transport())
         return self._client
+
+    def _get_index_client(self) -> SearchIndexClient:
+        """Get the search index client if it is absent."""
+        if self._index_client is None:
+            self._index_client = SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, transport=self._get_transport())
+        return self._index_client
+
+    def get_connection_stats(self) -> Dict[str, float]:
+        """
+        Get the statistics of the connections of the shared transport.
+
+        :return: The numbers of the created and reused connections and the share of the reused ones.
+        """
+        created = self._connection_stats['created']
+        reused = self._connection_stats['reused']
+        return {'created': created, 'reused': reused, 'reuse_ratio': reused / max(1, created + reused)}
     
-    async def upload_documents(self, embeddings_file: str) -> None:
+    @staticmethod
+    def _iter_documents(embeddings_file: str, skip_keys: Optional[Set[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily read the documents from the embeddings file.
+
+        :param embeddings_file: The embeddings file, generated by build_embeddings_file,
+                                or its binary version.
+        :param skip_keys: The keys of the documents, which must not be read.
+        :return: The iterator over the documents; the approximate size of the document
+                 in the request payload is stored under the '@size' key.
+        """
+        if is_binary_embeddings(embeddings_file):
+            for index, (token, title, vector) in enumerate(iter_embeddings(embeddings_file)):
+                if skip_keys and str(index) in skip_keys:
+                    continue
+                yield {
+                    'embedId': str(index),
+                    'token': token,
+                    'embedding': vector.tolist(),
+                    'title': title,
+                    # About 12 characters per serialized float.
+                    '@size': vector.shape[0] * 12 + len(token) + len(title) + 64,
+                }
+            return
+        with open(embeddings_file, newline='') as fp:
+            reader = csv.DictReader(fp)
+            for index, row in enumerate(reader):
+                if skip_keys and str(index) in skip_keys:
+                    continue
+                yield {
+                    'embedId': str(index),
+                    'token': row['token'],
+                    'embedding': json.loads(row['embedding']),
+                    'title': row['title'],
+                    # The JSON payload is dominated by the vector, already serialized in the file.
+                    '@size': len(row['embedding']) + len(row['token']) + len(row['title']) + 64,
+                }
+
+    @staticmethod
+    def _iter_batches(
+            documents: Iterator[Dict[str, Any]],
+            batch_size: int,
+            batch_bytes: int
+            ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Group the documents into the batches, bounded by document count and payload size.
+
+        :param documents: The documents to group.
+        :param batch_size: The maximal number of documents in the batch.
+        :param batch_bytes: The maximal approximate payload size of the batch.
+        :return: The iterator over the batches.
+        """
+        batch = []
+        size = 0
+        for document in documents:
+            doc_size = document.pop('@size', 0)
+            if batch and (len(batch) >= batch_size or size + doc_size > batch_bytes):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(document)
+            size += doc_size
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _get_retry_after(error: HttpResponseError, attempt: int) -> float:
+        """
+        Get the delay before the next attempt.
+
+        :param error: The error, returned by the service, if any.
+        :param attempt: The number of the attempt, starting from zero.
+        :return: The number of seconds to wait.
+        """
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return float(retry_after)
+                except ValueError:
+                    pass
+        return min(2 ** attempt, 30) + random.random()
+
+    async def _upload_batch(self, batch: List[Dict[str, Any]]) -> int:
+        """
+        Upload one batch, retrying the throttled requests and documents.
+
+        :param batch: The documents to upload.
+        :return: The number of uploaded documents.
+        :raises: HttpResponseError if the batch cannot be uploaded.
+        """
+        documents = batch
+        for attempt in range(SearchIndexManager.UPLOAD_MAX_RETRIES + 1):
+            error = None
+            try:
+                results = await self._get_client().upload_documents(documents)
+                failed_keys = {r.key for r in results if not r.succeeded}
+                if not failed_keys:
+                    return len(batch)
+                retriable = {r.key for r in results if not r.succeeded and r.status_code in SearchIndexManager._RETRIABLE_STATUSES}
+                if retriable != failed_keys:
+                    messages = [r.error_message for r in results if r.key in failed_keys - retriable]
+                    raise HttpResponseError(message=f"Unable to upload {len(failed_keys)} documents: {messages[0]}")
+                documents = [d for d in documents if d['embedId'] in failed_keys]
+            except HttpResponseError as e:
+                if e.status_code not in SearchIndexManager._RETRIABLE_STATUSES:
+                    raise
+                error = e
+            if attempt == SearchIndexManager.UPLOAD_MAX_RETRIES:
+                break
+            delay = SearchIndexManager._get_retry_after(error, attempt)
+            logger.info(f"Search service throttled {len(documents)} documents, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        raise HttpResponseError(
+            message=f"Unable to upload {len(documents)} documents after {SearchIndexManager.UPLOAD_MAX_RETRIES} retries.")
+
+    @staticmethod
+    def get_checkpoint_file(embeddings_file: str, index_name: str) -> str:
+        """
+        Get the default path of the upload checkpoint of the index.
+
+        :param embeddings_file: The embeddings file to upload.
+        :param index_name: The name of the index.
+        :return: The path to the checkpoint file, stored next to the embeddings file.
+        """
+        return f"{embeddings_file}.{index_name}.checkpoint.json"
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_file: str, source_hash: str) -> Set[str]:
+        """
+        Load the keys of the documents, which were uploaded from the same embeddings file.
+
+        :param checkpoint_file: The checkpoint file.
+        :param source_hash: The hash of the embeddings file.
+        :return: The set of the uploaded keys; empty if the checkpoint is absent or stale.
+        """
+        try:
+            with open(checkpoint_file) as fp:
+                checkpoint = json.load(fp)
+        except (OSError, ValueError):
+            return set()
+        if checkpoint.get('source_sha256') != source_hash:
+            return set()
+        return {str(key) for first, last in checkpoint.get('completed', []) for key in range(first, last + 1)}
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_file: str, source_hash: str, keys: Iterable[str]) -> None:
+        """
+        Save the keys of the uploaded documents as the ranges of the row numbers.
+
+        :param checkpoint_file: The checkpoint file.
+        :param source_hash: The hash of the embeddings file.
+        :param keys: The keys of the uploaded documents.
+        """
+        ranges = []
+        for key in sorted(int(k) for k in keys):
+            if ranges and ranges[-1][1] == key - 1:
+                ranges[-1][1] = key
+            else:
+                ranges.append([key, key])
+        try:
+            tmp_file = checkpoint_file + '.tmp'
+            with open(tmp_file, 'w') as fp:
+                json.dump({'source_sha256': source_hash, 'completed': ranges}, fp)
+            os.replace(tmp_file, checkpoint_file)
+        except OSError as e:
+            logger.warning(f"Unable to save the upload checkpoint {checkpoint_file}: {e}")
+
+    async def upload_documents(
+            self,
+            embeddings_file: str,
+            batch_size: Optional[int] = None,
+            batch_bytes: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            checkpoint_file: Optional[str] = None,
+            resume: bool = False,
+            skip_keys: Optional[Set[str]] = None
+            ) -> int:
         """
         Upload the embeggings file to index search.
 
+        The file is read lazily and sent in batches, bounded by the document count
+        and the payload size, several batches at a time. If the checkpoint file is
+        given, the keys of every uploaded batch are recorded in it.
+
         :param embeddings_file: The embeddings file to upload.
+        :param batch_size: The maximal number of documents in one request.
+        :param batch_bytes: The maximal approximate payload size of one request.
+        :param max_concurrency: The maximal number of requests in flight.
+        :param checkpoint_file: The file to record the upload progress.
+        :param resume: If True, skip the documents recorded in the checkpoint file,
+                       otherwise start the new checkpoint.
+        :param skip_keys: The keys of the documents, which are already in the index.
+        :return: The number of uploaded documents.
         """
         self._raise_if_no_index()
-        documents = []
-        index = 0
-        with open(embeddings_file, newline='') as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                documents.append(
-                    {
-                        'embedId': str(index),
-                        'token': row['token'],
-                        'embedding': json.loads(row['embedding']),
-                        'title': row['title'] 
-                    }
-                )
-                index += 1
-        await self._get_client().upload_documents(documents)
+        batch_size = batch_size or SearchIndexManager.UPLOAD_BATCH_SIZE
+        batch_bytes = batch_bytes or SearchIndexManager.UPLOAD_BATCH_BYTES
+        max_concurrency = max_concurrency or SearchIndexManager.UPLOAD_CONCURRENCY
+
+        completed = set(skip_keys or ())
+        source_hash = None
+        if checkpoint_file:
+            source_hash = file_sha256(embeddings_file)
+            if resume:
+                completed |= SearchIndexManager._load_checkpoint(checkpoint_file, source_hash)
+            SearchIndexManager._save_checkpoint(checkpoint_file, source_hash, completed)
+        if completed:
+            logger.info(f"Skipping {len(completed)} documents, which are already in {self._index.name}")
+
+        start = time.perf_counter()
+        uploaded = 0
+        pending: Dict[asyncio.Future, List[str]] = {}
+
+        def complete(done: Set[asyncio.Future]) -> int:
+            count = 0
+            for task in done:
+                count += task.result()
+                completed.update(pending.pop(task))
+            if checkpoint_file:
+                SearchIndexManager._save_checkpoint(checkpoint_file, source_hash, completed)
+            return count
+
+        try:
+            for batch in SearchIndexManager._iter_batches(
+                    SearchIndexManager._iter_documents(embeddings_file, set(completed)), batch_size, batch_bytes):
+                # Keep at most max_concurrency batches in memory.
+                if len(pending) >= max_concurrency:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    uploaded += complete(done)
+                pending[asyncio.ensure_future(self._upload_batch(batch))] = [d['embedId'] for d in batch]
+            if pending:
+                done, _ = await asyncio.wait(pending)
+                uploaded += complete(done)
+        finally:
+            for task in pending:
+                task.cancel()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Uploaded {uploaded} documents to {self._index.name} in {elapsed:.1f}s "
+            f"({uploaded / max(elapsed, 1e-6):.0f} documents/s)")
+        self._invalidate_results()
+        self._start_probe(len(completed))
+        return uploaded
+
+    async def upsert_documents(self, documents: Iterable[Dict[str, Any]]) -> int:
+        """
+        Upload the documents, replacing the ones with the same keys.
+
+        :param documents: The documents with 'embedId', 'token', 'title' and 'embedding' fields.
+        :return: The number of uploaded documents.
+        """
+        self._raise_if_no_index()
+        uploaded = 0
+        for batch in SearchIndexManager._iter_batches(
+                iter(documents), SearchIndexManager.UPLOAD_BATCH_SIZE, SearchIndexManager.UPLOAD_BATCH_BYTES):
+            uploaded += await self._upload_batch(batch)
+        if uploaded:
+            self._invalidate_results()
+        return uploaded
+
+    async def delete_documents(self, keys: Iterable[str]) -> int:
+        """
+        Delete the documents by their keys; the absent keys are ignored by the service.
+
+        :param keys: The keys of the documents.
+        :return: The number of the deleted keys.
+        """
+        self._raise_if_no_index()
+        keys = list(keys)
+        for start in range(0, len(keys), SearchIndexManager.UPLOAD_BATCH_SIZE):
+            results = await self._get_client().delete_documents(
+                [{'embedId': key} for key in keys[start:start + SearchIndexManager.UPLOAD_BATCH_SIZE]])
+            failed = [r for r in results if not r.succeeded]
+            if failed:
+                raise HttpResponseError(
+                    message=f"Unable to delete {len(failed)} documents: {failed[0].error_message}")
+        if keys:
+            self._invalidate_results()
+        return len(keys)
+
+    async def _probe_ready(self, expected_count: int = 1) -> bool:
+        """
+        Wait until the index reports the expected number of documents.
+
+        The documents become searchable with a delay after the upload, so
+        the document count is polled with the exponential backoff. The index is
+        considered ready after the probe even if the timeout was reached, so that
+        the empty results of the later queries are returned without waiting.
+
+        :param expected_count: The number of documents, which must be searchable.
+        :return: True if the index is ready, False if the timeout was reached.
+        """
+        deadline = time.monotonic() + SearchIndexManager.READY_TIMEOUT
+        delay = 0.1
+        while True:
+            count = await self._get_client().get_document_count()
+            if count >= expected_count:
+                self._ready = True
+                return True
+            if time.monotonic() + delay > deadline:
+                logger.warning(
+                    f"Index {self._index.name} has {count} of {expected_count} documents "
+                    f"after {SearchIndexManager.READY_TIMEOUT}s.")
+                self._ready = True
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2)
+
+    def _start_probe(self, expected_count: int) -> None:
+        """
+        Start the readiness probe in the background after the upload.
+
+        :param expected_count: The number of documents, which must be searchable.
+        """
+        if self._ready_task is not None:
+            self._ready_task.cancel()
+            self._ready_task = None
+        if expected_count <= 0:
+            self._ready = True
+            return
+        self._ready = False
+        self._ready_task = asyncio.ensure_future(self._probe_ready(expected_count))
+        # The failed probe is repeated by _ensure_ready; do not report it as unretrieved.
+        self._ready_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def _ensure_ready(self) -> None:
+        """Wait for the readiness probe once, sharing it between the concurrent queries."""
+        if self._ready:
+            return
+        if self._ready_task is None or self._ready_task.done():
+            self._ready_task = asyncio.ensure_future(self._probe_ready())
+        await asyncio.shield(self._ready_task)
+
+    async def get_index_keys(self) -> Set[str]:
+        """Get the keys of all the documents in the index."""
+        return set(await self.get_index_titles())
+
+    async def get_index_titles(self) -> Dict[str, str]:
+        """Get the titles of all the documents in the index by their keys."""
+        response = await self._get_client().search(search_text='*', select=['embedId', 'title'])
+        return {result['embedId']: result.get('title') async for result in response}
+
+    async def ensure_documents(self, embeddings_file: str, checkpoint_file: Optional[str] = None) -> int:
+        """
+        Verify that the index contains every document of the embeddings file and upload the missing ones.
+
+        If the previous upload was interrupted, it is resumed from the checkpoint file;
+        without the usable checkpoint only the keys, absent from the index, are uploaded.
+        The uploads are idempotent, so that the documents uploaded concurrently by the
+        other instance are overwritten with the same content. Only the keys of the
+        embeddings file are counted, so the documents, uploaded by api.index_watcher or
+        upsert_documents, do not hide the missing ones.
+
+        :param embeddings_file: The embeddings file, the index was populated from.
+        :param checkpoint_file: The file with the progress of the previous upload.
+        :return: The number of uploaded documents.
+        """
+        self._raise_if_no_index()
+        expected = count_embeddings(embeddings_file)
+        present = await self.get_index_keys() & {str(index) for index in range(expected)}
+        actual = len(present)
+        if actual >= expected:
+            logger.info(f"Index {self._index.name} contains all {expected} documents.")
+            return 0
+        logger.warning(f"Index {self._index.name} contains {actual} of {expected} documents, completing the upload.")
+
+        if checkpoint_file:
+            completed = SearchIndexManager._load_checkpoint(checkpoint_file, file_sha256(embeddings_file))
+            if completed and len(completed) < expected:
+                return await self.upload_documents(embeddings_file, checkpoint_file=checkpoint_file, resume=True)
+        return await self.upload_documents(embeddings_file, checkpoint_file=checkpoint_file, skip_keys=present)
 
     def _raise_if_no_index(self) -> None:
         """
@@ -124,9 +633,238 @@ class SearchIndexManager:
     async def delete_index(self):
         """Delete the index from vector store."""
         self._raise_if_no_index()
-        async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
-            await ix_client.delete_index(self._index.name)
+        await self._get_index_client().delete_index(self._index.name)
         self._index = None
+        self._invalidate_results()
+
+    @staticmethod
+    def get_versioned_name(index_name: str, version: Optional[str] = None) -> str:
+        """
+        Get the name of the version of the index.
+
+        :param index_name: The stable name of the index.
+        :param version: The digits of the version, the current UTC time by default;
+                        the versions must sort in the order of their creation.
+        :return: The name of the versioned index.
+        """
+        version = version or datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+        return f"{index_name}{SearchIndexManager.VERSION_INFIX}{version}"
+
+    def _get_alias_client(self) -> SearchClient:
+        """Get the client of the pointer index, which records the active version of the index."""
+        if self._alias_client is None:
+            self._alias_client = SearchClient(
+                endpoint=self._endpoint,
+                index_name=self._base_index_name + SearchIndexManager.ALIAS_SUFFIX,
+                credential=self._credential,
+                transport=self._get_transport())
+        return self._alias_client
+
+    async def resolve_index_name(self) -> str:
+        """
+        Get the name of the active version of the index.
+
+        :return: The index, the pointer refers to, or the stable name of the index
+                 if it was never rebuilt with rebuild_index.
+        """
+        try:
+            document = await self._get_alias_client().get_document(
+                key=self._base_index_name, selected_fields=['index_name'])
+        except ResourceNotFoundError:
+            return self._base_index_name
+        return document['index_name']
+
+    async def use_active_index(self) -> str:
+        """
+        Point the manager to the active version of the index.
+
+        The method must be called before create_index.
+
+        :return: The name of the active index.
+        """
+        self._index_name = await self.resolve_index_name()
+        return self._index_name
+
+    async def _switch_index(self, index_name: str) -> None:
+        """
+        Point the stable name of the index to the new version.
+
+        The pointer is the single document, so the switch is atomic: the readers
+        get either the previous or the new version.
+
+        :param index_name: The name of the new version.
+        """
+        pointer_index = SearchIndex(
+            name=self._base_index_name + SearchIndexManager.ALIAS_SUFFIX,
+            fields=[
+                SimpleField(name="alias", type=SearchFieldDataType.String, key=True),
+                SimpleField(name="index_name", type=SearchFieldDataType.String),
+                SimpleField(name="updated", type=SearchFieldDataType.DateTimeOffset),
+            ])
+        await self._get_index_client().create_or_update_index(pointer_index)
+        results = await self._get_alias_client().merge_or_upload_documents([{
+            'alias': self._base_index_name,
+            'index_name': index_name,
+            'updated': datetime.now(timezone.utc).isoformat(),
+        }])
+        if not results[0].succeeded:
+            raise HttpResponseError(
+                message=f"Unable to switch {self._base_index_name} to {index_name}: {results[0].error_message}")
+
+    def _get_staging_manager(self, index_name: str) -> "SearchIndexManager":
+        """
+        Get the manager of the new version of the index.
+
+        The manager is built from the same settings, but has its own connections and
+        clients, so the queries are served by the active version while the new one is
+        built. Its results are not cached.
+
+        :param index_name: The name of the new version.
+        :return: The manager of the new version.
+        """
+        staging = SearchIndexManager(
+            endpoint=self._endpoint,
+            credential=self._credential,
+            index_name=index_name,
+            dimensions=self._dimensions,
+            model=self._embedding_model,
+            deployment_name=self._embedding_deployment,
+            embedding_endpoint=self._embeddings_endpoint,
+            embed_api_key=self._embed_api_key,
+            embedding_client=self._embedding_client,
+            vectorize_queries=self._query_cache is not None,
+            result_cache_ttl=0,
+            context_budget=self._context_budget,
+            context_budget_unit=self._context_budget_unit,
+            max_connections=self._max_connections,
+            keepalive_timeout=self._keepalive_timeout,
+            connection_timeout=self._connection_timeout,
+            read_timeout=self._read_timeout)
+        staging._ready = False
+        return staging
+
+    async def rebuild_index(
+            self,
+            embeddings_file: str,
+            vector_index_dimensions: Optional[int] = None,
+            warmup_queries: Sequence[str] = (),
+            keep_versions: Optional[int] = None,
+            before_switch: Optional[Callable[[str], Awaitable[Any]]] = None,
+            pinned_indexes: Optional[Callable[[], Awaitable[Set[str]]]] = None
+            ) -> str:
+        """
+        Build the new version of the index and switch to it without the downtime.
+
+        The documents are uploaded to the new versioned index, while the active one keeps
+        serving the queries. The new version is verified to contain every document and is
+        warmed up with the queries, which have the cached results, and with warmup_queries.
+        Then before_switch re-pins the agents to it, the pointer is switched to it, and the
+        cached results are replaced with the ones found in the new version. Finally, the
+        oldest versions, which are not pinned, are deleted.
+
+        :param embeddings_file: The embeddings file to build the index from.
+        :param vector_index_dimensions: The number of dimensions in the vector index.
+        :param warmup_queries: The queries, searched in the new version before the switch.
+        :param keep_versions: The number of the most recent versions to keep, including the new one.
+        :param before_switch: The coroutine function, called with the name of the new version
+                              before the switch, like api.agent_index.repin_agent.
+        :param pinned_indexes: The coroutine function, returning the names of the indexes, which
+                               the agents still search, like api.agent_index.get_pinned_index_names.
+                               These versions are never deleted. Without it, no version is deleted.
+        :return: The name of the new active index.
+        :raises: ValueError if the new version misses documents; it is deleted and
+                 the active index is kept.
+        """
+        vector_index_dimensions = self._check_dimensions(vector_index_dimensions)
+        keep_versions = keep_versions or SearchIndexManager.KEEP_VERSIONS
+        async with self._get_staging_manager(
+                SearchIndexManager.get_versioned_name(self._base_index_name)) as staging:
+            await staging.create_index(vector_index_dimensions, raise_on_error=True)
+            new_name = staging._index.name
+            warmup: Dict[str, List[str]] = {}
+            for message, mode in self._result_cache.queries():
+                warmup.setdefault(mode, []).append(message)
+            warmup.setdefault('vector', []).extend(warmup_queries)
+            repinned = False
+            try:
+                await staging.upload_documents(embeddings_file)
+                await staging._ensure_ready()
+                expected = count_embeddings(embeddings_file)
+                actual = await staging._get_client().get_document_count()
+                if actual < expected:
+                    raise ValueError(f"Index {new_name} contains {actual} of {expected} documents.")
+                warm_results = {
+                    mode: await staging.search_many(messages, mode=mode)
+                    for mode, messages in warmup.items() if messages}
+                if before_switch is not None:
+                    repinned = True
+                    await before_switch(new_name)
+                await self._switch_index(new_name)
+            except BaseException:
+                if repinned:
+                    # The agents may already search the new version, so it is kept.
+                    logger.error(f"Rebuild of {self._base_index_name} failed, keeping {new_name}.")
+                    raise
+                logger.error(f"Rebuild of {self._base_index_name} failed, deleting {new_name}.")
+                try:
+                    await staging._get_index_client().delete_index(new_name)
+                except Exception as e:
+                    logger.warning(f"Unable to delete {new_name}: {e}")
+                raise
+
+        previous_name = self._index.name if self._index else None
+        if self._client:
+            # The client does not own the shared connections, so the queries in flight complete.
+            await self._client.close()
+        self._index = staging._index
+        self._client = None
+        self._index_name = new_name
+        self._ready = True
+        self._invalidate_results()
+        for mode, results in warm_results.items():
+            for result in results:
+                self._cache_results(
+                    SearchResultCache.get_key(result.message, mode, self._index_version), result.context)
+        logger.info(
+            f"Switched {self._base_index_name} from {previous_name} to {new_name}, "
+            f"warmed up with {sum(len(results) for results in warm_results.values())} queries.")
+        if pinned_indexes is None:
+            return new_name
+        try:
+            pinned = await pinned_indexes()
+        except Exception as e:
+            logger.warning(f"Unable to get the pinned versions of {self._base_index_name}, keeping them all: {e}")
+            return new_name
+        await self._delete_old_versions(keep_versions, pinned)
+        return new_name
+
+    async def _delete_old_versions(self, keep_versions: int, pinned: Set[str]) -> List[str]:
+        """
+        Delete all the versions of the index, except the active, the pinned and the most recent ones.
+
+        The index with the stable name, created by create_index, is never deleted.
+
+        :param keep_versions: The number of the most recent versions to keep.
+        :param pinned: The names of the indexes, which the agents still search.
+        :return: The names of the deleted indexes.
+        """
+        prefix = self._base_index_name + SearchIndexManager.VERSION_INFIX
+        versions = sorted(
+            [name async for name in self._get_index_client().list_index_names()
+             if name.startswith(prefix) and name[len(prefix):].isdigit()],
+            reverse=True)
+        deleted = []
+        for name in versions[keep_versions:]:
+            if name == self._index_name or name in pinned:
+                continue
+            try:
+                await self._get_index_client().delete_index(name)
+                deleted.append(name)
+            except HttpResponseError as e:
+                logger.warning(f"Unable to delete the old version {name}: {e}")
+        if deleted:
+            logger.info(f"Deleted the old versions of {self._base_index_name}: {', '.join(deleted)}")
+        return deleted
 
     def _check_dimensions(self, vector_index_dimensions: Optional[int] = None) -> int:
         """
@@ -146,32 +884,129 @@ class SearchIndexManager:
             raise ValueError("vector_index_dimensions is different from dimensions provided to constructor.")
         return vector_index_dimensions
 
-    async def _format_search_results(self, response: AsyncSearchItemPaged[Dict]) -> str:
+    async def _iter_documents_when_ready(self, **search_kwargs: Any) -> AsyncIterator[Dict[str, Any]]:
         """
-        Format the output of search.
+        Run the query and stream the found documents.
+
+        Until the probe, started after the upload, has finished, the empty result may mean
+        that the uploaded documents are not searchable yet; in this case the query is repeated
+        after the probe. After that, and for the index without the recent upload, the
+        empty results are returned right away.
 
-        :param response: The search results.
-        :return: The formatted response string.
+        :param search_kwargs: The arguments of SearchClient.search.
+        :return: The asynchronous iterator over the found documents.
         """
-        results = [f"{result['token']}, source: {result['title']}" async for result in response]
-        return "\n------\n".join(results)
+        # The documents may become searchable while the query runs, so the state is taken before it.
+        ready = self._ready
+        found = False
+        async for document in await self._get_client().search(**search_kwargs):
+            found = True
+            yield document
+        if found or ready:
+            return
+        await self._ensure_ready()
+        async for document in await self._get_client().search(**search_kwargs):
+            yield document
 
-    async def semantic_search(self, message: str) -> str:
+    async def _search_documents(self, **search_kwargs: Any) -> List[Dict[str, Any]]:
         """
-        Perform the semantic search on the search resource.
+        Run the query.
 
-        :param message: The customer question.
-        :return: The context for the question.
+        :param search_kwargs: The arguments of SearchClient.search.
+        :return: The found documents.
         """
-        self._raise_if_no_index()
-        response = await self._get_client().search(
+        return [document async for document in self._iter_documents_when_ready(**search_kwargs)]
+
+    def _format_hits(self, hits: Iterable[SearchHit]) -> str:
+        """Format the hits, packed into the context budget if it is set."""
+        if self._context_budget is not None:
+            hits = pack_search_hits(hits, self._context_budget, self._context_budget_unit)
+        return format_search_hits(hits)
+
+    async def _search_when_ready(self, **search_kwargs: Any) -> str:
+        """
+        Run the query and format the results.
+
+        :param search_kwargs: The arguments of SearchClient.search.
+        :return: The formatted results.
+        """
+        return self._format_hits(
+            SearchHit.from_document(document) for document in await self._search_documents(**search_kwargs))
+
+    async def _get_vector_query_kwargs(self, message: str, k: int = 5) -> Dict[str, Any]:
+        """Get the arguments of SearchClient.search for the vector query."""
+        if self._query_cache is not None:
+            vector_query = VectorizedQuery(
+                vector=await self._query_cache.get(message),
+                k_nearest_neighbors=k,
+                fields="embedding"
+            )
+        else:
+            vector_query = VectorizableTextQuery(
+                text=message,
+                k_nearest_neighbors=k,
+                fields="embedding"
+            )
+        return dict(vector_queries=[vector_query], select=['token', 'title', 'embedId'])
+
+    @staticmethod
+    def _get_semantic_query_kwargs(message: str) -> Dict[str, Any]:
+        """Get the arguments of SearchClient.search for the semantic query."""
+        return dict(
             search_text=message,
             query_type="full",
             search_fields=['token', 'title'],
             semantic_configuration_name=SearchIndexManager._SEMANTIC_CONFIG,
+            select=['token', 'title', 'embedId'],
         )
-        return await self._format_search_results(response)
-        
+
+    async def _embed_query(self, message: str) -> List[float]:
+        """Embed the query with the embedding client."""
+        return (await self.embed_batch([message]))[0]
+
+    def get_query_cache_stats(self) -> Optional[Dict[str, float]]:
+        """
+        Get the metrics of the query embedding cache.
+
+        :return: The hits, misses, hit rate and the estimated time saved by the cache,
+                 or None if the queries are vectorized by the search service.
+        """
+        return self._query_cache.stats() if self._query_cache is not None else None
+
+    def _cache_results(self, key: Tuple[str, str, int], results: str) -> None:
+        """Cache the results, unless they were found in the version of the index, which is already stale."""
+        # The empty results may mean that the documents are not searchable yet.
+        if results and key[2] == self._index_version:
+            self._result_cache.put(key, results)
+
+    def _invalidate_results(self) -> None:
+        """Drop the cached results after the change of the documents."""
+        self._index_version += 1
+        self._result_cache.clear()
+
+    def get_result_cache_stats(self) -> Dict[str, float]:
+        """
+        Get the metrics of the search result cache.
+
+        :return: The numbers of hits, misses and invalidations and the hit rate.
+        """
+        return self._result_cache.stats()
+
+    async def semantic_search(self, message: str) -> str:
+        """
+        Perform the semantic search on the search resource.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        self._raise_if_no_index()
+        key = SearchResultCache.get_key(message, 'semantic', self._index_version)
+        results = self._result_cache.get(key)
+        if results is not None:
+            return results
+        results = await self._search_when_ready(**SearchIndexManager._get_semantic_query_kwargs(message))
+        self._cache_results(key, results)
+        return results
 
     async def search(self, message: str) -> str:
         """
@@ -181,18 +1016,135 @@ class SearchIndexManager:
         :return: The context for the question.
         """
         self._raise_if_no_index()
-        vector_query = VectorizableTextQuery(
-            text=message,
-            k_nearest_neighbors=5,
-            fields="embedding"
-        )
-        response = await self._get_client().search(
-            vector_queries=[vector_query],
-            select=['token', 'title'],
-        )
-        # This lag is necessary, despite it is not described in documentation.
-        time.sleep(1)
-        return await self._format_search_results(response)
+        key = SearchResultCache.get_key(message, 'vector', self._index_version)
+        results = self._result_cache.get(key)
+        if results is not None:
+            return results
+        results = await self._search_when_ready(**await self._get_vector_query_kwargs(message))
+        self._cache_results(key, results)
+        return results
+
+    async def search_hits(self, message: str, mode: str = 'vector') -> AsyncIterator[SearchHit]:
+        """
+        Search the message and stream the found documents with their scores.
+
+        :param message: The customer question.
+        :param mode: The search method: 'vector' for search, 'semantic' for semantic_search
+                     or 'hybrid' for hybrid_search.
+        :return: The asynchronous iterator over the hits, best first.
+        :raises: ValueError if the mode is unknown.
+        """
+        self._raise_if_no_index()
+        if mode == 'hybrid':
+            documents, _ = await self.hybrid_search_documents(message)
+            for document in documents:
+                yield SearchHit.from_document(document)
+            return
+        if mode == 'vector':
+            search_kwargs = await self._get_vector_query_kwargs(message)
+        elif mode == 'semantic':
+            search_kwargs = SearchIndexManager._get_semantic_query_kwargs(message)
+        else:
+            raise ValueError(f"Unknown search mode {mode}, must be one of vector, semantic, hybrid.")
+        async for document in self._iter_documents_when_ready(**search_kwargs):
+            yield SearchHit.from_document(document)
+
+    async def search_many(
+            self,
+            messages: Sequence[str],
+            concurrency: int = 8,
+            mode: str = 'vector'
+            ) -> List[QueryResult]:
+        """
+        Search the batch of messages, several at a time.
+
+        :param messages: The customer questions.
+        :param concurrency: The maximal number of queries sent at the same time.
+        :param mode: The search method: 'vector' for search, 'semantic' for semantic_search
+                     or 'hybrid' for hybrid_search.
+        :return: The results in the order of the messages.
+        :raises: ValueError if the mode is unknown.
+        """
+        methods = {'vector': self.search, 'semantic': self.semantic_search, 'hybrid': self.hybrid_search}
+        if mode not in methods:
+            raise ValueError(f"Unknown search mode {mode}, must be one of {', '.join(methods)}.")
+        self._raise_if_no_index()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(message: str) -> QueryResult:
+            async with semaphore:
+                start = time.perf_counter()
+                context = await methods[mode](message)
+                return QueryResult(message, context, time.perf_counter() - start)
+
+        return list(await asyncio.gather(*(run(message) for message in messages)))
+
+    async def hybrid_search_documents(
+            self,
+            message: str,
+            top_k: int = 5,
+            candidates: int = 10,
+            rank_constant: int = 60,
+            vector_weight: float = 1.0,
+            semantic_weight: float = 1.0
+            ) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+        """
+        Run the vector and the semantic queries concurrently and fuse their results.
+
+        :param message: The customer question.
+        :param top_k: The number of documents to return.
+        :param candidates: The number of documents, requested by each query.
+        :param rank_constant: The constant of the reciprocal rank fusion.
+        :param vector_weight: The weight of the vector query in the fusion.
+        :param semantic_weight: The weight of the semantic query in the fusion.
+        :return: The tuple of the fused documents, best first, and the durations of the
+                 vector and semantic queries and of the whole search in seconds.
+        """
+        self._raise_if_no_index()
+        timings: Dict[str, float] = {}
+
+        async def timed(name: str, search_kwargs: Awaitable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            start = time.perf_counter()
+            try:
+                return await self._search_documents(**await search_kwargs, top=candidates)
+            finally:
+                timings[name] = time.perf_counter() - start
+
+        async def semantic_kwargs() -> Dict[str, Any]:
+            return SearchIndexManager._get_semantic_query_kwargs(message)
+
+        start = time.perf_counter()
+        vector, semantic = await asyncio.gather(
+            timed('vector', self._get_vector_query_kwargs(message, candidates)),
+            timed('semantic', semantic_kwargs()))
+        documents = fuse_rankings(
+            {'vector': vector, 'semantic': semantic},
+            {'vector': vector_weight, 'semantic': semantic_weight},
+            top_k, rank_constant)
+        timings['total'] = time.perf_counter() - start
+        return documents, timings
+
+    async def hybrid_search(self, message: str) -> str:
+        """
+        Search the message with both vector and semantic queries, run concurrently.
+
+        The results are merged with the reciprocal rank fusion.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        self._raise_if_no_index()
+        key = SearchResultCache.get_key(message, 'hybrid', self._index_version)
+        results = self._result_cache.get(key)
+        if results is not None:
+            return results
+        documents, timings = await self.hybrid_search_documents(message)
+        logger.debug(
+            f"Hybrid search took {timings['total']:.3f}s: vector {timings['vector']:.3f}s, "
+            f"semantic {timings['semantic']:.3f}s")
+        results = self._format_hits(SearchHit.from_document(document) for document in documents)
+        self._cache_results(key, results)
+        return results
 
     async def create_index(
         self,
@@ -221,8 +1173,7 @@ class SearchIndexManager:
         except HttpResponseError:
             if raise_on_error:
                 raise
-            async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
-                self._index = await ix_client.get_index(self._index_name)
+            self._index = await self._get_index_client().get_index(self._index_name)
             return False
         
     async def _index_create(self, vector_index_dimensions: int) -> SearchIndex:
@@ -238,127 +1189,254 @@ class SearchIndexManager:
                https://platform.openai.com/docs/models#embeddings
         :return: The newly created search index.
         """
-        async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
-            fields = [
-                SimpleField(name="embedId", type=SearchFieldDataType.String, key=True),
-                SearchField(
-                    name="embedding",
-                    type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                    vector_search_dimensions=vector_index_dimensions,
-                    searchable=True,
-                    vector_search_profile_name=SearchIndexManager._EMBEDDING_CONFIG
-                ),
-                SearchField(name="token", searchable=True, type=SearchFieldDataType.String, hidden=False),
-                SearchField(name="title", type=SearchFieldDataType.String, hidden=False),
-            ]
-            vector_search = VectorSearch(
-                profiles=[
-                    VectorSearchProfile(
-                        name=SearchIndexManager._EMBEDDING_CONFIG,
-                        algorithm_configuration_name="embed-algorithms-config",
-                        vectorizer_name=SearchIndexManager._VECTORIZER
-                    )
-                ],
-                algorithms=[HnswAlgorithmConfiguration(name="embed-algorithms-config")],
-                vectorizers=[
-                    AzureOpenAIVectorizer(
-                        vectorizer_name=SearchIndexManager._VECTORIZER,
-                        parameters=AzureOpenAIVectorizerParameters(
-                            resource_url=self._embeddings_endpoint,
-                            deployment_name=self._embedding_deployment,
-                            api_key=self._embed_api_key,
-                            model_name=self._embedding_model
-                        )
+        fields = [
+            SimpleField(name="embedId", type=SearchFieldDataType.String, key=True),
+            SearchField(
+                name="embedding",
+                type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                vector_search_dimensions=vector_index_dimensions,
+                searchable=True,
+                vector_search_profile_name=SearchIndexManager._EMBEDDING_CONFIG
+            ),
+            SearchField(name="token", searchable=True, type=SearchFieldDataType.String, hidden=False),
+            SearchField(name="title", type=SearchFieldDataType.String, hidden=False),
+        ]
+        vector_search = VectorSearch(
+            profiles=[
+                VectorSearchProfile(
+                    name=SearchIndexManager._EMBEDDING_CONFIG,
+                    algorithm_configuration_name="embed-algorithms-config",
+                    vectorizer_name=SearchIndexManager._VECTORIZER
+                )
+            ],
+            algorithms=[HnswAlgorithmConfiguration(name="embed-algorithms-config")],
+            vectorizers=[
+                AzureOpenAIVectorizer(
+                    vectorizer_name=SearchIndexManager._VECTORIZER,
+                    parameters=AzureOpenAIVectorizerParameters(
+                        resource_url=self._embeddings_endpoint,
+                        deployment_name=self._embedding_deployment,
+                        api_key=self._embed_api_key,
+                        model_name=self._embedding_model
                     )
-                ]
-            )
-            semantic_search = SemanticSearch(
-                default_configuration_name=SearchIndexManager._SEMANTIC_CONFIG,
-                configurations=[
-                    SemanticConfiguration(
-                        name=SearchIndexManager._SEMANTIC_CONFIG,
-                        prioritized_fields=SemanticPrioritizedFields(
-                            title_field=SemanticField(field_name="title"),
-                            content_fields=[
-                                SemanticField(field_name="token"),
-                            ]
-                        )
+                )
+            ]
+        )
+        semantic_search = SemanticSearch(
+            default_configuration_name=SearchIndexManager._SEMANTIC_CONFIG,
+            configurations=[
+                SemanticConfiguration(
+                    name=SearchIndexManager._SEMANTIC_CONFIG,
+                    prioritized_fields=SemanticPrioritizedFields(
+                        title_field=SemanticField(field_name="title"),
+                        content_fields=[
+                            SemanticField(field_name="token"),
+                        ]
                     )
-                ] 
-            )
-            search_index = SearchIndex(
-                name=self._index_name,
-                fields=fields,
-                vector_search=vector_search,
-                semantic_search=semantic_search)
-            new_index = await ix_client.create_index(search_index)
+                )
+            ] 
+        )
+        search_index = SearchIndex(
+            name=self._index_name,
+            fields=fields,
+            vector_search=vector_search,
+            semantic_search=semantic_search)
+        new_index = await self._get_index_client().create_index(search_index)
         return new_index
         
 
+    async def embed_batch(self, sentences: List[str]) -> List[List[float]]:
+        """
+        Embed one batch of sentences, retrying the throttled requests.
+
+        :param sentences: The sentences to embed.
+        :return: The embeddings in the order of the sentences.
+        :raises: HttpResponseError if the batch cannot be embedded.
+        """
+        for attempt in range(SearchIndexManager.EMBED_MAX_RETRIES + 1):
+            try:
+                embedding = (await self._embedding_client.embed(
+                    input=sentences,
+                    dimensions=self._dimensions,
+                    model=self._embedding_model
+                ))["data"]
+                return [item['embedding'] for item in embedding]
+            except HttpResponseError as e:
+                if e.status_code not in SearchIndexManager._EMBED_RETRIABLE_STATUSES or attempt == SearchIndexManager.EMBED_MAX_RETRIES:
+                    raise
+                delay = SearchIndexManager._get_retry_after(e, attempt)
+                logger.info(f"Embedding service throttled {len(sentences)} sentences, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _to_async(chunks: Iterable[Tuple[str, str]]) -> AsyncIterator[Tuple[str, str]]:
+        """Wrap the iterable of the chunks to the asynchronous iterator."""
+        for chunk in chunks:
+            yield chunk
+
+    @staticmethod
+    async def _next_batch(chunks: AsyncIterator[Tuple[str, str]], batch_size: int) -> List[Tuple[str, str]]:
+        """Get up to batch_size next chunks."""
+        batch = []
+        async for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                break
+        return batch
+
+    async def _write_embeddings(
+            self,
+            chunks: Union[Iterable[Tuple[str, str]], AsyncIterable[Tuple[str, str]]],
+            output_file: str,
+            batch_size: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            use_cache: bool = True
+            ) -> int:
+        """
+        Embed the chunks and write them to the embeddings file.
+
+        Several batches are embedded at the same time, and the rows are written as soon as
+        the oldest batch is ready, so that the order of the chunks is kept and at most
+        max_concurrency batches are held in memory. The chunks, embedded by the previous
+        builds with the same model and dimensions, are taken from the cache next to the
+        output file, so only the new or changed chunks are sent to the embedding client.
+
+        :param chunks: The tuples of the chunk text and the name of its file.
+        :param output_file: The csv file to store the embeddings.
+        :param batch_size: The number of chunks per embedding request.
+        :param max_concurrency: The maximal number of embedding requests at the same time.
+        :param use_cache: Reuse the cached embeddings of the unchanged chunks.
+        :return: The number of the written embeddings.
+        """
+        batch_size = batch_size or SearchIndexManager.EMBED_BATCH_SIZE
+        max_concurrency = max_concurrency or SearchIndexManager.EMBED_CONCURRENCY
+        cache = EmbeddingCache(
+            EmbeddingCache.get_cache_file(output_file) if use_cache else None,
+            self._embedding_model, self._dimensions)
+        if not hasattr(chunks, '__aiter__'):
+            chunks = SearchIndexManager._to_async(chunks)
+        chunks = chunks.__aiter__()
+        pending: Deque[Tuple[List[Tuple[str, str]], List[Optional[str]], asyncio.Future]] = deque()
+        written = 0
+        start = time.perf_counter()
+
+        async def embed_missing(keys: List[str], batch: List[Tuple[str, str]], embeddings: List[Optional[str]]) -> None:
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            if not missing:
+                return
+            vectors = await self.embed_batch([batch[i][0] for i in missing])
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = json.dumps(vector)
+                cache.put(keys[i], embeddings[i])
+
+        try:
+            with open(output_file, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                writer.writeheader()
+                while True:
+                    while len(pending) < max_concurrency:
+                        batch = await SearchIndexManager._next_batch(chunks, batch_size)
+                        if not batch:
+                            break
+                        keys = [cache.get_key(token) for token, _ in batch]
+                        embeddings = [cache.get(key) for key in keys]
+                        pending.append((batch, embeddings, asyncio.ensure_future(embed_missing(keys, batch, embeddings))))
+                    if not pending:
+                        break
+                    batch, embeddings, task = pending.popleft()
+                    await task
+                    for (token, reference), embedding in zip(batch, embeddings):
+                        writer.writerow({
+                            'token': token,
+                            'embedding': embedding,
+                            'title': reference})
+                    written += len(batch)
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
+            # Keep the embeddings of the finished batches even if the build has failed.
+            cache.save()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Built {written} embeddings in {elapsed:.1f}s ({written / max(elapsed, 1e-6):.0f} embeddings/s), "
+            f"{cache.hits} ({cache.reuse_ratio:.0%}) reused from the cache")
+        return written
+
     async def build_embeddings_file(
             self,
             input_directory: str,
             output_file: str,
             sentences_per_embedding: int=4,
-            ) -> None:
+            batch_size: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            use_cache: bool = True,
+            patterns: Optional[Sequence[str]] = None,
+            max_workers: Optional[int] = None,
+            duplicate_threshold: Optional[float] = None
+            ) -> int:
         """
-        In this method we do lazy loading of nltk and download the needed data set to split
+        Split the documents to the chunks of sentences and build the embeddings file.
 
-        document into tokens. This operation takes time that is why we hide import nltk under this
-        method. We also do not include nltk into requirements because this method is only used
-        during rag generation.
-        :param dimensions: The number of dimensions in the embeddings. Must be the same as
-               the one used for SearchIndexManager creation.
+        The files are split by nltk on the process pool, which requires nltk to be installed;
+        we do not include nltk into requirements because this method is only used
+        during rag generation. The chunks are streamed to the embedding requests as
+        the files are processed.
         :param input_directory: The directory with the embedding files.
         :param output_file: The file csv file to store embeddings.
-        :param embeddings_client: The embedding client, used to create embeddings. 
-                Must be the same as the one used for SearchIndexManager creation.
         :param sentences_per_embedding: The number of sentences used to build embedding.
+        :param batch_size: The number of chunks per embedding request.
+        :param max_concurrency: The maximal number of embedding requests at the same time.
+        :param use_cache: Reuse the embeddings of the unchanged chunks from the previous build,
+               cached next to the output file.
+        :param patterns: The recursive glob patterns of the files, relative to input_directory;
+               all the markdown and JSON files by default.
+        :param max_workers: The number of the chunking processes, the number of CPUs by default.
+        :param duplicate_threshold: The minimal similarity of the near-duplicate chunks; only the first
+               of them is embedded, with the title of its file. None, the default, keeps the duplicates,
+               like api.index_watcher does.
+        :return: The number of the written embeddings.
         """
-        import nltk
-        nltk.download('punkt')
-        
-        from nltk.tokenize import sent_tokenize
-        # Split the data to sentence tokens.
-        sentence_tokens = []
-        references = []
-        globs = glob.glob(input_directory + '/*.md', recursive=True)
-        index = 0
-        for fle in globs:
-            with open(fle) as f:
-                for line in f:
-                    line = line.strip()
-                    # Skip non informative lines.
-                    if len(line) < SearchIndexManager.MIN_LINE_LENGTH or len(set(line)) < SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE:
-                        continue
-                    for sentence in sent_tokenize(line):
-                        if index % sentences_per_embedding == 0:
-                            sentence_tokens.append(sentence)
-                            references.append(os.path.split(fle)[-1])
-                        else:
-                            sentence_tokens[-1] += ' '
-                            sentence_tokens[-1] += sentence
-                        index += 1
-        
-        
+        from .chunking import DEFAULT_PATTERNS, deduplicate_chunks, iter_chunks
+        chunks = iter_chunks(
+            input_directory, sentences_per_embedding, patterns or DEFAULT_PATTERNS, max_workers)
+        stats: Dict[str, int] = {}
+        # The deduplication is streamed, so the chunks still reach the embedding requests as the files are chunked.
+        if duplicate_threshold is not None:
+            chunks = deduplicate_chunks(chunks, duplicate_threshold, stats)
         # For each token build the embedding, which will be used in the search.
-        batch_size = 2000
-        with open(output_file, 'w') as fp:
-            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
-            writer.writeheader()
-            for i in range(0, len(sentence_tokens), batch_size):
-                emedding = (await self._embedding_client.embed(
-                    input=sentence_tokens[i:i+min(batch_size, len(sentence_tokens))],
-                    dimensions=self._dimensions,
-                    model=self._embedding_model
-                ))["data"]
-                for token, float_data, reference in zip(sentence_tokens, emedding, references):
-                    writer.writerow({
-                        'token': token,
-                        'embedding': json.dumps(float_data['embedding']),
-                        'title': reference})
+        written = await self._write_embeddings(chunks, output_file, batch_size, max_concurrency, use_cache)
+        if stats:
+            batch_size = batch_size or SearchIndexManager.EMBED_BATCH_SIZE
+            removed = stats['chunks'] - stats['unique']
+            saved_requests = -(-stats['chunks'] // batch_size) - -(-stats['unique'] // batch_size)
+            logger.info(
+                f"Dropped {removed} near-duplicate chunks: the index is {removed / max(1, stats['chunks']):.0%} "
+                f"smaller, {removed} embeddings and {saved_requests} embedding requests saved")
+        return written
 
     async def close(self):
         """Close the closeable resources, associated with SearchIndexManager."""
+        if self._ready_task is not None:
+            self._ready_task.cancel()
+            self._ready_task = None
         if self._client:
             await self._client.close()
+            self._client = None
+        if self._alias_client:
+            await self._alias_client.close()
+            self._alias_client = None
+        if self._index_client:
+            await self._index_client.close()
+            self._index_client = None
+        if self._session:
+            await self._session.close()
+            self._session = None
+            self._transport = None
+
+    async def __aenter__(self) -> "SearchIndexManager":
+        return self
+
+    async def __aexit__(self, *exc_details: Any) -> None:
+        await self.close()
@@ -0,0 +1,162 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+import re
+
+SEPARATOR = "\n------\n"
+# The separator of the files in the title of the document, found in several files.
+TITLE_SEPARATOR = "; "
+BUDGET_UNITS = ('characters', 'tokens')
+
+_WORD = re.compile(r"\w+")
+
+
+@dataclass
+class SearchHit:
+    """
+    The document, found by the search.
+
+    :param token: The text of the document.
+    :param title: The name of the file, the document comes from, or the names of the files,
+                  joined by TITLE_SEPARATOR, if the document was found in several ones.
+    :param embed_id: The key of the document in the index.
+    :param score: The relevance of the document, the larger the better; the scale depends on the search mode.
+    """
+    token: str
+    title: str
+    embed_id: Optional[str] = None
+    score: Optional[float] = None
+
+    @staticmethod
+    def from_document(document: Dict[str, Any]) -> "SearchHit":
+        """
+        Create the hit from the document, returned by the search service.
+
+        :param document: The document with 'token' and 'title' fields.
+        :return: The hit with the best available score: fused, reranker or search score.
+        """
+        score = None
+        for field in ('@rrf_score', '@search.reranker_score', '@search.score'):
+            if document.get(field) is not None:
+                score = float(document[field])
+                break
+        return SearchHit(
+            token=document['token'],
+            title=document['title'],
+            embed_id=document.get('embedId'),
+            score=score)
+
+    @property
+    def titles(self) -> List[str]:
+        """The names of the files, the document comes from."""
+        return self.title.split(TITLE_SEPARATOR)
+
+    def format(self) -> str:
+        """Format the hit as the context for the agent."""
+        titles = self.titles
+        if len(titles) == 1:
+            return f"{self.token}, source: {self.title}"
+        return f"{self.token}, sources: {', '.join(titles)}"
+
+
+def join_titles(titles: Iterable[str]) -> str:
+    """
+    Join the names of the files, the document was found in, to its title.
+
+    :param titles: The names of the files, the repeated names are dropped.
+    :return: The title.
+    """
+    return TITLE_SEPARATOR.join(dict.fromkeys(titles))
+
+
+def format_search_hits(hits: Iterable[SearchHit]) -> str:
+    """
+    Format the hits as the context for the agent.
+
+    :param hits: The hits.
+    :return: The formatted response string.
+    """
+    return SEPARATOR.join(hit.format() for hit in hits)
+
+
+def fuse_rankings(
+        rankings: Dict[str, List[Dict[str, Any]]],
+        weights: Dict[str, float],
+        top_k: int,
+        rank_constant: int = 60
+        ) -> List[Dict[str, Any]]:
+    """
+    Merge the rankings with the weighted reciprocal rank fusion.
+
+    :param rankings: The documents found by every query, best first.
+    :param weights: The weight of every query.
+    :param top_k: The number of documents to return.
+    :param rank_constant: The constant, added to the rank; the larger value
+                          gives the more weight to the lower ranks.
+    :return: The documents with the largest fused score under the '@rrf_score' key, best first.
+    """
+    fused: Dict[str, Dict[str, Any]] = {}
+    for name, documents in rankings.items():
+        for rank, document in enumerate(documents, start=1):
+            # The documents, found by both queries, are merged by their key.
+            key = document.get('embedId') or document['token']
+            entry = fused.setdefault(key, {**document, '@rrf_score': 0.0})
+            entry['@rrf_score'] += weights.get(name, 1.0) / (rank_constant + rank)
+    return sorted(fused.values(), key=lambda d: d['@rrf_score'], reverse=True)[:top_k]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of the model tokens in the text, about four characters per token."""
+    return (len(text) + 3) // 4
+
+
+def get_shingles(text: str, size: int = 3) -> Set[str]:
+    """Get the set of the word n-grams of the text."""
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def pack_search_hits(
+        hits: Iterable[SearchHit],
+        budget: int,
+        unit: str = 'characters',
+        max_similarity: float = 0.8
+        ) -> List[SearchHit]:
+    """
+    Select the best hits, which fit the budget of the context.
+
+    The hits are taken by descending score; the hits, which do not fit the remaining
+    budget, are skipped, and so are the near-duplicates of the already selected hits.
+
+    :param hits: The hits.
+    :param budget: The maximal size of the formatted context.
+    :param unit: The unit of the budget, characters or tokens (estimated).
+    :param max_similarity: The maximal Jaccard similarity of the word trigrams of two selected hits.
+    :return: The selected hits, best first.
+    :raises: ValueError if the unit is unknown.
+    """
+    if unit not in BUDGET_UNITS:
+        raise ValueError(f"Unknown budget unit {unit}, expected one of {', '.join(BUDGET_UNITS)}.")
+    measure: Callable[[str], int] = len if unit == 'characters' else estimate_tokens
+    hits = list(hits)
+    # The stable sort keeps the order of the service for the equal or missing scores.
+    hits.sort(key=lambda hit: -hit.score if hit.score is not None else 0.0)
+    selected: List[SearchHit] = []
+    selected_shingles: List[Set[str]] = []
+    used = 0
+    for hit in hits:
+        size = measure(hit.format()) + (measure(SEPARATOR) if selected else 0)
+        if used + size > budget:
+            continue
+        shingles = get_shingles(hit.token)
+        if any(len(shingles & other) / len(shingles | other) >= max_similarity for other in selected_shingles):
+            continue
+        selected.append(hit)
+        selected_shingles.append(shingles)
+        used += size
+    return selected
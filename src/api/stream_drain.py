@@ -0,0 +1,206 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Dict, Iterable, Iterator, Optional, Set
+
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger("azureaiapp")
+
+# The number of seconds in-flight /chat streams may keep running once the worker
+# starts draining. Gunicorn's graceful_timeout must be larger than this value.
+DEFAULT_DRAIN_SECONDS = 45
+
+
+def get_drain_seconds() -> int:
+    """Get the drain grace period from STREAM_DRAIN_SECONDS."""
+    return int(os.getenv("STREAM_DRAIN_SECONDS", str(DEFAULT_DRAIN_SECONDS)))
+
+
+class TrackedStream:
+    """The state of one /chat stream, tracked by StreamDrain."""
+
+    def __init__(self) -> None:
+        self.aborted = False
+
+
+class StreamDrain:
+    """
+    Track the in-flight /chat streams of a worker and drain them on shutdown.
+
+    When the worker is about to be recycled (max_requests) or receives SIGTERM,
+    the drain begins: new /chat streams are refused, active streams may finish
+    until the grace deadline and are cut off after it, and the pending
+    conversation metadata writes are flushed before the worker exits.
+
+    :param grace_seconds: The number of seconds active streams may run after the drain begins.
+    """
+
+    # Upper bound on the time spent waiting for a single metadata write.
+    FLUSH_TIMEOUT = 5
+
+    def __init__(self, grace_seconds: Optional[float] = None) -> None:
+        """Constructor."""
+        self.grace_seconds = get_drain_seconds() if grace_seconds is None else grace_seconds
+        self.max_requests: Optional[int] = None
+        self._requests = 0
+        self._deadline: Optional[float] = None
+        self._active = 0
+        self._drained = 0
+        self._aborted = 0
+        self._pending: Set[asyncio.Future] = set()
+
+    @property
+    def draining(self) -> bool:
+        """True if the worker does not accept new streams anymore."""
+        return self._deadline is not None
+
+    def configure(self, max_requests: Optional[int] = None, grace_seconds: Optional[float] = None) -> None:
+        """
+        Configure the drain for the current worker.
+
+        :param max_requests: The number of requests after which the worker is recycled.
+        :param grace_seconds: The number of seconds active streams may run after the drain begins.
+        """
+        if max_requests is not None and max_requests < sys.maxsize:
+            self.max_requests = max_requests
+        if grace_seconds is not None:
+            self.grace_seconds = grace_seconds
+
+    def begin(self, reason: str) -> None:
+        """
+        Start draining, if it was not started yet.
+
+        :param reason: The reason of the drain, used for logging.
+        """
+        if self.draining:
+            return
+        self._deadline = time.monotonic() + self.grace_seconds
+        logger.info(
+            f"Draining worker {os.getpid()} ({reason}): {self._active} active stream(s), "
+            f"grace period {self.grace_seconds}s")
+
+    def count_request(self) -> None:
+        """Count a request and begin the drain when the worker reaches max_requests."""
+        self._requests += 1
+        if self.max_requests is not None and self._requests >= self.max_requests:
+            self.begin("max_requests reached")
+
+    def expired(self) -> bool:
+        """True if the grace deadline has passed and active streams must be stopped."""
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[TrackedStream]:
+        """
+        Track one stream for the duration of the context.
+
+        The stream is counted as aborted if it was cancelled, closed or marked as aborted,
+        and as drained if it completed normally while the drain was in progress.
+        """
+        stream = TrackedStream()
+        self._active += 1
+        try:
+            yield stream
+        except (asyncio.CancelledError, GeneratorExit):
+            stream.aborted = True
+            raise
+        finally:
+            self._active -= 1
+            if self.draining:
+                if stream.aborted:
+                    self._aborted += 1
+                else:
+                    self._drained += 1
+
+    async def flush(self, write: Awaitable[Any]) -> None:
+        """
+        Run the metadata write so that the cancellation of the stream does not interrupt it.
+
+        :param write: The awaitable performing the write.
+        """
+        task = asyncio.ensure_future(write)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Let the write land before the caller closes the client it uses.
+            await asyncio.wait({task}, timeout=StreamDrain.FLUSH_TIMEOUT)
+            raise
+
+    def install_signal_handler(self) -> None:
+        """Begin the drain on SIGTERM, then hand the signal over to the server's handler."""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handler(sig, frame):
+            self.begin("SIGTERM")
+            if callable(previous):
+                previous(sig, frame)
+
+        signal.signal(signal.SIGTERM, handler)
+
+    async def wait(self) -> Dict[str, int]:
+        """
+        Wait for the active streams up to the grace deadline and flush the pending writes.
+
+        :return: The number of drained and aborted streams.
+        """
+        self.begin("shutdown")
+        while self._active and not self.expired():
+            await asyncio.sleep(0.1)
+        if self._pending:
+            await asyncio.wait(set(self._pending), timeout=StreamDrain.FLUSH_TIMEOUT)
+        report = {
+            "drained": self._drained,
+            "aborted": self._aborted + self._active,
+            "pending_writes": len(self._pending),
+        }
+        logger.info(
+            f"Worker {os.getpid()} drained: {report['drained']} stream(s) completed, "
+            f"{report['aborted']} aborted, {report['pending_writes']} metadata write(s) not flushed")
+        return report
+
+
+class StreamDrainMiddleware:
+    """
+    The ASGI middleware counting requests and refusing new streams while the worker drains.
+
+    The refused requests get 503 with Retry-After, so that the client retries on another worker.
+
+    :param app: The ASGI application.
+    :param drain: The drain of the worker.
+    :param stream_paths: The paths which start a stream.
+    """
+
+    def __init__(self, app: Any, drain: StreamDrain, stream_paths: Iterable[str] = ("/chat",)) -> None:
+        """Constructor."""
+        self.app = app
+        self.drain = drain
+        self.stream_paths = frozenset(stream_paths)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            if self.drain.draining and scope["path"] in self.stream_paths:
+                response = JSONResponse(
+                    status_code=503,
+                    content={"detail": "The server is restarting, please retry."},
+                    headers={"Retry-After": "1", "Connection": "close"})
+                await response(scope, receive, send)
+                return
+            self.drain.count_request()
+        await self.app(scope, receive, send)
+
+
+# The drain of the current worker process.
+stream_drain = StreamDrain()
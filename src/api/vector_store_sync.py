@@ -0,0 +1,146 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from openai import AsyncOpenAI, NotFoundError
+from util import file_sha256
+
+logger = logging.getLogger("azureaiapp")
+
+
+class VectorStoreSync:
+    """
+    Keep the vector store used by file search in sync with the local files.
+
+    The manifest file maps the path of every uploaded file, relative to the root
+    directory, to its content hash and file id, together with the id of the vector store. On rebuild the existing vector store
+    is reused, only the added or changed files are uploaded and the files removed
+    locally are deleted from the store.
+
+    :param openai_client: The OpenAI client of the project.
+    :param manifest_file: The path to the JSON manifest.
+    :param root_directory: The directory, the file paths in the manifest are relative to;
+                           the current directory by default.
+    :param max_concurrency: The maximal number of files uploaded at the same time.
+    """
+
+    def __init__(
+            self,
+            openai_client: AsyncOpenAI,
+            manifest_file: str,
+            root_directory: Optional[str] = None,
+            max_concurrency: int = 4
+        ) -> None:
+        """Constructor."""
+        self._client = openai_client
+        self._manifest_file = manifest_file
+        self._root_directory = root_directory or os.curdir
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _load_manifest(self) -> Dict:
+        """Load the manifest or return the empty one if it is absent or broken."""
+        try:
+            with open(self._manifest_file) as fp:
+                manifest = json.load(fp)
+            if isinstance(manifest.get("files"), dict):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {"vector_store_id": None, "files": {}}
+
+    def _save_manifest(self, manifest: Dict) -> None:
+        """Atomically replace the manifest."""
+        os.makedirs(os.path.dirname(os.path.abspath(self._manifest_file)), exist_ok=True)
+        tmp_file = self._manifest_file + ".tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+        os.replace(tmp_file, self._manifest_file)
+
+    async def _get_store_files(self, vector_store_id: Optional[str]) -> Optional[Dict[str, str]]:
+        """
+        Get the files of the vector store.
+
+        :param vector_store_id: The id of the vector store from the manifest.
+        :return: The mapping of file ids to their statuses or None if the store does not exist.
+        """
+        if not vector_store_id:
+            return None
+        try:
+            await self._client.vector_stores.retrieve(vector_store_id)
+            return {f.id: f.status async for f in self._client.vector_stores.files.list(vector_store_id)}
+        except NotFoundError:
+            logger.info(f"Vector store {vector_store_id} from the manifest was not found.")
+            return None
+
+    async def _upload(self, vector_store_id: str, file_path: str) -> str:
+        """Upload one file, streaming it from disk, and return its file id."""
+        async with self._semaphore:
+            with open(file_path, "rb") as fp:
+                vector_file = await self._client.vector_stores.files.upload_and_poll(
+                    vector_store_id=vector_store_id, file=fp)
+        if vector_file.status != "completed":
+            raise RuntimeError(f"Upload of {file_path} to the vector store finished with status {vector_file.status}.")
+        return vector_file.id
+
+    async def _delete(self, vector_store_id: str, file_id: str) -> None:
+        """Remove the file from the vector store and delete the file itself."""
+        async with self._semaphore:
+            try:
+                await self._client.vector_stores.files.delete(file_id, vector_store_id=vector_store_id)
+                await self._client.files.delete(file_id)
+            except NotFoundError:
+                pass
+
+    async def sync(self, file_paths: List[str]) -> str:
+        """
+        Bring the vector store up to date with the files.
+
+        :param file_paths: The paths of the files, which must be searchable.
+        :return: The id of the vector store.
+        """
+        manifest = self._load_manifest()
+        store_files = await self._get_store_files(manifest["vector_store_id"])
+        if store_files is None:
+            vector_store = await self._client.vector_stores.create()
+            manifest = {"vector_store_id": vector_store.id, "files": {}}
+            store_files = {}
+        vector_store_id = manifest["vector_store_id"]
+
+        # The files with the same name in the different directories are different entries.
+        local = {
+            os.path.relpath(path, self._root_directory).replace(os.sep, '/'): (path, file_sha256(path))
+            for path in file_paths}
+        known: Dict[str, Dict[str, str]] = manifest["files"]
+        to_upload = [
+            name for name, (_, sha) in local.items()
+            if name not in known
+            or known[name]["sha256"] != sha
+            or store_files.get(known[name]["file_id"]) != "completed"]
+        to_delete = [
+            known[name]["file_id"] for name in known
+            if name not in local or name in to_upload]
+
+        await asyncio.gather(*(self._delete(vector_store_id, file_id) for file_id in to_delete))
+        for name in known.keys() - local.keys():
+            del known[name]
+
+        file_ids = await asyncio.gather(
+            *(self._upload(vector_store_id, local[name][0]) for name in to_upload), return_exceptions=True)
+        errors = [file_id for file_id in file_ids if isinstance(file_id, BaseException)]
+        for name, file_id in zip(to_upload, file_ids):
+            if not isinstance(file_id, BaseException):
+                known[name] = {"sha256": local[name][1], "file_id": file_id}
+        # Save the successful uploads, so that the next run does not repeat them.
+        self._save_manifest(manifest)
+        if errors:
+            raise errors[0]
+
+        logger.info(
+            f"Vector store {vector_store_id} synchronized: {len(to_upload)} file(s) uploaded, "
+            f"{len(to_delete)} deleted, {len(local) - len(to_upload)} unchanged.")
+        return vector_store_id
@@ -28,6 +28,11 @@ from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from logging_config import configure_logging
 from util import get_env_file_path
+from startup_pipeline import StartupPipeline
+from api.agent_index import copy_agent, get_search_index_name
+from api.customer_lookup import has_function_tool
+from api.stream_drain import get_drain_seconds
+from api.vector_store_sync import VectorStoreSync
 
 # Load environment variables from azd environment folder for local development
 env_file = get_env_file_path()
@@ -53,18 +58,24 @@ FILES_NAMES = list_files_in_files_directory()
 
 
 async def create_index_maybe(
-        ai_client: AIProjectClient, creds: AsyncTokenCredential) -> None:
+        ai_client: AIProjectClient, creds: AsyncTokenCredential) -> Optional[str]:
     """
     Create the index and upload documents if the index does not exist.
 
     This code is executed only once, when called on_starting hook is being
     called. This code ensures that the index is being populated only once.
     rag.create_index return True if the index was created, meaning that this
-    docker node have started first and must populate index.
+    docker node have started first and must populate index. If the index
+    already exists, the number of its documents is verified and the upload
+    is resumed when the index was populated partially, unless the files are
+    kept in sync by api.index_watcher. If the index was rebuilt
+    with SearchIndexManager.rebuild_index, its active version is used.
 
     :param ai_client: The project client to be used to create an index.
     :param creds: The credentials, used for the index.
+    :return: The name of the active index or None if it was not created.
     """
+    from api.index_watcher import DEFAULT_MANIFEST_FILE
     from api.search_index_manager import SearchIndexManager
     endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
     embedding = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME')    
@@ -74,13 +85,21 @@ async def create_index_maybe(
                 connection_type=ConnectionType.AZURE_OPEN_AI, include_credentials=True)
         except ValueError as e:
             logger.error("Error creating index: {e}")
-            return
+            return None
         
         embed_api_key = None
         if aoai_connection.credentials and isinstance(aoai_connection.credentials, ApiKeyCredentials):
             embed_api_key = aoai_connection.credentials.api_key
 
-        search_mgr = SearchIndexManager(
+        # Prefer the binary embeddings, converted by api.embeddings_store, if present.
+        embeddings_path = os.path.join(
+            os.path.dirname(__file__), 'data', 'embeddings.npy')
+        if not os.path.exists(embeddings_path):
+            embeddings_path = os.path.join(
+                os.path.dirname(__file__), 'data', 'embeddings.csv')
+        assert embeddings_path, f'File {embeddings_path} not found.'
+        # The index and search clients share the connections and are closed on any exit.
+        async with SearchIndexManager(
             endpoint=endpoint,
             credential=creds,
             index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
@@ -89,18 +108,24 @@ async def create_index_maybe(
             deployment_name=embedding,
             embedding_endpoint=aoai_connection.target,
             embed_api_key=embed_api_key
-        )
-        # If another application instance already have created the index,
-        # do not upload the documents.
-        if await search_mgr.create_index(
-            vector_index_dimensions=int(
-                os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
-            embeddings_path = os.path.join(
-                os.path.dirname(__file__), 'data', 'embeddings.csv')
-
-            assert embeddings_path, f'File {embeddings_path} not found.'
-            await search_mgr.upload_documents(embeddings_path)
-            await search_mgr.close()
+        ) as search_mgr:
+            index_name = await search_mgr.use_active_index()
+            checkpoint_path = SearchIndexManager.get_checkpoint_file(embeddings_path, index_name)
+            if await search_mgr.create_index(
+                vector_index_dimensions=int(
+                    os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
+                await search_mgr.upload_documents(
+                    embeddings_path, checkpoint_file=checkpoint_path)
+            elif os.path.exists(DEFAULT_MANIFEST_FILE):
+                # The documents of the files are kept in sync by api.index_watcher.
+                logger.info(f"Index {index_name} is maintained by the index watcher.")
+            else:
+                # The index exists, but its population may have been interrupted.
+                await search_mgr.ensure_documents(
+                    embeddings_path, checkpoint_file=checkpoint_path)
+            logger.info(f"Search index connections: {search_mgr.get_connection_stats()}")
+            return index_name
+    return None
 
 
 def _get_file_path(file_name: str) -> str:
@@ -130,7 +155,8 @@ async def get_available_tool(
     conn_id = os.environ.get('SEARCH_CONNECTION_ID')
     search_index_name = os.environ.get('AZURE_AI_SEARCH_INDEX_NAME')
     if search_index_name and conn_id:
-        await create_index_maybe(project_client, creds)
+        # The agent is pinned to the active version of the index.
+        search_index_name = await create_index_maybe(project_client, creds) or search_index_name
 
         return AzureAISearchAgentTool(
             azure_ai_search=AzureAISearchToolResource(indexes=[AISearchIndexResource( 
@@ -143,30 +169,58 @@ async def get_available_tool(
         logger.info(
             "agent: index was not initialized, falling back to file search.")
         
-        # Upload files for file search
-        file_streams = [open(_get_file_path(file_name), "rb") for file_name in FILES_NAMES]
-
+        # Upload the new and changed files for file search
+        manifest_file = os.path.join(
+            os.path.dirname(__file__), 'data', 'vector_store_manifest.json')
+        vector_store_sync = VectorStoreSync(
+            openai_client, manifest_file, os.path.join(os.path.dirname(__file__), 'files'))
         try:
-            vector_store = await openai_client.vector_stores.create()
-            await openai_client.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=vector_store.id, files=file_streams
-            )
-            logger.info(f"File uploaded to vector store (id: {vector_store.id})")
+            vector_store_id = await vector_store_sync.sync(
+                [_get_file_path(file_name) for file_name in FILES_NAMES])
+            logger.info(f"File uploaded to vector store (id: {vector_store_id})")
         except FileNotFoundError:
             logger.warning(f"Asset file not found.")
             logger.info("Creating vector store without file for demonstration...")
+            vector_store_id = (await openai_client.vector_stores.create()).id
 
 
         logger.info("agent: file store and vector store success")
 
-        return FileSearchTool(vector_store_ids=[vector_store.id])
+        return FileSearchTool(vector_store_ids=[vector_store_id])
+
+
+LOOKUP_INSTRUCTIONS = (
+    "For the questions about a customer or an order, given by the customer id, "
+    "e-mail or order number, use the lookup_customer function."
+)
+
+
+async def get_lookup_tools() -> List[Tool]:
+    """
+    Get the function tools, which answer the structured questions without the search.
+
+    The customer records are indexed by their keys once, before the workers start.
+
+    :return: The lookup tools, empty if there are no customer files.
+    """
+    from api.customer_lookup import get_function_tool, get_store
+    try:
+        if not len(await asyncio.to_thread(get_store)):
+            return []
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unable to index the customer records: {e}")
+        return []
+    return [get_function_tool()]
 
 
 async def create_agent(ai_project: AIProjectClient,
                        openai_client: AsyncOpenAI,
-                       creds: AsyncTokenCredential) -> AgentVersionObject:
+                       creds: AsyncTokenCredential,
+                       tool: Optional[Tool] = None,
+                       lookup_tools: Optional[List[Tool]] = None) -> AgentVersionObject:
     logger.info("Creating new agent with resources")
-    tool = await get_available_tool(ai_project, openai_client, creds)
+    if tool is None:
+        tool = await get_available_tool(ai_project, openai_client, creds)
 
     instructions = "Use File Search always with citations.  Avoid to use base knowledge."
     
@@ -177,27 +231,32 @@ async def create_agent(ai_project: AIProjectClient,
             "Avoid to use base knowledge."
         )
 
+    if lookup_tools is None:
+        lookup_tools = await get_lookup_tools()
+    if lookup_tools:
+        instructions += " " + LOOKUP_INSTRUCTIONS
+
     agent = await ai_project.agents.create_version(
         agent_name=os.environ["AZURE_AI_AGENT_NAME"],
         definition=PromptAgentDefinition(
             model=os.environ["AZURE_AI_AGENT_DEPLOYMENT_NAME"],
             instructions=instructions,
-            tools=[tool],
+            tools=[tool, *lookup_tools],
         ),
     )
     return agent
 
 
-async def initialize_eval(project_client: AIProjectClient, openai_client: AsyncOpenAI, agent_obj: AgentVersionObject, credential: AsyncTokenCredential):
-    eval_rule_id = f"eval-rule-for-{agent_obj.name}"
+async def initialize_eval(project_client: AIProjectClient, openai_client: AsyncOpenAI, agent_name: str, credential: AsyncTokenCredential):
+    eval_rule_id = f"eval-rule-for-{agent_name}"
     try:
         eval_rules = project_client.evaluation_rules.list(
             action_type=EvaluationRuleActionType.CONTINUOUS_EVALUATION,
-            agent_name=agent_obj.name)
+            agent_name=agent_name)
         rules_list = [rule async for rule in eval_rules]
 
         if len(rules_list) >= 1:
-            logger.info(f"Continuous Evaluation Rule for agent {agent_obj.name} already exists")
+            logger.info(f"Continuous Evaluation Rule for agent {agent_name} already exists")
         else:
             # Create an evaluation with testing criteria
             data_source_config = {"type": "azure_ai_source", "scenario": "responses"}
@@ -209,7 +268,7 @@ async def initialize_eval(project_client: AIProjectClient, openai_client: AsyncO
                 }
             ]
             eval_object = await openai_client.evals.create(
-                name=f"{agent_obj.name} Continuous Evaluation",
+                name=f"{agent_name} Continuous Evaluation",
                 data_source_config=data_source_config,  # type: ignore
                 testing_criteria=testing_criteria,  # type: ignore
             )
@@ -219,13 +278,13 @@ async def initialize_eval(project_client: AIProjectClient, openai_client: AsyncO
             continuous_eval_rule = await project_client.evaluation_rules.create_or_update(
                 id=eval_rule_id,
                 evaluation_rule=EvaluationRule(
-                    display_name=f"{agent_obj.name} Continuous Eval Rule",
+                    display_name=f"{agent_name} Continuous Eval Rule",
                     description="An eval rule that runs on agent response completions",
                     action=ContinuousEvaluationRuleAction(
                         eval_id=eval_object.id, # link to evaluation created above
                         max_hourly_runs=5), # set max eval run limit per hour
                     event_type=EvaluationRuleEventType.RESPONSE_COMPLETED,
-                    filter=EvaluationRuleFilter(agent_name=agent_obj.name),
+                    filter=EvaluationRuleFilter(agent_name=agent_name),
                     enabled=True,
                 ),
             )
@@ -236,6 +295,14 @@ async def initialize_eval(project_client: AIProjectClient, openai_client: AsyncO
         logger.error(f"Error creating Continuous Evaluation Rule: {e}", exc_info=True)
 
 async def initialize_resources():
+    """
+    Find or create the agent and its continuous evaluation rule.
+
+    The steps are run as a dependency graph: the agent lookups, the search tool
+    and the lookup tools are prepared concurrently. The agent step waits for all of
+    them, while the evaluation rule, which targets the agent by name, is set up as
+    soon as the lookups have found the name.
+    """
     proj_endpoint = os.environ.get("AZURE_EXISTING_AIPROJECT_ENDPOINT")
     try:
         async with (
@@ -243,42 +310,93 @@ async def initialize_resources():
             AIProjectClient(endpoint=proj_endpoint, credential=credential) as project_client,
             project_client.get_openai_client() as openai_client,
         ):
-            agent_obj: Optional[AgentVersionObject] = None
-
             agentID = os.environ.get("AZURE_EXISTING_AGENT_ID")
 
-            if agentID:
+            async def get_agent_by_id() -> Optional[AgentVersionObject]:
+                if not agentID:
+                    logger.info("No existing agent ID found.")
+                    return None
                 try:
                     agent_name = agentID.split(":")[0]
                     agent_version = agentID.split(":")[1]
                     agent_obj = await project_client.agents.get_version(agent_name, agent_version)
                     logger.info(f"Found agent by ID: {agent_obj.id}")
+                    return agent_obj
                 except Exception as e:
                     logger.warning(
                         "Could not retrieve agent by AZURE_EXISTING_AGENT_ID = "
                         f"{agentID}, error: {e}")
-            else:
-                logger.info("No existing agent ID found.")
+                    return None
 
             # Check if an agent with the same name already exists
-            if not agent_obj:
+            async def get_agent_by_name() -> Optional[AgentVersionObject]:
+                agent_name = os.environ.get("AZURE_AI_AGENT_NAME")
                 try:
-                    agent_name = os.environ["AZURE_AI_AGENT_NAME"]
                     logger.info(f"Retrieving agent by name: {agent_name}")
                     agents = await project_client.agents.get(agent_name)
                     agent_obj = agents.versions.latest
                     logger.info(f"Agent with agent id, {agent_obj.id} retrieved.")
+                    return agent_obj
                 except Exception as e:
                     logger.info(f"Agent name, {agent_name} not found.")
-                    
-            # Create a new agent
-            if not agent_obj:
-                agent_obj = await create_agent(project_client, openai_client, credential)
-                logger.info(f"Created agent, agent ID: {agent_obj.id}")
-
-            os.environ["AZURE_EXISTING_AGENT_ID"] = agent_obj.id
-
-            await initialize_eval(project_client, openai_client, agent_obj, credential)
+                    return None
+
+            async def get_search_tool() -> Tool:
+                return await get_available_tool(project_client, openai_client, credential)
+
+            async def get_or_create_agent(
+                    by_id: Optional[AgentVersionObject],
+                    by_name: Optional[AgentVersionObject],
+                    search_tool: Tool,
+                    lookup_tools: List[Tool]) -> AgentVersionObject:
+                agent_obj = by_id or by_name
+                if not agent_obj:
+                    agent_obj = await create_agent(
+                        project_client, openai_client, credential, search_tool, lookup_tools)
+                    logger.info(f"Created agent, agent ID: {agent_obj.id}")
+                else:
+                    # Follow the switch of the index, rebuilt by SearchIndexManager.rebuild_index.
+                    index_name = None
+                    pinned_index = get_search_index_name(agent_obj)
+                    if isinstance(search_tool, AzureAISearchAgentTool) and pinned_index is not None:
+                        active_index = search_tool.azure_ai_search.indexes[0].index_name
+                        if active_index != pinned_index:
+                            logger.info(f"The index was switched from {pinned_index} to {active_index}, updating the agent.")
+                            index_name = active_index
+                    # The agents, created before the customer lookup, get the function tool,
+                    # but the agent, chosen by AZURE_EXISTING_AGENT_ID, is kept as configured.
+                    tools = [] if by_id or has_function_tool(agent_obj) else lookup_tools
+                    if tools:
+                        logger.info("The agent has no lookup function, updating the agent.")
+                    # The new version keeps the custom instructions, model and tools of the agent.
+                    if index_name or tools:
+                        agent_obj = await copy_agent(
+                            project_client, agent_obj, index_name, tools,
+                            LOOKUP_INSTRUCTIONS if tools else None)
+                os.environ["AZURE_EXISTING_AGENT_ID"] = agent_obj.id
+                return agent_obj
+
+            async def setup_eval(
+                    by_id: Optional[AgentVersionObject],
+                    by_name: Optional[AgentVersionObject]) -> None:
+                # The rule targets the agent by name, so it does not wait for the agent to be created.
+                agent_obj = by_id or by_name
+                agent_name = agent_obj.name if agent_obj else os.environ.get("AZURE_AI_AGENT_NAME")
+                if not agent_name:
+                    logger.warning("Agent name is unknown, skipping the Continuous Evaluation Rule.")
+                    return
+                await initialize_eval(project_client, openai_client, agent_name, credential)
+
+            pipeline = StartupPipeline(logger)
+            pipeline.add_step("agent_by_id", get_agent_by_id)
+            pipeline.add_step("agent_by_name", get_agent_by_name)
+            pipeline.add_step("search_tool", get_search_tool)
+            pipeline.add_step("lookup_tools", get_lookup_tools)
+            pipeline.add_step(
+                "agent", get_or_create_agent,
+                depends_on=["agent_by_id", "agent_by_name", "search_tool", "lookup_tools"])
+            pipeline.add_step("eval", setup_eval, depends_on=["agent_by_id", "agent_by_name"])
+            await pipeline.run()
     except Exception as e:
         logger.info("Error creating agent: {e}", exc_info=True)
         raise RuntimeError(f"Failed to create the agent: {e}")  
@@ -289,8 +407,25 @@ def on_starting(server):
     asyncio.get_event_loop().run_until_complete(initialize_resources())
 
 
+def post_worker_init(worker):
+    """
+    Configure the stream drain of the worker.
+
+    The drain begins when the worker reaches its max_requests (including the jitter)
+    or receives SIGTERM. Uvicorn cancels the streams, which are still running
+    after the grace period, before gunicorn kills the worker.
+    """
+    from api.stream_drain import stream_drain
+    stream_drain.configure(max_requests=worker.max_requests, grace_seconds=stream_drain_seconds)
+    if hasattr(worker, "config"):
+        worker.config.timeout_graceful_shutdown = stream_drain_seconds + 5
+
+
 max_requests = 1000
 max_requests_jitter = 50
+# In-flight /chat streams are allowed to finish during this period on worker recycle or SIGTERM.
+stream_drain_seconds = get_drain_seconds()
+graceful_timeout = stream_drain_seconds + 15
 log_file = "-"
 bind = "0.0.0.0:50505"
 
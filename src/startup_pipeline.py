@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Sequence
+
+
+@dataclass
+class _Step:
+    """The step of the startup pipeline."""
+    name: str
+    func: Callable[..., Awaitable[Any]]
+    depends_on: Sequence[str]
+    start: float = 0.0
+    end: float = 0.0
+    result: Any = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class StartupPipeline:
+    """
+    A small asynchronous dependency graph of the startup steps.
+
+    Every step starts as soon as all the steps it depends on are finished, so the
+    independent steps run concurrently. Each step receives the results of its
+    dependencies as positional arguments, in the order they were declared.
+    After the run, the duration of each step and the critical path are logged.
+
+    :param logger: The logger used to report the timings.
+    """
+    logger: logging.Logger
+    _steps: Dict[str, _Step] = field(default_factory=dict)
+
+    def add_step(
+            self,
+            name: str,
+            func: Callable[..., Awaitable[Any]],
+            depends_on: Sequence[str] = ()
+            ) -> None:
+        """
+        Add the step to the pipeline.
+
+        :param name: The unique name of the step.
+        :param func: The coroutine function, performing the step.
+        :param depends_on: The names of the steps, which must finish before this step starts.
+        :raises: ValueError if the name is not unique or the dependency was not added before.
+        """
+        if name in self._steps:
+            raise ValueError(f"The step {name} was already added.")
+        for dependency in depends_on:
+            if dependency not in self._steps:
+                raise ValueError(f"The step {name} depends on the unknown step {dependency}.")
+        self._steps[name] = _Step(name=name, func=func, depends_on=tuple(depends_on))
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        Run all the steps.
+
+        :return: The dictionary with the results of the steps.
+        """
+        tasks: Dict[str, asyncio.Future] = {}
+        origin = time.perf_counter()
+
+        async def run_step(step: _Step) -> Any:
+            args = [await tasks[dependency] for dependency in step.depends_on]
+            step.start = time.perf_counter() - origin
+            try:
+                step.result = await step.func(*args)
+            finally:
+                step.end = time.perf_counter() - origin
+            return step.result
+
+        # Dependencies are always added before the dependent steps.
+        for step in self._steps.values():
+            tasks[step.name] = asyncio.ensure_future(run_step(step))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        self._report()
+        return {name: step.result for name, step in self._steps.items()}
+
+    def critical_path(self) -> List[str]:
+        """
+        Get the chain of steps, which determined the total duration of the pipeline.
+
+        :return: The names of the steps, from the first to the last one.
+        """
+        if not self._steps:
+            return []
+        step = max(self._steps.values(), key=lambda s: s.end)
+        path = [step.name]
+        while step.depends_on:
+            step = max((self._steps[d] for d in step.depends_on), key=lambda s: s.end)
+            path.append(step.name)
+        return path[::-1]
+
+    def _report(self) -> None:
+        """Log the timings of the steps and the critical path."""
+        for step in self._steps.values():
+            self.logger.info(
+                f"Startup step {step.name}: {step.duration:.2f}s "
+                f"(started at {step.start:.2f}s, finished at {step.end:.2f}s)")
+        path = self.critical_path()
+        total = max(step.end for step in self._steps.values())
+        serial = sum(step.duration for step in self._steps.values())
+        self.logger.info(
+            f"Startup critical path: {' -> '.join(path)}, {total:.2f}s "
+            f"(the steps would take {serial:.2f}s if run serially)")
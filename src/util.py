@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
-import os, json, base64
+import os, json, base64, hashlib
 from enum import IntEnum
 from typing import Dict
 from dataclasses import dataclass, field
@@ -54,6 +54,21 @@ def get_env_file_path():
         return None
     
 
+def file_sha256(file_path: str, chunk_size: int = 1 << 16) -> str:
+    """
+    Calculate the content hash of the file without loading it into memory.
+
+    :param file_path: The path to the file.
+    :param chunk_size: The size of the chunks the file is read with.
+    :return: The hex digest of the SHA-256 of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 # Constants
 DEFAULT_NS_TYPE = "Microsoft.CognitiveServices"
 DELIM = ","
@@ -0,0 +1,74 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+from types import SimpleNamespace
+
+from azure.ai.projects.models import (
+    AISearchIndexResource,
+    AzureAISearchAgentTool,
+    AzureAISearchToolResource,
+    PromptAgentDefinition,
+)
+
+from api.agent_index import copy_agent, get_search_index_name, repin_agent
+from api.customer_lookup import get_function_tool, has_function_tool
+
+
+class FakeAgents:
+    """The agents operations, which keep the versions of one agent."""
+
+    def __init__(self, definition):
+        self.versions = [SimpleNamespace(id="agent:1", name="agent", definition=definition)]
+
+    async def get(self, agent_name):
+        return SimpleNamespace(versions=SimpleNamespace(latest=self.versions[-1]))
+
+    async def create_version(self, agent_name, definition):
+        agent_obj = SimpleNamespace(id=f"{agent_name}:{len(self.versions) + 1}", name=agent_name, definition=definition)
+        self.versions.append(agent_obj)
+        return agent_obj
+
+
+def _get_definition(index_name):
+    return PromptAgentDefinition(
+        model="custom-model",
+        instructions="The custom instructions.",
+        tools=[AzureAISearchAgentTool(
+            azure_ai_search=AzureAISearchToolResource(indexes=[AISearchIndexResource(
+                project_connection_id="connection",
+                index_name=index_name,
+                query_type="simple"
+            )])
+        )],
+    )
+
+
+def test_repinned_agent_keeps_its_definition():
+    project_client = SimpleNamespace(agents=FakeAgents(_get_definition("index-v1")))
+
+    new_agent = asyncio.run(repin_agent(project_client, "agent", "index-v2"))
+
+    old_agent = project_client.agents.versions[0]
+    assert new_agent.id == "agent:2"
+    assert get_search_index_name(new_agent) == "index-v2"
+    assert get_search_index_name(old_agent) == "index-v1"
+    assert new_agent.definition.model == "custom-model"
+    assert new_agent.definition.instructions == "The custom instructions."
+    # The agent, which already searches the index, is not updated.
+    assert asyncio.run(repin_agent(project_client, "agent", "index-v2")) is None
+    assert len(project_client.agents.versions) == 2
+
+
+def test_copied_agent_gets_the_tools_appended():
+    project_client = SimpleNamespace(agents=FakeAgents(_get_definition("index-v1")))
+    agent_obj = project_client.agents.versions[0]
+
+    new_agent = asyncio.run(copy_agent(project_client, agent_obj, tools=[get_function_tool()], instructions="Look up."))
+
+    assert has_function_tool(new_agent) and not has_function_tool(agent_obj)
+    assert get_search_index_name(new_agent) == "index-v1"
+    assert new_agent.definition.model == "custom-model"
+    assert new_agent.definition.instructions == "The custom instructions. Look up."
@@ -0,0 +1,94 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import json
+import time
+
+from api import chunking
+
+
+def _split_sentences(line):
+    return [sentence.strip(" .") for sentence in line.split(". ") if sentence.strip(" .")]
+
+
+async def _collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_files_are_chunked_in_order_across_processes(tmp_path, monkeypatch):
+    # The forked workers inherit the tokenizer, so nltk is not needed.
+    monkeypatch.setattr(chunking, "_sent_tokenize", _split_sentences)
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "a.md").write_text("First tent. Second tent. Third tent.\n---\n")
+    (tmp_path / "nested" / "b.md").write_text("Hiking boots are great. They are light.\n")
+    (tmp_path / "c.json").write_text(json.dumps({"name": "John Smith", "orders": [{"item": "Tent"}]}))
+
+    chunks = asyncio.run(_collect(chunking.iter_chunks(
+        str(tmp_path), sentences_per_embedding=2, max_workers=2, max_pending=1)))
+
+    assert chunks == [
+        ("First tent Second tent", "a.md"),
+        ("Third tent", "a.md"),
+        ("name: John Smith orders.item: Tent", "c.json"),
+        ("Hiking boots are great They are light", "b.md"),
+    ]
+
+
+def _slow_split_sentences(line):
+    if "slow" in line:
+        time.sleep(1)
+    return _split_sentences(line)
+
+
+def test_closing_chunks_early_does_not_wait_for_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunking, "_sent_tokenize", _slow_split_sentences)
+    (tmp_path / "a.md").write_text("The tent is light.\n")
+    (tmp_path / "b.md").write_text("The slow file.\n")
+
+    async def main():
+        chunks = chunking.iter_chunks(str(tmp_path), sentences_per_embedding=1, max_workers=2)
+        first = await chunks.__anext__()
+        start = time.perf_counter()
+        await chunks.aclose()
+        return first, time.perf_counter() - start
+
+    first, elapsed = asyncio.run(main())
+
+    assert first == ("The tent is light", "a.md")
+    # The worker, still chunking the slow file, is not waited for.
+    assert elapsed < 0.5
+
+
+def test_near_duplicate_chunks_are_dropped_with_their_titles_kept():
+    boilerplate = "Return policy: all products can be returned within 30 days of purchase with the receipt"
+    chunks = [
+        ("The TrailMaster X4 Tent is a durable tent for four people", "product_info_1.md"),
+        (boilerplate, "product_info_1.md"),
+        ("The Alpine Explorer Tent is a robust tent for eight people", "product_info_8.md"),
+        (boilerplate + ".", "product_info_8.md"),
+        (boilerplate.replace("30", "thirty"), "product_info_9.md"),
+    ]
+    stats = {}
+    read = []
+
+    async def source():
+        for chunk in chunks:
+            read.append(chunk)
+            yield chunk
+
+    async def main():
+        return [chunk async for chunk in chunking.deduplicate_chunks(source(), 0.6, stats)]
+
+    unique = asyncio.run(main())
+
+    assert len(read) == 5
+    # The kept chunk cites every file, it was found in.
+    assert unique == [
+        chunks[0],
+        (boilerplate, "product_info_1.md; product_info_8.md; product_info_9.md"),
+        chunks[2],
+    ]
+    assert stats == {"chunks": 5, "unique": 3}
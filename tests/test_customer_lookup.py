@@ -0,0 +1,66 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import json
+import os
+import shutil
+import time
+
+from api import customer_lookup
+from api.customer_lookup import DEFAULT_INPUT_DIRECTORY, CustomerStore, call_function, get_store
+
+
+def test_customers_are_found_by_exact_keys(tmp_path):
+    input_directory = tmp_path / "files"
+    shutil.copytree(DEFAULT_INPUT_DIRECTORY, input_directory)
+    store_file = str(tmp_path / "customer_store.json")
+    store = CustomerStore.load_or_build(store_file, str(input_directory))
+
+    assert len(store) == 12
+    assert [r["id"] for r in store.lookup(customer_id="7")] == ["7"]
+    assert [r["id"] for r in store.lookup(email=" JohnSmith@Example.com")] == ["1"]
+    found = store.lookup(order_id="029")
+    assert [(r["id"], [o["id"] for o in r["orders"]]) for r in found] == [("1", [29])]
+    assert "description" not in found[0]["orders"][0]
+    assert store.lookup(customer_id="7", order_id="29") == []
+
+    # The store is rebuilt when a customer file changes.
+    path = input_directory / "customer_info_7.json"
+    record = json.loads(path.read_text())
+    record["email"] = "jason@example.com"
+    path.write_text(json.dumps(record))
+    assert [r["id"] for r in CustomerStore.load_or_build(store_file, str(input_directory)).lookup(
+        email="jason@example.com")] == ["7"]
+
+
+def test_function_call_output(monkeypatch):
+    store = CustomerStore.build([os.path.join(DEFAULT_INPUT_DIRECTORY, "customer_info_7.json")])
+    monkeypatch.setattr(customer_lookup, "get_store", lambda: store)
+
+    def call(name, arguments):
+        return json.loads(asyncio.run(call_function(name, arguments)))
+
+    assert call("lookup_customer", '{"customer_id": "7"}')["customers"][0]["lastName"] == "Brown"
+    assert call("lookup_customer", '{"order_id": "1"}')["customers"] == []
+    assert "error" in call("lookup_customer", "not json")
+    assert "error" in call("unknown", "{}")
+
+
+def test_store_is_reloaded_when_files_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(customer_lookup, "_store", None)
+    input_directory = tmp_path / "files"
+    input_directory.mkdir()
+    shutil.copy(os.path.join(DEFAULT_INPUT_DIRECTORY, "customer_info_7.json"), input_directory)
+    store_file = str(tmp_path / "customer_store.json")
+
+    store = get_store(store_file, str(input_directory))
+    assert get_store(store_file, str(input_directory)) is store
+    path = input_directory / "customer_info_7.json"
+    record = json.loads(path.read_text())
+    record["email"] = "jason@example.com"
+    path.write_text(json.dumps(record))
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert [r["id"] for r in get_store(store_file, str(input_directory)).lookup(email="jason@example.com")] == ["7"]
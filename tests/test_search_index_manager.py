@@ -0,0 +1,879 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import csv
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from azure.core.exceptions import HttpResponseError
+
+from api.ann_index import IvfAlgorithmConfiguration, benchmark
+from api.dimension_reduction import evaluate, get_projection_file, reduce_embeddings
+from api.embeddings_store import convert_csv
+from api.keyword_index import KeywordIndex, tokenize
+from api.local_search_index import LocalSearchIndex
+from api.quantization import benchmark as quantization_benchmark
+from api.query_cache import QueryEmbeddingCache, SearchResultCache
+from api.search_index_manager import SearchIndexManager
+
+
+class FakeSearchClient:
+    """The in-memory stand-in for the async SearchClient."""
+
+    def __init__(self, documents, latency=0.05, visible_after=0):
+        self.documents = documents
+        self.latency = latency
+        self.visible_after = visible_after
+        self.searches = 0
+
+    async def search(self, **kwargs):
+        self.searches += 1
+        await asyncio.sleep(self.latency)
+        visible = self.documents if self.searches > self.visible_after else []
+
+        async def results():
+            for document in visible:
+                yield document
+        return results()
+
+    async def get_document_count(self):
+        return len(self.documents) if self.searches >= self.visible_after else 0
+
+
+def _get_manager(client: FakeSearchClient) -> SearchIndexManager:
+    manager = SearchIndexManager(
+        endpoint="https://search.example.com",
+        credential=None,
+        index_name="index",
+        dimensions=None,
+        model="model",
+        deployment_name="model",
+        embedding_endpoint="https://embed.example.com",
+        embed_api_key=None)
+    manager._index = SimpleNamespace(name="index")
+    manager._client = client
+    return manager
+
+
+DOCUMENTS = [{"token": "The TrailMaster X4 Tent", "title": "product_info_1.md", "embedId": "0"}]
+
+
+def test_concurrent_searches_do_not_serialize():
+    manager = _get_manager(FakeSearchClient(DOCUMENTS, latency=0.05))
+
+    async def run():
+        return await asyncio.gather(*(manager.search("tent") for _ in range(20)))
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    assert all(r == "The TrailMaster X4 Tent, source: product_info_1.md" for r in results)
+    # 20 serialized searches would take at least 1 second.
+    assert elapsed < 0.5
+
+
+def test_search_waits_for_settling_index():
+    client = FakeSearchClient(DOCUMENTS, latency=0.01, visible_after=1)
+    manager = _get_manager(client)
+
+    async def main():
+        # The probe is started by upload_documents.
+        manager._start_probe(len(DOCUMENTS))
+        return await manager.search("tent")
+
+    result = asyncio.run(main())
+
+    assert result == "The TrailMaster X4 Tent, source: product_info_1.md"
+    assert manager._ready
+
+
+def test_search_of_empty_index_does_not_wait(monkeypatch):
+    monkeypatch.setattr(SearchIndexManager, "READY_TIMEOUT", 0.5)
+    manager = _get_manager(FakeSearchClient([], latency=0.01))
+
+    start = time.perf_counter()
+    assert asyncio.run(manager.search("tent")) == ""
+    assert time.perf_counter() - start < 0.1
+
+    async def main():
+        # The probe after the upload times out once; the later queries do not wait.
+        manager._start_probe(1)
+        first = time.perf_counter()
+        await manager.search("tent")
+        second = time.perf_counter()
+        await manager.semantic_search("tent")
+        return second - first, time.perf_counter() - second
+
+    first, second = asyncio.run(main())
+    assert first >= 0.25
+    assert second < 0.1
+
+
+EMBEDDINGS_FILE = os.path.join(os.path.dirname(__file__), "..", "src", "api", "data", "embeddings.csv")
+
+
+class FakeEmbeddingClient:
+    """The embedding client, which returns the given vectors."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    async def embed(self, input, dimensions, model):
+        return {"data": [{"embedding": self.vectors[text]} for text in input]}
+
+
+def _read_embeddings():
+    with open(EMBEDDINGS_FILE, newline="") as fp:
+        return [(row["token"], row["title"], json.loads(row["embedding"])) for row in csv.DictReader(fp)]
+
+
+def test_local_search_matches_exact_cosine_ranking():
+    rows = _read_embeddings()
+    token, title, vector = rows[42]
+    index = LocalSearchIndex(
+        EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient({"query": vector}))
+
+    result = asyncio.run(index.search("query"))
+
+    assert result.split("\n------\n")[0] == f"{token}, source: {title}"
+
+    matrix = np.asarray([r[2] for r in rows], dtype=np.float64)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = matrix[[1, 7, 300]]
+    expected = np.argsort(-(queries @ matrix.T), axis=1)[:, :5]
+    indices, scores = index.search_vectors(queries, k=5)
+    assert (indices == expected).all()
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+
+def test_ivf_index_recall_against_exact_search(tmp_path):
+    rows = _read_embeddings()
+    vectors = {"query": rows[10][2]}
+    exact = LocalSearchIndex(EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient(vectors))
+    approximate = LocalSearchIndex(
+        EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient(vectors),
+        ann_directory=str(tmp_path / "ivf"), ann_config=IvfAlgorithmConfiguration(nprobe=16))
+
+    assert len(list((tmp_path / "ivf").glob("*/vectors.npy"))) == 1
+    assert asyncio.run(approximate.search("query")) == asyncio.run(exact.search("query"))
+    recall = [row["recall"] for row in benchmark(EMBEDDINGS_FILE, k=5, nprobes=(16,))]
+    assert recall[-1] >= 0.95
+
+
+def test_binary_embeddings_match_csv(tmp_path):
+    vectors_file = convert_csv(EMBEDDINGS_FILE, str(tmp_path / "embeddings.npy"))
+    csv_documents = list(SearchIndexManager._iter_documents(EMBEDDINGS_FILE))
+    binary_documents = list(SearchIndexManager._iter_documents(vectors_file))
+
+    assert [d["token"] for d in binary_documents] == [d["token"] for d in csv_documents]
+    assert [d["title"] for d in binary_documents] == [d["title"] for d in csv_documents]
+    assert np.allclose(
+        [d["embedding"] for d in binary_documents], [d["embedding"] for d in csv_documents], atol=1e-6)
+
+    vectors = {"query": _read_embeddings()[5][2]}
+    index = LocalSearchIndex(vectors_file, model="model", embedding_client=FakeEmbeddingClient(vectors))
+    assert isinstance(index._matrix, np.memmap)
+    expected = LocalSearchIndex(EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient(vectors))
+    assert asyncio.run(index.search("query")) == asyncio.run(expected.search("query"))
+
+
+def test_quantized_search_rescores_at_full_precision():
+    rows = _read_embeddings()
+    vectors = {"query": rows[10][2]}
+    exact = LocalSearchIndex(EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient(vectors))
+    quantized = LocalSearchIndex(
+        EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient(vectors), quantization="int8")
+
+    assert asyncio.run(quantized.search("query")) == asyncio.run(exact.search("query"))
+    report = {row["mode"]: row for row in quantization_benchmark(EMBEDDINGS_FILE, k=5)}
+    assert report["int8"]["recall"] >= 0.95
+    assert report["binary"]["recall"] >= 0.85
+    assert report["binary"]["memory_bytes"] < report["int8"]["memory_bytes"] < report["float32"]["memory_bytes"]
+
+
+def test_reduced_embeddings_search_with_projected_queries(tmp_path):
+    rows = _read_embeddings()
+    vectors_file = str(tmp_path / "embeddings.pca50.npy")
+    projection = reduce_embeddings(EMBEDDINGS_FILE, vectors_file, dimensions=50)
+    reduced = LocalSearchIndex(
+        vectors_file, model="model", embedding_client=FakeEmbeddingClient({"query": rows[42][2]}),
+        projection_file=get_projection_file(vectors_file))
+
+    assert projection.dimensions == 50
+    assert np.load(vectors_file).shape == (len(rows), 50)
+    assert asyncio.run(reduced.search("query")).split("\n------\n")[0] == f"{rows[42][0]}, source: {rows[42][1]}"
+    report = evaluate(EMBEDDINGS_FILE, dimensions=(50,))
+    assert [row["method"] for row in report] == ["full", "truncate", "pca"]
+    assert report[2]["recall"] > report[1]["recall"]
+
+
+def test_pca_rejects_more_dimensions_than_vectors(tmp_path):
+    small_file = tmp_path / "small.csv"
+    with open(EMBEDDINGS_FILE, newline="") as source, open(small_file, "w", newline="") as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        writer.writerows(row for _, row in zip(range(9), reader))
+    vectors_file = tmp_path / "small.pca32.npy"
+
+    try:
+        reduce_embeddings(str(small_file), str(vectors_file), dimensions=32)
+        assert False, "PCA of 9 vectors must not have 32 dimensions."
+    except ValueError:
+        pass
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["small.csv"]
+    assert reduce_embeddings(str(small_file), str(vectors_file), dimensions=9).dimensions == 9
+    assert reduce_embeddings(str(small_file), str(vectors_file), dimensions=32, method="truncate").dimensions == 32
+
+
+def test_keyword_index_ranks_by_bm25_and_fuses_with_vectors(tmp_path):
+    rows = _read_embeddings()
+    chunks = [(token, title) for token, title, _ in rows]
+    query = "TrailMaster X4 tent waterproof"
+    KeywordIndex.build(chunks).save(str(tmp_path / "saved.bm25"))
+    index, _ = KeywordIndex.load(str(tmp_path / "saved.bm25"))
+
+    documents = [tokenize(f"{token} {title}") for token, title in chunks]
+    average_length = sum(map(len, documents)) / len(documents)
+    expected = np.zeros(len(documents))
+    for term in set(tokenize(query)):
+        df = sum(term in terms for terms in documents)
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        for number, terms in enumerate(documents):
+            tf = terms.count(term)
+            expected[number] += idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * len(terms) / average_length))
+    indices, scores = index.search_terms(query, k=5)
+    assert indices.tolist() == np.argsort(-expected, kind="stable")[:5].tolist()
+    assert np.allclose(scores, expected[indices], rtol=1e-4)
+
+    vector_top = 500
+    local = LocalSearchIndex(
+        EMBEDDINGS_FILE, model="model", embedding_client=FakeEmbeddingClient({query: rows[vector_top][2]}),
+        keyword_index_directory=str(tmp_path / "embeddings.bm25"))
+    assert len(list((tmp_path / "embeddings.bm25").glob("*/documents.json"))) == 1
+    assert asyncio.run(local.semantic_search(query)) == asyncio.run(index.search(query))
+    assert [hit.embed_id for hit in index.get_hits(query, k=5)] == [str(i) for i in indices]
+
+    async def hybrid():
+        return [hit.embed_id async for hit in local.search_hits(query, mode="hybrid")]
+    assert set(asyncio.run(hybrid())[:2]) == {str(vector_top), str(indices[0])}
+
+
+class ThrottlingEmbeddingClient:
+    """The embedding client, which answers slowly and throttles the first request."""
+
+    def __init__(self, status=429):
+        self.status = status
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def embed(self, input, dimensions, model):
+        self.calls += 1
+        if self.calls == 1:
+            error = HttpResponseError(message="Too many requests")
+            error.status_code = self.status
+            error.response = SimpleNamespace(headers={"Retry-After": "0"})
+            raise error
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        # The later batches finish first.
+        await asyncio.sleep(0.05 / (1 + int(input[0].split()[1])))
+        self.active -= 1
+        return {"data": [{"embedding": [float(text.split()[1])]} for text in input]}
+
+
+def test_embeddings_are_built_concurrently_in_order(tmp_path):
+    client = ThrottlingEmbeddingClient()
+    manager = _get_manager(FakeSearchClient([]))
+    manager._embedding_client = client
+    chunks = [(f"chunk {i}", f"file_{i // 10}.md") for i in range(95)]
+    output_file = tmp_path / "embeddings.csv"
+
+    written = asyncio.run(manager._write_embeddings(chunks, str(output_file), batch_size=10, max_concurrency=4))
+
+    with open(output_file, newline="") as fp:
+        rows = list(csv.DictReader(fp))
+    assert written == 95
+    assert [(row["token"], row["title"]) for row in rows] == chunks
+    assert all(json.loads(row["embedding"]) == [float(i)] for i, row in enumerate(rows))
+    assert client.max_active == 4
+
+
+def test_only_transient_embedding_errors_are_retried():
+    manager = _get_manager(FakeSearchClient([]))
+    manager._embedding_client = ThrottlingEmbeddingClient(status=500)
+    assert asyncio.run(manager.embed_batch(["chunk 1"])) == [[1.0]]
+    assert manager._embedding_client.calls == 2
+
+    # The search indexing conflicts are not the embedding errors.
+    manager._embedding_client = ThrottlingEmbeddingClient(status=409)
+    try:
+        asyncio.run(manager.embed_batch(["chunk 1"]))
+        assert False, "The conflict must not be retried."
+    except HttpResponseError:
+        pass
+    assert manager._embedding_client.calls == 1
+
+
+def test_rebuild_embeds_only_changed_chunks(tmp_path):
+    client = ThrottlingEmbeddingClient()
+    manager = _get_manager(FakeSearchClient([]))
+    manager._embedding_client = client
+    chunks = [(f"chunk {i}", "file.md") for i in range(20)]
+    output_file = str(tmp_path / "embeddings.csv")
+    asyncio.run(manager._write_embeddings(chunks, output_file, batch_size=8))
+    calls = client.calls
+
+    chunks[5] = ("chunk 105", "file.md")
+    asyncio.run(manager._write_embeddings(chunks, output_file, batch_size=8))
+
+    with open(output_file, newline="") as fp:
+        rows = list(csv.DictReader(fp))
+    assert [row["token"] for row in rows] == [token for token, _ in chunks]
+    assert json.loads(rows[5]["embedding"]) == [105.0]
+    # Only the batch with the changed chunk is sent.
+    assert client.calls == calls + 1
+
+
+class RecordingSearchClient(FakeSearchClient):
+    """The search client, which records the queries."""
+
+    def __init__(self, documents):
+        super().__init__(documents, latency=0)
+        self.queries = []
+
+    async def search(self, **kwargs):
+        self.queries.append(kwargs)
+        return await super().search(**kwargs)
+
+
+class CountingEmbeddingClient(FakeEmbeddingClient):
+    """The embedding client, which counts the requests."""
+
+    def __init__(self, vectors):
+        super().__init__(vectors)
+        self.calls = 0
+
+    async def embed(self, input, dimensions, model):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return await super().embed(input, dimensions, model)
+
+
+def test_vectorized_queries_are_cached():
+    client = RecordingSearchClient(DOCUMENTS)
+    embedding_client = CountingEmbeddingClient({"What is the tent price?": [0.5, 0.5]})
+    manager = _get_manager(client)
+    manager._query_cache = QueryEmbeddingCache(manager._embed_query, max_size=2)
+    manager._result_cache = SearchResultCache(ttl=0)
+    manager._embedding_client = embedding_client
+
+    async def main():
+        await asyncio.gather(*(manager.search("What is the tent price?") for _ in range(3)))
+        await manager.search("  what is the TENT price? ")
+
+    asyncio.run(main())
+
+    assert embedding_client.calls == 1
+    assert client.queries[-1]["vector_queries"][0].vector == [0.5, 0.5]
+    stats = manager.get_query_cache_stats()
+    assert (stats["hits"], stats["misses"]) == (3, 1)
+    assert stats["time_saved"] > 0
+
+
+def test_search_results_are_cached_until_documents_change(tmp_path):
+    client = RecordingSearchClient(DOCUMENTS)
+    manager = _get_manager(client)
+    client.upload_documents = lambda documents: asyncio.sleep(0, [
+        SimpleNamespace(key=d["embedId"], succeeded=True, status_code=201) for d in documents])
+    manager._probe_ready = lambda expected_count: asyncio.sleep(0, True)
+
+    async def main():
+        first = await manager.semantic_search("Tent price")
+        assert await manager.semantic_search(" tent  PRICE") == first
+        await manager.search("Tent price")
+        assert len(client.queries) == 2
+        await manager.upload_documents(EMBEDDINGS_FILE)
+        await manager.semantic_search("Tent price")
+
+    asyncio.run(main())
+
+    assert len(client.queries) == 3
+    stats = manager.get_result_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 3, 1)
+
+
+class TwoLegSearchClient:
+    """The search client, which answers the vector and the text queries differently."""
+
+    def __init__(self, vector_documents, text_documents, latency=0.05):
+        self.results = {"vector": vector_documents, "text": text_documents}
+        self.latency = latency
+
+    async def search(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        documents = self.results["vector" if "vector_queries" in kwargs else "text"]
+
+        async def results():
+            for document in documents[:kwargs.get("top") or len(documents)]:
+                yield document
+        return results()
+
+
+def test_hybrid_search_fuses_concurrent_legs():
+    def doc(key):
+        return {"token": f"chunk {key}", "title": "product_info_1.md", "embedId": key}
+    client = TwoLegSearchClient([doc("1"), doc("2"), doc("3")], [doc("3"), doc("4"), doc("1")])
+    manager = _get_manager(client)
+
+    start = time.perf_counter()
+    documents, timings = asyncio.run(manager.hybrid_search_documents("tent", top_k=3))
+    elapsed = time.perf_counter() - start
+
+    assert [d["embedId"] for d in documents] == ["1", "3", "2"]
+    assert elapsed < 2 * client.latency
+    assert set(timings) == {"vector", "semantic", "total"}
+    assert asyncio.run(manager.hybrid_search("tent")).startswith("chunk 1, source: product_info_1.md")
+
+
+def test_search_many_keeps_order():
+    client = FakeSearchClient(DOCUMENTS, latency=0.05)
+    manager = _get_manager(client)
+    messages = [f"question {i}" for i in range(8)]
+
+    start = time.perf_counter()
+    results = asyncio.run(manager.search_many(messages, concurrency=4))
+    elapsed = time.perf_counter() - start
+
+    assert [r.message for r in results] == messages
+    assert all(r.context == "The TrailMaster X4 Tent, source: product_info_1.md" for r in results)
+    assert all(r.latency >= 0.05 for r in results)
+    assert 0.1 <= elapsed < 0.3
+
+    rows = _read_embeddings()
+    vectors = {f"q{i}": rows[i][2] for i in (3, 30, 300)}
+    index = LocalSearchIndex(EMBEDDINGS_FILE, model="model", embedding_client=CountingEmbeddingClient(vectors))
+    local = asyncio.run(index.search_many(list(vectors)))
+    assert index._embedding_client.calls == 1
+    assert [r.context for r in local] == [asyncio.run(index.search(m)) for m in vectors]
+
+
+def test_clients_share_connections():
+    from aiohttp import web
+    from azure.core.credentials import AzureKeyCredential
+
+    async def count(request):
+        return web.Response(text="953", content_type="text/plain")
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/indexes('index')/docs/$count", count)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with SearchIndexManager(
+                    endpoint=f"http://127.0.0.1:{port}",
+                    credential=AzureKeyCredential("key"),
+                    index_name="index",
+                    dimensions=None,
+                    model="model",
+                    deployment_name="model",
+                    embedding_endpoint="https://embed.example.com",
+                    embed_api_key=None) as manager:
+                manager._index = SimpleNamespace(name="index")
+                counts = [await manager._get_client().get_document_count() for _ in range(3)]
+                session = manager._session
+            assert session.closed
+            return counts, manager.get_connection_stats()
+        finally:
+            await runner.cleanup()
+
+    counts, stats = asyncio.run(main())
+
+    assert counts == [953, 953, 953]
+    assert (stats["created"], stats["reused"]) == (1, 2)
+
+
+class FakeSearchService:
+    """The in-memory stand-in for the search service with several indexes."""
+
+    def __init__(self, documents):
+        self.indexes = {"index": list(documents)}
+        self.pointers = {}
+        self.drop_uploads = False
+
+    def get_client(self, endpoint, index_name, credential, transport):
+        if index_name.endswith(SearchIndexManager.ALIAS_SUFFIX):
+            return FakeAliasClient(self)
+        return FakeIndexSearchClient(self, index_name)
+
+    async def create_index(self, index):
+        self.indexes[index.name] = []
+        return SimpleNamespace(name=index.name)
+
+    async def create_or_update_index(self, index):
+        return index
+
+    async def delete_index(self, name):
+        del self.indexes[name]
+
+    async def list_index_names(self):
+        for name in list(self.indexes):
+            yield name
+
+    async def close(self):
+        pass
+
+
+class FakeIndexSearchClient(FakeSearchClient):
+    """The search client of one index of the fake service."""
+
+    def __init__(self, service, index_name):
+        super().__init__(service.indexes[index_name], latency=0.01)
+        self.service = service
+
+    async def upload_documents(self, documents):
+        await asyncio.sleep(0.01)
+        if not self.service.drop_uploads:
+            self.documents.extend(documents)
+        return [SimpleNamespace(key=d["embedId"], succeeded=True, status_code=201) for d in documents]
+
+    async def close(self):
+        pass
+
+
+class FakeAliasClient:
+    """The search client of the pointer index of the fake service."""
+
+    def __init__(self, service):
+        self.service = service
+
+    async def get_document(self, key, selected_fields):
+        from azure.core.exceptions import ResourceNotFoundError
+        if key not in self.service.pointers:
+            raise ResourceNotFoundError("Not found")
+        return {"index_name": self.service.pointers[key]}
+
+    async def merge_or_upload_documents(self, documents):
+        for document in documents:
+            self.service.pointers[document["alias"]] = document["index_name"]
+        return [SimpleNamespace(succeeded=True)]
+
+
+def test_rebuild_switches_versions_without_downtime(monkeypatch):
+    import api.search_index_manager as search_index_manager
+    service = FakeSearchService(DOCUMENTS)
+    monkeypatch.setattr(search_index_manager, "SearchClient", service.get_client)
+    monkeypatch.setattr(search_index_manager, "SearchIndexClient", lambda **kwargs: service)
+    monkeypatch.setattr(SearchIndexManager, "READY_TIMEOUT", 0.1)
+    manager = _get_manager(service.get_client(None, "index", None, None))
+    manager._index_client = service
+    manager._transport = SimpleNamespace()
+    # The agent versions: the running one searches the first version, the latest one the active version.
+    agent_indexes = ["index"]
+
+    async def repin(index_name):
+        assert service.pointers.get("index") != index_name
+        agent_indexes.append(index_name)
+
+    async def pinned():
+        return {agent_indexes[1], agent_indexes[-1]}
+
+    async def rebuild():
+        return await manager.rebuild_index(
+            EMBEDDINGS_FILE, vector_index_dimensions=100, before_switch=repin, pinned_indexes=pinned)
+
+    async def main():
+        assert await manager.resolve_index_name() == "index"
+        old_results = await manager.search("Tent price")
+        served = []
+        rebuilding = asyncio.ensure_future(rebuild())
+        while not rebuilding.done():
+            served.append(await manager.search(f"question {len(served)}"))
+        first = await rebuilding
+        assert all(served)
+        searches = manager._get_client().searches
+        new_results = await manager.search("Tent price")
+        assert manager._client.searches == searches
+        assert new_results != old_results
+        names = [first] + [await rebuild() for _ in range(3)]
+
+        service.drop_uploads = True
+        try:
+            await rebuild()
+            assert False, "The incomplete index must not be switched to."
+        except ValueError:
+            pass
+        return names, await manager.resolve_index_name()
+
+    names, active = asyncio.run(main())
+
+    assert all(name.startswith("index-v") for name in names)
+    assert active == names[-1] == manager._index.name
+    assert agent_indexes == ["index"] + names
+    # The legacy index, the version pinned by the running agent and the two most recent
+    # versions are kept; the failed one is deleted.
+    assert sorted(service.indexes) == ["index", names[0]] + names[2:]
+
+
+def test_failed_cleanup_raises_the_rebuild_error(monkeypatch):
+    import api.search_index_manager as search_index_manager
+    service = FakeSearchService(DOCUMENTS)
+    service.drop_uploads = True
+    monkeypatch.setattr(search_index_manager, "SearchClient", service.get_client)
+    monkeypatch.setattr(search_index_manager, "SearchIndexClient", lambda **kwargs: service)
+    monkeypatch.setattr(SearchIndexManager, "READY_TIMEOUT", 0.1)
+    manager = _get_manager(service.get_client(None, "index", None, None))
+    manager._index_client = service
+
+    async def delete_index(name):
+        raise HttpResponseError(message="Service unavailable")
+
+    service.delete_index = delete_index
+    try:
+        asyncio.run(manager.rebuild_index(EMBEDDINGS_FILE, vector_index_dimensions=100))
+        assert False, "The rebuild error must be raised."
+    except ValueError:
+        pass
+    assert manager._index_name == "index"
+
+
+class KeyedSearchClient:
+    """The search client, which keeps the documents by their keys."""
+
+    def __init__(self, documents):
+        self.documents = {d["embedId"]: d for d in documents}
+
+    async def search(self, **kwargs):
+        async def results():
+            for document in list(self.documents.values()):
+                yield document
+        return results()
+
+    async def upload_documents(self, documents):
+        self.documents.update({d["embedId"]: d for d in documents})
+        return [SimpleNamespace(key=d["embedId"], succeeded=True, status_code=201) for d in documents]
+
+    async def delete_documents(self, documents):
+        for document in documents:
+            self.documents.pop(document["embedId"], None)
+        return [SimpleNamespace(key=d["embedId"], succeeded=True, status_code=200) for d in documents]
+
+
+def test_watcher_reindexes_only_changed_files(tmp_path, monkeypatch):
+    from api import chunking
+    from api.index_watcher import IndexWatcher, OpenAIEmbeddingClient, get_document_key, is_document_key
+    monkeypatch.setattr(chunking, "_sent_tokenize", lambda line: [s for s in line.split(". ") if s])
+    files = tmp_path / "files"
+    files.mkdir()
+    (files / "a.md").write_text("The tent is light. The tent is green.\n")
+    (files / "b.md").write_text("Hiking boots are waterproof.\n")
+    client = KeyedSearchClient(DOCUMENTS)
+    manager = _get_manager(client)
+    requests = []
+
+    async def create(input, model, **kwargs):
+        requests.append(kwargs)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text))]) for text in input])
+
+    manager._dimensions = 1
+    manager._embedding_client = OpenAIEmbeddingClient(SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    watcher = IndexWatcher(
+        manager, str(files), str(tmp_path / "manifest.json"), sentences_per_embedding=1, patterns=("*.md",))
+
+    # The stale document of the lost manifest and the one of the embeddings file for a.md are deleted,
+    # the one for another file is kept.
+    stale_key = get_document_key("c.md", "The stale chunk.")
+    client.documents[stale_key] = {"embedId": stale_key, "token": "The stale chunk."}
+    client.documents["1"] = {"embedId": "1", "token": "The tent is light.", "title": "a.md"}
+    first = asyncio.run(watcher.sync())
+    assert (first["added"], first["uploaded"], first["removed"]) == (2, 3, 2)
+    assert "1" not in client.documents
+    assert sorted(d["token"] for d in client.documents.values() if is_document_key(d["embedId"])) == [
+        "Hiking boots are waterproof.", "The tent is green.", "The tent is light"]
+    assert {d["embedId"] for d in DOCUMENTS} <= set(client.documents)
+    assert requests and all(kwargs == {"dimensions": 1} for kwargs in requests)
+
+    os.utime(files / "a.md", (time.time() + 10, time.time() + 10))
+    assert asyncio.run(watcher.sync())["unchanged"] == 2
+
+    kept = {key for key, d in client.documents.items() if d["token"] == "The tent is light"}
+    (files / "a.md").write_text("The tent is light. The tent is blue.\n")
+    (files / "b.md").unlink()
+    stats = asyncio.run(watcher.sync())
+    assert (stats["changed"], stats["deleted"], stats["uploaded"], stats["removed"]) == (1, 1, 1, 2)
+    assert sorted(d["token"] for d in client.documents.values() if is_document_key(d["embedId"])) == [
+        "The tent is blue.", "The tent is light"]
+    assert kept <= set(client.documents)
+
+
+def test_watcher_survives_connection_errors(tmp_path):
+    from azure.core.exceptions import ServiceRequestError
+    from api.index_watcher import IndexWatcher
+    watcher = IndexWatcher(_get_manager(KeyedSearchClient([])), str(tmp_path), str(tmp_path / "manifest.json"))
+    stop = asyncio.Event()
+    calls = []
+
+    async def sync():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ServiceRequestError("Connection refused")
+        stop.set()
+
+    watcher.sync = sync
+    asyncio.run(watcher.watch(interval=0, stop=stop))
+
+    assert len(calls) == 2
+
+
+class UploadingSearchClient(KeyedSearchClient):
+    """The keyed search client, which fails the uploads as scripted and tracks the concurrent ones."""
+
+    def __init__(self, failures=()):
+        super().__init__([])
+        # Every item is the status of the failed request or the statuses of the failed documents by key.
+        self.failures = list(failures)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def upload_documents(self, documents):
+        self.requests.append([d["embedId"] for d in documents])
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        failure = self.failures.pop(0) if self.failures else {}
+        if isinstance(failure, int):
+            error = HttpResponseError(message=f"Status {failure}")
+            error.status_code = failure
+            raise error
+        results = await super().upload_documents([d for d in documents if d["embedId"] not in failure])
+        return results + [
+            SimpleNamespace(key=key, succeeded=False, status_code=status, error_message=f"Status {status}")
+            for key, status in failure.items()]
+
+    async def get_document_count(self):
+        return len(self.documents)
+
+    async def close(self):
+        pass
+
+
+def test_batches_are_bounded_by_count_and_size():
+    documents = [{"embedId": str(i), "@size": size} for i, size in enumerate([10] * 5 + [60, 60, 150])]
+
+    batches = list(SearchIndexManager._iter_batches(iter(documents), batch_size=3, batch_bytes=100))
+
+    # The oversized document is sent alone rather than dropped.
+    assert [[d["embedId"] for d in batch] for batch in batches] == [
+        ["0", "1", "2"], ["3", "4", "5"], ["6"], ["7"]]
+    assert all("@size" not in d for batch in batches for d in batch)
+
+
+def test_upload_retries_throttled_documents_and_requests(monkeypatch):
+    monkeypatch.setattr(SearchIndexManager, "_get_retry_after", staticmethod(lambda error, attempt: 0))
+    client = UploadingSearchClient([{"0": 409, "1": 422}, 429, {"1": 503}])
+    manager = _get_manager(client)
+
+    async def upload(documents):
+        return await manager._upload_batch([{"embedId": key} for key in documents])
+
+    assert asyncio.run(upload(["0", "1", "2"])) == 3
+    # Only the failed documents are sent again, the throttled request is repeated as is.
+    assert client.requests == [["0", "1", "2"], ["0", "1"], ["0", "1"], ["1"]]
+    assert set(client.documents) == {"0", "1", "2"}
+
+    client = UploadingSearchClient([{"0": 400}])
+    manager = _get_manager(client)
+    try:
+        asyncio.run(upload(["0", "1"]))
+        assert False, "The document, rejected for good, must fail the upload."
+    except HttpResponseError:
+        pass
+    assert client.requests == [["0", "1"]]
+
+
+def test_upload_keeps_bounded_number_of_batches_in_flight():
+    client = UploadingSearchClient()
+    manager = _get_manager(client)
+
+    async def main():
+        uploaded = await manager.upload_documents(EMBEDDINGS_FILE, batch_size=100, max_concurrency=2)
+        await manager.close()
+        return uploaded
+
+    uploaded = asyncio.run(main())
+
+    assert uploaded == len(_read_embeddings()) == len(client.documents)
+    assert client.max_active == 2
+    assert len(client.requests) == 10 and all(len(request) <= 100 for request in client.requests)
+
+
+def _get_uploaded_manager(keys):
+    client = UploadingSearchClient()
+    client.documents = {key: {"embedId": key} for key in keys}
+    return _get_manager(client), client
+
+
+def _ensure_documents(manager, checkpoint_file=None):
+    async def main():
+        uploaded = await manager.ensure_documents(EMBEDDINGS_FILE, checkpoint_file=checkpoint_file)
+        await manager.close()
+        return uploaded
+    return asyncio.run(main())
+
+
+def test_interrupted_upload_is_resumed_from_checkpoint(tmp_path):
+    from util import file_sha256
+    count = len(_read_embeddings())
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    SearchIndexManager._save_checkpoint(checkpoint_file, file_sha256(EMBEDDINGS_FILE), map(str, range(100)))
+    manager, client = _get_uploaded_manager(map(str, range(100)))
+
+    assert _ensure_documents(manager, checkpoint_file) == count - 100
+    assert not {str(key) for key in range(100)} & {key for request in client.requests for key in request}
+    assert len(client.documents) == count
+    assert len(SearchIndexManager._load_checkpoint(checkpoint_file, file_sha256(EMBEDDINGS_FILE))) == count
+
+    # The complete index is not uploaded again.
+    client.requests.clear()
+    assert _ensure_documents(_get_manager(client), checkpoint_file) == 0 and client.requests == []
+
+
+def test_documents_of_other_sources_are_not_counted():
+    count = len(_read_embeddings())
+    # The documents of the watcher outnumber the missing ones of the embeddings file.
+    manager, client = _get_uploaded_manager(
+        [str(key) for key in range(count - 10)] + [f"watched-{key}" for key in range(20)])
+
+    assert _ensure_documents(manager) == 10
+    assert len(client.documents) == count + 20
+
+
+def test_stale_checkpoint_falls_back_to_index_keys(tmp_path):
+    count = len(_read_embeddings())
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    # The checkpoint of another embeddings file claims more documents than the index has.
+    SearchIndexManager._save_checkpoint(checkpoint_file, "other", map(str, range(100)))
+    manager, client = _get_uploaded_manager(map(str, range(50)))
+
+    assert _ensure_documents(manager, checkpoint_file) == count - 50
+    assert len(client.documents) == count
+    assert not {str(key) for key in range(50)} & {key for request in client.requests for key in request}
+
+    # Without the checkpoint, only the keys absent from the index are uploaded too.
+    manager, client = _get_uploaded_manager(map(str, range(0, count, 2)))
+    assert _ensure_documents(manager) == count // 2
+    assert len(client.documents) == count
@@ -0,0 +1,44 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+from api.search_index_manager import format_search_results
+from api.search_results import SearchHit, format_search_hits, pack_search_hits
+
+
+def test_formatter_is_adapter_over_hits():
+    documents = [
+        {"token": "The TrailMaster X4 Tent", "title": "product_info_1.md", "@search.score": 0.5},
+        {"token": "The Alpine Explorer Tent", "title": "product_info_8.md", "embedId": "7"},
+    ]
+
+    hits = [SearchHit.from_document(document) for document in documents]
+
+    assert hits[0].score == 0.5 and hits[1].embed_id == "7"
+    assert format_search_results(documents) == format_search_hits(hits) == (
+        "The TrailMaster X4 Tent, source: product_info_1.md\n------\n"
+        "The Alpine Explorer Tent, source: product_info_8.md")
+
+
+def test_hit_found_in_several_files_cites_them_all():
+    hit = SearchHit.from_document({"token": "Return within 30 days", "title": "a.md; b.md"})
+
+    assert hit.titles == ["a.md", "b.md"]
+    assert hit.format() == "Return within 30 days, sources: a.md, b.md"
+
+
+def test_packing_fills_budget_by_score_and_drops_near_duplicates():
+    hits = [
+        SearchHit("The tent is waterproof and sleeps four people.", "a.md", "1", 0.7),
+        SearchHit("The tent is waterproof and sleeps four people!", "b.md", "2", 0.9),
+        SearchHit("Hiking boots with a breathable membrane.", "c.md", "3", 0.8),
+        SearchHit("A very long passage. " * 20, "d.md", "4", 0.85),
+        SearchHit("The stove boils water fast.", "e.md", "5", 0.1),
+    ]
+
+    packed = pack_search_hits(hits, budget=180)
+
+    assert [hit.embed_id for hit in packed] == ["2", "3", "5"]
+    assert len(format_search_hits(packed)) <= 180
+    assert [hit.embed_id for hit in pack_search_hits(hits, budget=35, unit="tokens")] == ["2", "3"]
@@ -0,0 +1,34 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import logging
+import time
+
+from startup_pipeline import StartupPipeline
+
+
+def _sleep_step(seconds: float, value):
+    async def step(*args):
+        await asyncio.sleep(seconds)
+        return (value, args)
+    return step
+
+
+def test_independent_steps_run_concurrently():
+    pipeline = StartupPipeline(logging.getLogger(__name__))
+    pipeline.add_step("a", _sleep_step(0.2, "a"))
+    pipeline.add_step("b", _sleep_step(0.2, "b"))
+    pipeline.add_step("c", _sleep_step(0.1, "c"), depends_on=["a", "b"])
+    pipeline.add_step("d", _sleep_step(0.05, "d"), depends_on=["a"])
+
+    start = time.perf_counter()
+    results = asyncio.run(pipeline.run())
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.45
+    assert results["c"] == ("c", (("a", ()), ("b", ())))
+    assert pipeline.critical_path()[-1] == "c"
+    assert len(pipeline.critical_path()) == 2
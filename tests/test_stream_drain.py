@@ -0,0 +1,69 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+
+from api.stream_drain import StreamDrain
+
+
+async def _stream(drain: StreamDrain, events: int):
+    with drain.track() as stream:
+        for i in range(events):
+            if drain.expired():
+                stream.aborted = True
+                break
+            await asyncio.sleep(0.05)
+            yield i
+
+
+async def _consume(stream):
+    return [event async for event in stream]
+
+
+def test_drain_counts_finished_and_aborted_streams():
+    async def run():
+        drain = StreamDrain(grace_seconds=0.2)
+        short = asyncio.create_task(_consume(_stream(drain, 2)))
+        long = asyncio.create_task(_consume(_stream(drain, 100)))
+        await asyncio.sleep(0.01)
+        drain.begin("test")
+        await drain.wait()
+        return await short, await long, drain
+
+    short, long, drain = asyncio.run(run())
+    assert short == [0, 1]
+    assert 0 < len(long) < 100
+    assert drain._drained == 1
+    assert drain._aborted == 1
+
+
+def test_drain_begins_on_max_requests():
+    drain = StreamDrain(grace_seconds=1)
+    drain.configure(max_requests=2)
+    drain.count_request()
+    assert not drain.draining
+    drain.count_request()
+    assert drain.draining
+
+
+def test_flush_completes_write_of_cancelled_stream():
+    async def run():
+        drain = StreamDrain(grace_seconds=1)
+        written = []
+
+        async def write():
+            await asyncio.sleep(0.1)
+            written.append(True)
+
+        task = asyncio.create_task(drain.flush(write()))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return written
+
+    assert asyncio.run(run()) == [True]
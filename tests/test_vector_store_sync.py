@@ -0,0 +1,83 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+from api.vector_store_sync import VectorStoreSync
+
+
+class _FakeStoreFiles:
+    def __init__(self, client):
+        self._client = client
+
+    async def _list(self, vector_store_id):
+        for file_id in list(self._client.store_files):
+            yield SimpleNamespace(id=file_id, status="completed")
+
+    def list(self, vector_store_id):
+        return self._list(vector_store_id)
+
+    async def upload_and_poll(self, vector_store_id, file):
+        file_id = f"file-{next(self._client.ids)}"
+        self._client.store_files[file_id] = file.read()
+        self._client.uploads.append(file.name)
+        return SimpleNamespace(id=file_id, status="completed")
+
+    async def delete(self, file_id, vector_store_id):
+        del self._client.store_files[file_id]
+
+
+class _FakeOpenAI:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.store_files = {}
+        self.uploads = []
+        self.deleted = []
+
+        async def create():
+            return SimpleNamespace(id="vs-1")
+
+        async def retrieve(vector_store_id):
+            return SimpleNamespace(id=vector_store_id)
+
+        async def delete_file(file_id):
+            self.deleted.append(file_id)
+
+        self.vector_stores = SimpleNamespace(create=create, retrieve=retrieve, files=_FakeStoreFiles(self))
+        self.files = SimpleNamespace(delete=delete_file)
+
+
+def test_only_changed_files_are_uploaded(tmp_path):
+    root = tmp_path / "files"
+    (root / "a").mkdir(parents=True)
+    (root / "b").mkdir()
+    paths = [root / "a" / "info.md", root / "b" / "info.md", root / "c.md"]
+    for path in paths:
+        path.write_text(f"The contents of {path.parent.name}.")
+    client = _FakeOpenAI()
+    sync = VectorStoreSync(client, str(tmp_path / "manifest.json"), str(root))
+
+    # The files with the same name in the different directories are uploaded separately.
+    assert asyncio.run(sync.sync([str(p) for p in paths])) == "vs-1"
+    assert len(client.uploads) == 3 and len(client.store_files) == 3
+
+    # The unchanged files are reused.
+    client.uploads.clear()
+    asyncio.run(sync.sync([str(p) for p in paths]))
+    assert client.uploads == [] and client.deleted == []
+
+    # The changed file is re-uploaded and its previous version is deleted.
+    paths[1].write_text("The new contents.")
+    asyncio.run(sync.sync([str(p) for p in paths]))
+    assert client.uploads == [str(paths[1])]
+    assert len(client.deleted) == 1 and len(client.store_files) == 3
+
+    # The deleted file is removed from the vector store.
+    client.uploads.clear()
+    asyncio.run(sync.sync([str(p) for p in paths[1:]]))
+    assert client.uploads == [] and len(client.deleted) == 2
+    assert sorted(client.store_files.values()) == [b"The contents of files.", b"The new contents."]